@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+This module precomputes ("bakes") the parts of a logistic model that do not
+depend on shaking. The model equation
+
+    b0 + b1*t1 + ... + bN*tN
+
+is split into a static part and a sum of shaking dependent factors, each
+multiplied by a coefficient that only depends on the predictor layers, e.g.,
+for log(pgv) * arctan(slope) the slope part goes into the coefficient grid of
+log(pgv). The static part and the coefficient grids are saved as GeoTIFF
+files aligned with the base layer of the model, along with a json manifest.
+
+Adding ``bakefile = <path to manifest>`` to the model config makes
+LogisticModel read these grids instead of cutting and resampling every
+predictor layer for each event. The grids are resampled bilinearly to the
+model grid, so results can differ slightly from the full calculation where
+the model resamples layers with another method or subdivides cells
+(divfactor).
+
+The Godt and others (2008) model is baked the same way (bakeGodt): the
+critical acceleration of each slope quantile only depends on the slope,
+cohesion and friction layers and the model parameters, so it is saved as one
+grid per quantile, along with the maximum slope. Adding ``bakefile`` to the
+godt_2008 section of the config makes godt2008 read windows of these grids
+instead of computing the Factor of Safety for each event.
+"""
+
+# stdlib imports
+import os
+import json
+from timeit import default_timer as timer
+
+# third party imports
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from mapio.geodict import GeoDict
+
+# local imports
+from gfail.logisticmodel import (getLogisticModelNames, validateCoefficients,
+                                 validateLayers, validateTerms,
+                                 validateInterpolations, validateClips,
+                                 getFileType, getNuggets, getBakeHash)
+from gfail.godt import (QUANTILES, BAKE_PARAMS, getStrength, getSlope,
+                        getCriticalAcc, getGodtBakeHash)
+from gfail.spatial import quickcut, getTileGeoDict
+from gfail.catalog import getCatalog
+from gfail.termcompiler import TermKernel, splitTerms
+
+
+def bake(config, outdir, bounds=None, rowmax=1000):
+    """
+    Compute the static grids of a logistic model.
+
+    Args:
+        config: configobj object defining the model and its inputs, with
+            full file paths. Only one model should be described.
+        outdir (str): Directory where the grids and manifest are saved.
+        bounds (dict): Default of None uses the full extent of the base layer,
+            otherwise a dictionary of boundaries to cut to like
+
+            .. code-block:: python
+
+                bounds = {
+                    'xmin': lonmin, 'xmax': lonmax,
+                    'ymin': latmin, 'ymax': latmax
+                }
+
+        rowmax (int): Number of rows of the base layer to compute at once.
+
+    Returns:
+        str: Path to the manifest file, to use as bakefile in the model
+        config.
+    """
+    mnames = getLogisticModelNames(config)
+    if len(mnames) != 1:
+        raise Exception('Config file must contain exactly one model')
+    model = mnames[0]
+    cmodel = config[model]
+    coeffs = validateCoefficients(cmodel)
+    layers = validateLayers(cmodel)
+    terms, timeField = validateTerms(cmodel, coeffs, layers)
+    if timeField is not None:
+        raise Exception('Models with time dependent layers cannot be baked')
+    interpolations = validateInterpolations(cmodel, layers)
+    gmused = [value for term, value in cmodel['terms'].items()
+              if 'pga' in value.lower() or 'pgv' in value.lower() or
+              'mmi' in value.lower()]
+    clips = validateClips(cmodel, layers, gmused)
+
+    static, factors = splitTerms(getNuggets(terms, coeffs))
+
+    # Equations to evaluate on each block, first the static part then the
+    # coefficients that depend on layers
+    equations = [' + '.join(static)]
+    manifest = {
+        'model': model,
+        'hash': getBakeHash(terms, coeffs, layers, interpolations, clips),
+        'static': '%s_static.tif' % model,
+        'factors': [],
+        'notes': ''
+    }
+    for i, (factor, coeff) in enumerate(factors.items()):
+        coeff = ' + '.join(coeff)
+        if 'getSlice' in coeff:
+            equations.append(coeff)
+            manifest['factors'].append({
+                'factor': factor, 'file': '%s_coeff%d.tif' % (model, i)})
+        else:
+            manifest['factors'].append({
+                'factor': factor, 'value': float(eval(coeff, {'np': np}))})
+    outfiles = [manifest['static']] + [
+        factor['file'] for factor in manifest['factors'] if 'file' in factor]
+    kernel = TermKernel(equations)
+    needed = [leaf[1] for leaf in kernel.getLeaves()]
+    if 'rock' in needed:
+        manifest['notes'] = (
+            'unconsolidated sediment coefficient changed to -1.36 (weaker) '
+            'from -3.22 to better reflect that this unit is not actually '
+            'strong\n')
+
+    gdict = _getBaseGeoDict(layers[cmodel['baselayer']], bounds)
+    bakefile = os.path.join(outdir, '%s_bake.json' % model)
+    _removeManifest(bakefile)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    profile = _getProfile(gdict)
+    dsts = [rasterio.open(os.path.join(outdir, outfile), 'w', **profile)
+            for outfile in outfiles]
+    try:
+        for rowstart in range(0, gdict.ny, rowmax):
+            start = timer()
+            rowend = min(rowstart + rowmax, gdict.ny)
+            blockdict = GeoDict({
+                'xmin': gdict.xmin, 'xmax': gdict.xmax,
+                'ymin': gdict.ymax - (rowend - 1) * gdict.dy,
+                'ymax': gdict.ymax - rowstart * gdict.dy,
+                'dx': gdict.dx, 'dy': gdict.dy,
+                'ny': rowend - rowstart, 'nx': gdict.nx})
+            data = {}
+            for layername in needed:
+                temp = quickcut(layers[layername], blockdict, precise=True,
+                                method=interpolations[layername])
+                layer = temp.getData().astype(float)
+                if layername in clips:
+                    layer = np.clip(layer, clips[layername][0],
+                                    clips[layername][1])
+                if layername == 'rock':  # Same substitution as LogisticModel
+                    layer[layer <= -3.21] = -1.36
+                data[layername] = layer
+                del(temp)
+            results = kernel.evaluate(lambda source, key, name: data[key])
+            window = Window(0, rowstart, gdict.nx, rowend - rowstart)
+            for dst, result in zip(dsts, results):
+                block = np.empty((rowend - rowstart, gdict.nx))
+                block[:] = result
+                dst.write(block.astype('float32'), 1, window=window)
+            print('Baked rows %d to %d of %d: %1.1f sec'
+                  % (rowstart, rowend, gdict.ny, timer() - start))
+    finally:
+        for dst in dsts:
+            dst.close()
+
+    # Written last, so an interrupted bake is never used
+    with open(bakefile, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return bakefile
+
+
+def bakeGodt(config, outdir, bounds=None, rowmax=1000, slopediv=100.,
+             codiv=10.):
+    """
+    Compute the critical accelerations of each slope quantile of the Godt
+    and others (2008) model (see :func:`gfail.godt.godt2008`), which do not
+    depend on shaking.
+
+    Args:
+        config: configobj object of the godt_2008 model, with full file
+            paths.
+        outdir (str): Directory where the grids and manifest are saved.
+        bounds (dict): Default of None uses the full extent of the slope
+            quantile files, otherwise a dictionary of boundaries to cut to,
+            see bake.
+        rowmax (int): Number of rows of the slope quantile files to compute
+            at once.
+        slopediv (float): Divide slope by this number to get slope in
+            degrees, must be the same as in godt2008.
+        codiv (float): Divide cohesion input layer by this number, must be
+            the same as in godt2008.
+
+    Returns:
+        str: Path to the manifest file, to use as bakefile in the godt_2008
+        section of the config.
+    """
+    cmodel = config['godt_2008']
+    try:
+        slopefilepath = cmodel['layers']['slope']['filepath']
+        cohesionfile = cmodel['layers']['cohesion']['file']
+        frictionfile = cmodel['layers']['friction']['file']
+        params = dict([(key, float(cmodel['parameters'][key]))
+                       for key in BAKE_PARAMS
+                       if key not in ['slopediv', 'codiv']])
+    except Exception as e:
+        raise NameError('Could not parse configfile, %s' % e)
+    params['slopediv'] = slopediv
+    params['codiv'] = codiv
+
+    manifest = {
+        'model': 'godt_2008',
+        'hash': getGodtBakeHash(slopefilepath, cohesionfile, frictionfile,
+                                params),
+        'ac': ['godt_2008_ac_%s.tif' % os.path.splitext(quant)[0]
+               for quant in QUANTILES],
+        'maxslope': 'godt_2008_maxslope.tif'
+    }
+    gdict = _getBaseGeoDict(os.path.join(slopefilepath, QUANTILES[0]),
+                            bounds)
+    bakefile = os.path.join(outdir, 'godt_2008_bake.json')
+    _removeManifest(bakefile)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    profile = _getProfile(gdict)
+    dsts = [rasterio.open(os.path.join(outdir, outfile), 'w', **profile)
+            for outfile in manifest['ac'] + [manifest['maxslope']]]
+    try:
+        for rowstart in range(0, gdict.ny, rowmax):
+            start = timer()
+            rowend = min(rowstart + rowmax, gdict.ny)
+            blockdict = getTileGeoDict((rowstart, rowend, None, None), gdict)
+            window = Window(0, rowstart, gdict.nx, rowend - rowstart)
+            cohesion, friction = getStrength(
+                cohesionfile, frictionfile, blockdict, codiv=codiv,
+                nodata_cohesion=params['nodata_cohesion'],
+                nodata_friction=params['nodata_friction'])
+            for dst, quant in zip(dsts, QUANTILES):
+                slope = getSlope(os.path.join(slopefilepath, quant),
+                                 blockdict, slopediv=slopediv)
+                FS, Ac = getCriticalAcc(
+                    slope, cohesion, friction, params['thick'],
+                    params['uwt'], params['fsthresh'], params['acthresh'])
+                dst.write(Ac.astype('float32'), 1, window=window)
+                del(FS, Ac)
+            # The last quantile is the maximum slope
+            dsts[-1].write(slope.astype('float32'), 1, window=window)
+            print('Baked rows %d to %d of %d: %1.1f sec'
+                  % (rowstart, rowend, gdict.ny, timer() - start))
+    finally:
+        for dst in dsts:
+            dst.close()
+
+    # Written last, so an interrupted bake is never used
+    with open(bakefile, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return bakefile
+
+
+def _removeManifest(bakefile):
+    """
+    Remove the manifest of a previous bake before its grids are overwritten,
+    so an interrupted bake never leaves a manifest pointing at partial grids.
+    """
+    if os.path.exists(bakefile):
+        os.remove(bakefile)
+
+
+def _getBaseGeoDict(basefile, bounds=None):
+    """
+    Get the geodictionary of the grids to bake, the grid of basefile or its
+    part within bounds.
+    """
+    ftype = getFileType(basefile)
+    if ftype == 'esri':
+        gdict, firstcol = getCatalog().getGeoDict(basefile, 'gdal')
+    elif ftype == 'gmt':
+        gdict, firstcol = getCatalog().getGeoDict(basefile, 'gmt')
+    else:
+        raise Exception('All predictor variable grids must be a valid '
+                        'GMT or ESRI file type.')
+    if bounds is not None:
+        tempgdict = GeoDict.createDictFromBox(
+            bounds['xmin'], bounds['xmax'], bounds['ymin'], bounds['ymax'],
+            gdict.dx, gdict.dy, inside=False)
+        gdict = gdict.getBoundsWithin(tempgdict)
+    return gdict
+
+
+def _getProfile(gdict):
+    """
+    Get the rasterio profile of baked GeoTIFF files covering gdict.
+    """
+    profile = {
+        'driver': 'GTiff',
+        'height': gdict.ny,
+        'width': gdict.nx,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': 'EPSG:4326',
+        'transform': from_origin(gdict.xmin - gdict.dx / 2.,
+                                 gdict.ymax + gdict.dy / 2.,
+                                 gdict.dx, gdict.dy),
+        'nodata': np.nan,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER'
+    }
+    if gdict.nx >= 256 and gdict.ny >= 256:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+    return profile
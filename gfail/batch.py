@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+This module runs several logistic models for the same event together. The
+models share their layer stores, so each distinct layer (ShakeMap or
+predictor) is stored once, and all models on the same grid are evaluated in
+a single sweep over the tiles of the grid with one fused kernel, which
+reads each layer once per tile and computes terms shared by several models
+(e.g., log(pgv)) only once.
+"""
+
+# stdlib imports
+import collections
+import shutil
+import threading
+
+# third party imports
+import numpy as np
+
+# local imports
+from gfail.logisticmodel import LogisticModel, runTiles
+from gfail.termcompiler import TermKernel
+
+
+class LogisticBatch(object):
+    def __init__(self, shakefile, configs, uncertfile=None, saveinputs=False,
+                 bounds=None, numstd=1, trimfile=None, store=None):
+        """
+        Sets up the logistic models.
+
+        Args:
+            shakefile (str): Path to shakemap grid.xml file for the event.
+            configs (list): List of configobj objects, each defining one
+                logistic model (funcname = LogisticModel).
+            uncertfile (str): Path to uncertainty.xml file.
+            saveinputs (bool): Save input layers as Grid2D objects in
+                addition to the models?
+            bounds (dict): Default of None uses ShakeMap boundaries, see
+                LogisticModel.
+            numstd (float): Number of +/- standard deviations to use if
+                uncertainty is computed.
+            trimfile (str): shapefile of earth's landmasses to use to cut
+                offshore areas.
+            store (str): Where to keep the resampled layers, see
+                LogisticModel.
+        """
+        self.stores = {}
+        self.models = collections.OrderedDict()
+        for conf in configs:
+            lm = LogisticModel(shakefile, conf, uncertfile=uncertfile,
+                               saveinputs=saveinputs, bounds=bounds,
+                               numstd=numstd, trimfile=trimfile, store=store,
+                               stores=self.stores)
+            self.models[lm.model] = lm
+
+    def getGroups(self):
+        """
+        Group the models by the grid they are computed on, models with
+        different base layers or divfactor end up in different groups.
+
+        Returns:
+            list: List of lists of model names.
+        """
+        groups = collections.OrderedDict()
+        for name, lm in self.models.items():
+            key = tuple(sorted(lm.getGeoDict().asDict().items()))
+            groups.setdefault(key, []).append(name)
+        return list(groups.values())
+
+    def calculate(self, cleanup=True, rowmax=300, colmax=None, nworkers=1,
+                  executor='thread', sparse=False, outfiles=None):
+        """
+        Calculate all models.
+
+        Args:
+            cleanup (bool): If True, delete temporary hdf5 files
+            rowmax (int): Number of rows to compute at once; If None, all rows
+                will be computed at once.
+            colmax (int): Number of columns to compute at once; If None, all
+                columns will be computed at once.
+            nworkers (int): Number of tiles to compute concurrently.
+            executor (str): Either 'thread' or 'process', see
+                LogisticModel.calculate.
+            sparse (bool): Only evaluate the cells needed by at least one
+                model, see LogisticModel.calculate.
+            outfiles (dict): Dictionary where keys are model names and values
+                are paths to hdf5 files the results of these models are
+                written to tile by tile, see LogisticModel.calculate.
+
+        Returns:
+            OrderedDict: Dictionary where keys are model names and values are
+            the dictionaries returned by LogisticModel.calculate (the path of
+            the output file for models in outfiles).
+        """
+        if outfiles is None:
+            outfiles = {}
+        results = collections.OrderedDict()
+        try:
+            for group in self.getGroups():
+                results.update(self._calculateGroup(
+                    group, rowmax, colmax, nworkers, executor, sparse,
+                    outfiles))
+        finally:
+            if cleanup:
+                for lm in self.models.values():
+                    shutil.rmtree(lm.tempdir, ignore_errors=True)
+        return collections.OrderedDict(
+            (name, results[name]) for name in self.models)
+
+    def _calculateGroup(self, group, rowmax, colmax, nworkers, executor,
+                        sparse=False, outfiles=None):
+        """
+        Evaluate the models of one group in a single sweep.
+        """
+        if outfiles is None:
+            outfiles = {}
+        models = [self.models[name] for name in group]
+
+        # Identify the layers of all models by their store, so a layer
+        # shared by several models is read once
+        storeids = {}
+        stores = {}
+        leafmaps = []
+        for lm in models:
+            leafmap = {}
+            for source, key, name in lm.kernel.getLeaves():
+                store = getattr(lm, source)[key]
+                if id(store) not in storeids:
+                    storeids[id(store)] = 's%d' % len(storeids)
+                    stores[storeids[id(store)]] = {key: store}
+                leafmap[(source, key, name)] = (storeids[id(store)], key, name)
+            leafmaps.append(leafmap)
+        kernel = TermKernel.combine([lm.kernel for lm in models], leafmaps)
+
+        geodict = models[0].getGeoDict()
+        tk = list(models[0].shakemap.keys())[0]
+        rowstarts, rowends, colstarts, colends = \
+            models[0].shakemap[tk].getSliceDiv(rowmax, colmax)
+        arrays = []
+        writers = []
+        for lm in models:
+            if lm.model in outfiles:
+                writers.append(lm.openWriter(outfiles[lm.model]))
+                arrays.append([None, None, None])
+                continue
+            writers.append(None)
+            X = np.empty([geodict.ny, geodict.nx])
+            if lm.uncert is not None:
+                arrays.append([X, np.empty_like(X), np.empty_like(X)])
+            else:
+                arrays.append([X, None, None])
+        lock = threading.RLock()
+
+        def fill(tile, results):
+            rowstart, rowend, colstart, colend = tile
+            for i, outputs in enumerate(arrays):
+                if writers[i] is not None:
+                    with lock:
+                        models[i].writeTile(writers[i], tile,
+                                            results[3 * i:3 * i + 3],
+                                            sparse=sparse)
+                    continue
+                for j, output in enumerate(outputs):
+                    if output is not None and results[3 * i + j] is not None:
+                        output[rowstart:rowend, colstart:colend] = \
+                            results[3 * i + j]
+
+        mask = None
+        if sparse:
+            # Cells needed by any of the models
+            for lm in models:
+                lmmask = lm.getEvaluationMask()
+                mask = lmmask if mask is None else mask | lmmask
+
+        tiles = list(zip(rowstarts, rowends, colstarts, colends))
+        try:
+            runTiles(tiles, kernel, stores, fill, nworkers=nworkers,
+                     executor=executor, mask=mask, lock=lock)
+            if mask is not None:
+                # Tiles skipped by runTiles still need their zeros
+                for tile in tiles:
+                    rowstart, rowend, colstart, colend = tile
+                    if not mask[rowstart:rowend, colstart:colend].any():
+                        fill(tile, [None] * (3 * len(models)))
+        finally:
+            for writer in writers:
+                if writer is not None:
+                    writer.close()
+
+        results = collections.OrderedDict()
+        for lm, (X, Xmin, Xmax), writer in zip(models, arrays, writers):
+            if writer is not None:
+                results[lm.model] = writer.filename
+            else:
+                results[lm.model] = lm.finalize(X, Xmin, Xmax, cleanup=False,
+                                                sparse=sparse)
+        return results
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Catalog of the input rasters of the models.
+
+Every run probes the same predictor files: getFileType opens each layer
+file when the config is validated, LogisticModel and quickcut read the
+header of each file to get its geodictionary, and directories of monthly
+files are listed and scanned for the month of the event. A LayerCatalog
+probes each file once and keeps what it found (file type, georeference,
+data type, block size, nodata value) keyed by the absolute path of the
+file, together with the grid files of directories and the mapping of
+multi-file layers to their time values. Entries are checked against the
+modification time and size of the file, and can be saved in a directory
+so later runs do not probe the files again.
+"""
+
+# stdlib imports
+import os
+import json
+import threading
+from collections import OrderedDict
+
+# third party imports
+import rasterio
+from mapio.gmt import GMTGrid
+from mapio.gdal import GDALGrid
+from mapio.geodict import GeoDict
+
+#: Readers of georeference, in the order quickcut tries them
+READERS = ['gdal', 'gmt']
+
+#: Version of the entries saved on disk
+VERSION = 1
+
+
+class LayerCatalog(object):
+    def __init__(self, cachedir=None):
+        """
+        Catalog of raster files.
+
+        Args:
+            cachedir (str): Directory where the catalog is saved so it can be
+                reused by later runs, None to only keep it in memory.
+        """
+        self.cachedir = cachedir
+        self.entries = {}
+        self.timefiles = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if cachedir is not None:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            self._load()
+
+    def getEntry(self, filename):
+        """
+        Get the catalog entry of a file or directory, probing it if it is
+        not in the catalog or changed since it was probed.
+
+        Args:
+            filename (str): Path to a raster file or a directory.
+
+        Returns:
+            dict: Entry with keys 'ftype' ('gmt', 'esri', 'dir' or
+            'unknown') and, for 'esri' files, 'dtype', 'blocksize' and
+            'nodata', for directories 'files', the names of the grid files
+            in the directory.
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = [stat.st_mtime, stat.st_size]
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry['key'] == key:
+                self.hits += 1
+                return entry
+        self.misses += 1
+        entry = {'key': key, 'geodicts': {}}
+        if os.path.isdir(path):
+            entry['ftype'] = 'dir'
+            entry['files'] = [
+                tf for tf in os.listdir(path)
+                if self.getFileType(os.path.join(path, tf))
+                in ['gmt', 'esri']]
+        else:
+            entry.update(_probe(path))
+        with self.lock:
+            self.entries[path] = entry
+            self._save()
+        return entry
+
+    def getFileType(self, filename):
+        """
+        Determine whether input file is a grid (ESRI or GMT) or a directory,
+        as gfail.logisticmodel.getFileType.
+
+        Args:
+            filename (str): Path to candidate filename.
+
+        Returns:
+            str: 'gmt', 'esri', 'dir' or 'unknown'.
+        """
+        return self.getEntry(filename)['ftype']
+
+    def getGridFiles(self, indir):
+        """
+        Get list of all gmt or esri files in a directory.
+
+        Args:
+            indir (str): Directory to search.
+
+        Returns:
+            list: List of file names.
+        """
+        return [os.path.join(indir, tf)
+                for tf in self.getEntry(indir)['files']]
+
+    def getGeoDict(self, filename, reader=None):
+        """
+        Get the geodictionary of a grid file without reading its header
+        again.
+
+        Args:
+            filename (str): Path to a grid file.
+            reader (str): 'gdal' to read it as GDALGrid.getFileGeoDict does,
+                'gmt' as GMTGrid.getFileGeoDict does, None to try them in
+                the order of READERS as quickcut does.
+
+        Returns:
+            tuple: (GeoDict, first_column_duplicated) as returned by
+            getFileGeoDict.
+
+        Raises:
+            Exception: When the geodictionary can't be read.
+        """
+        entry = self.getEntry(filename)
+        readers = READERS if reader is None else [reader]
+        for name in readers:
+            with self.lock:
+                found = name in entry['geodicts']
+                value = entry['geodicts'].get(name)
+            if not found:
+                value = _readGeoDict(filename, name)
+                with self.lock:
+                    entry['geodicts'][name] = value
+                    self._save()
+            if value is not None:
+                return (GeoDict(value[0]), value[1])
+        raise Exception('Cannot get geodict for %s' % filename)
+
+    def getTimeFiles(self, files, values):
+        """
+        Map the files of a multi-file layer to time values, e.g. monthly
+        files to the names of the months. Each value gets the last file
+        whose name contains it.
+
+        Args:
+            files (list): List of file names.
+            values (list): Time values, e.g. MONTHS.
+
+        Returns:
+            OrderedDict: Dictionary where keys are the values found in the
+            file names and values are file names.
+        """
+        key = (tuple(files), tuple(values))
+        with self.lock:
+            timefiles = self.timefiles.get(key)
+        if timefiles is None:
+            timefiles = OrderedDict()
+            for value in values:
+                for lfile in files:
+                    if lfile.find(value) > -1:
+                        timefiles[value] = lfile
+            with self.lock:
+                self.timefiles[key] = timefiles
+        return timefiles
+
+    def clear(self):
+        """
+        Forget all entries, the catalog saved on disk is kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.timefiles.clear()
+
+    def _load(self):
+        """
+        Read the catalog saved in cachedir, if any.
+        """
+        try:
+            with open(os.path.join(self.cachedir, 'catalog.json'), 'r') as f:
+                catalog = json.load(f)
+            if catalog['version'] == VERSION:
+                self.entries.update(catalog['entries'])
+        except Exception:
+            pass
+
+    def _save(self):
+        """
+        Save the catalog in cachedir.
+        """
+        if self.cachedir is None:
+            return
+        catfile = os.path.join(self.cachedir, 'catalog.json')
+        temp = '%s.%d.tmp' % (catfile, os.getpid())
+        try:
+            # Written under a temporary name first so that other runs never
+            # read a partial file
+            with open(temp, 'w') as f:
+                json.dump({'version': VERSION, 'entries': self.entries}, f)
+            os.replace(temp, catfile)
+        except Exception as e:
+            print('Could not save layer catalog: %s' % e)
+
+
+def _probe(filename):
+    """
+    Find the type of a file and, for ESRI files, the properties of its
+    first band.
+    """
+    if GMTGrid.getFileType(filename) != 'unknown':
+        return {'ftype': 'gmt'}
+    # Skip over ESRI header files
+    if filename.endswith('.hdr'):
+        return {'ftype': 'unknown'}
+    try:
+        with rasterio.open(filename) as src:
+            props = {'ftype': 'esri', 'dtype': src.dtypes[0],
+                     'blocksize': list(src.block_shapes[0]),
+                     'nodata': src.nodata}
+    except Exception:
+        return {'ftype': 'unknown'}
+    try:
+        gdict, firstcol = GDALGrid.getFileGeoDict(filename)
+    except Exception:
+        return {'ftype': 'unknown'}
+    props['geodicts'] = {'gdal': [_asDict(gdict), bool(firstcol)]}
+    return props
+
+
+def _readGeoDict(filename, reader):
+    """
+    Read the geodictionary of a file with one of READERS, or return None
+    if it can't.
+    """
+    try:
+        if reader == 'gdal':
+            gdict, firstcol = GDALGrid.getFileGeoDict(filename)
+        else:
+            gdict, firstcol = GMTGrid.getFileGeoDict(filename)
+    except Exception:
+        return None
+    return [_asDict(gdict), bool(firstcol)]
+
+
+def _asDict(gdict):
+    """
+    Geodictionary as a plain dictionary.
+    """
+    return {'xmin': gdict.xmin, 'xmax': gdict.xmax, 'ymin': gdict.ymin,
+            'ymax': gdict.ymax, 'dx': gdict.dx, 'dy': gdict.dy,
+            'nx': gdict.nx, 'ny': gdict.ny}
+
+
+_CATALOG = [LayerCatalog()]
+
+
+def getCatalog():
+    """
+    Return the layer catalog used by the models of this process.
+    """
+    return _CATALOG[0]
+
+
+def setCatalog(cachedir=None):
+    """
+    Replace the layer catalog used by the models of this process, see
+    LayerCatalog for the arguments.
+
+    Returns:
+        LayerCatalog: The new catalog.
+    """
+    _CATALOG[0] = LayerCatalog(cachedir=cachedir)
+    return _CATALOG[0]
@@ -9,19 +9,22 @@ import re
 from argparse import Namespace
 
 # local imports
-from mapio.shake import getHeaderData
 from mapio.gdal import GDALGrid
 from impactutils.io.cmd import get_command_output
-from mapio.shake import ShakeGrid
 from gfail.conf import correct_config_filepaths
+from gfail.shakecache import getShakeHeader, loadShakeGrid
+from gfail.layercache import setLayerCache
+from gfail.landmask import setLandMask
+from gfail.catalog import setCatalog
 import gfail.logisticmodel as LM
+from gfail.batch import LogisticBatch
 from gfail.godt import godt2008
 from gfail.makemaps import (modelMap, interactiveMap, GFSummary)
 from gfail.webpage import hazdev
 from gfail.utilities import (
     get_event_comcat, parseConfigLayers,
     parseMapConfig, text_to_json, write_floats,
-    savelayers)
+    savelayers, loadlayers)
 
 
 def run_gfail(args):
@@ -41,6 +44,18 @@ def run_gfail(args):
     if isinstance(args, dict):
         args = Namespace(**args)
 
+    # Newer options, with the defaults of bin/gfail so callers that do not
+    # set them still work
+    nworkers = getattr(args, 'nworkers', 1)
+    executor = getattr(args, 'executor', 'thread')
+    store = getattr(args, 'store', None)
+    cache_dir = getattr(args, 'cache_dir', None)
+    cache_memory = getattr(args, 'cache_memory', 0.)
+    land_pyramid = getattr(args, 'land_pyramid', None)
+    sparse = getattr(args, 'sparse', False)
+    stream = getattr(args, 'stream', False)
+    stats_proj = getattr(args, 'stats_proj', 'ellipsoid')
+
     if args.set_default_paths:
         set_default_paths(args)
         print('default paths set, continuing...\n')
@@ -53,6 +68,15 @@ def run_gfail(args):
         reset_default_paths()
         return
 
+    if cache_dir is not None or cache_memory:
+        setLayerCache(maxbytes=cache_memory * 1e6, cachedir=cache_dir)
+    if cache_dir is not None:
+        setCatalog(cachedir=os.path.join(cache_dir, 'catalog'))
+    if cache_dir is not None or land_pyramid is not None:
+        setLandMask(cachedir=None if cache_dir is None else
+                    os.path.join(cache_dir, 'landmask'),
+                    pyramid=land_pyramid)
+
     if args.make_webpage:
         # Turn on GIS and HDF5 flags
         gis = True
@@ -88,7 +112,7 @@ def run_gfail(args):
             else:
                 raise NameError('Could not find "%s" as a file or a valid url'
                                 % (shakefile))
-        eventid = getHeaderData(shakefile)[0]['event_id']
+        eventid = getShakeHeader(shakefile)[0]['event_id']
 
         # Get entire path so won't break if running gfail with relative path
         shakefile = os.path.abspath(shakefile)
@@ -257,27 +281,71 @@ def run_gfail(args):
                 ffault = None
                 point = False
 
+        # Evaluate all logistic models together in a single sweep, sharing
+        # their input layers
+        logconfs = [conf for conf in configs
+                    if conf[conf.keys()[0]]['funcname'] == 'LogisticModel']
+        # Write hdf5 results tile by tile instead of keeping them in memory
+        stream = hdf5 and stream
+        outfiles = {}
+        for conf in configs:
+            modelname = conf.keys()[0]
+            if args.appendname is not None:
+                filename = ('%s_%s_%s' % (eventid, modelname, args.appendname))
+            else:
+                filename = ('%s_%s' % (eventid, modelname))
+            outfiles[modelname] = os.path.join(outfolder, filename + '.hdf5')
+            if stream and os.path.exists(outfiles[modelname]):
+                os.remove(outfiles[modelname])
+        batchlayers = {}
+        if len(logconfs) > 1:
+            print('\nNow running %s together:'
+                  % ', '.join([conf.keys()[0] for conf in logconfs]))
+            batch = LogisticBatch(shakefile, logconfs,
+                                  uncertfile=args.uncertfile,
+                                  saveinputs=args.save_inputs,
+                                  bounds=bounds,
+                                  numstd=float(args.std),
+                                  trimfile=trimfile,
+                                  store=store)
+            batchlayers = batch.calculate(nworkers=nworkers,
+                                          executor=executor,
+                                          sparse=sparse,
+                                          outfiles=outfiles if stream
+                                          else None)
+            del(batch)
+
         # Loop over config files
         for conf in configs:
             modelname = conf.keys()[0]
             print('\nNow running %s:' % modelname)
             modelfunc = conf[modelname]['funcname']
-            if modelfunc == 'LogisticModel':
+            if modelname in batchlayers:
+                maplayers = batchlayers.pop(modelname)
+            elif modelfunc == 'LogisticModel':
                 lm = LM.LogisticModel(shakefile, conf,
                                       uncertfile=args.uncertfile,
                                       saveinputs=args.save_inputs,
                                       bounds=bounds,
                                       numstd=float(args.std),
-                                      trimfile=trimfile)
-
-                maplayers = lm.calculate()
+                                      trimfile=trimfile,
+                                      store=store)
+
+                maplayers = lm.calculate(nworkers=nworkers,
+                                         executor=executor,
+                                         sparse=sparse,
+                                         outfile=outfiles[modelname] if stream
+                                         else None)
             elif modelfunc == 'godt2008':
                 maplayers = godt2008(shakefile, conf,
                                      uncertfile=args.uncertfile,
                                      saveinputs=args.save_inputs,
                                      bounds=bounds,
                                      numstd=float(args.std),
-                                     trimfile=trimfile)
+                                     trimfile=trimfile,
+                                     rowmax=300,
+                                     nworkers=nworkers,
+                                     executor=executor)
             else:
                 print('Unknown model function specified in config for %s '
                       'model, skipping to next config' % modelfunc)
@@ -290,7 +358,15 @@ def run_gfail(args):
                 filename = ('%s_%s_%s' % (eventid, modelname, args.appendname))
             else:
                 filename = ('%s_%s' % (eventid, modelname))
-            if hdf5:
+            if isinstance(maplayers, str):
+                # Results were already written by the model
+                filenames.append(os.path.basename(maplayers))
+                if not (args.make_static_pdfs or args.make_static_pngs or
+                        args.make_interactive_plots or gis or
+                        args.make_webpage or args.make_summary):
+                    continue
+                maplayers = loadlayers(maplayers)
+            elif hdf5:
                 filenameh = filename + '.hdf5'
                 if os.path.exists(filenameh):
                     os.remove(filenameh)
@@ -410,14 +486,16 @@ def run_gfail(args):
                 results, configs,
                 shakefile, outfolder=outfolder,
                 pop_file=args.popfile,
-                pager_alert=args.property_alertlevel)
+                pager_alert=args.property_alertlevel,
+                proj=stats_proj)
             filenames = filenames + outputs
 
         if args.make_summary:
             outputs = GFSummary(
                 results, configs, args.web_template,
                 shakefile, outfolder=outfolder, cleanup=True,
-                faultfile=ffault, point=point, pop_file=args.popfile)
+                faultfile=ffault, point=point, pop_file=args.popfile,
+                proj=stats_proj)
             filenames = filenames + outputs
 
 #        # create transparent png file
@@ -663,7 +741,7 @@ def get_bounds(shakefile, parameter='pga', threshold=2.0):
         dict: A dictionary with keys 'xmin', 'xmax', 'ymin', and 'ymax' that
         defines the boundaries in geographic coordinates.
     """
-    shakemap = ShakeGrid.load(shakefile, adjust='res')
+    shakemap = loadShakeGrid(shakefile, adjust='res')
     if parameter == 'pga':
         vals = shakemap.getLayer('pga')
     elif parameter == 'pgv':
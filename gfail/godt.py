@@ -6,24 +6,49 @@ mechanistic landslide models.
 
 # stdlib imports
 import os.path
+import json
+import hashlib
 #import warnings
 import collections
-import tempfile
-import shutil
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 # local imports
-from mapio.shake import ShakeGrid
 from mapio.gdal import GDALGrid
 from mapio.geodict import GeoDict
-from gfail.spatial import quickcut, trim_ocean
+from gfail.spatial import trim_ocean, getTileGeoDict
+from gfail.layercache import getLayerCache
+from gfail.catalog import getCatalog
+from gfail.polygonstore import getFileKey
+from gfail.shakecache import getShakeGeoDict, loadShakeGrid, getShakeLayer
 
 # third party imports
 import numpy as np
 
 
+#: Slope quantile files, from the minimum to the maximum slope of each cell
+QUANTILES = ['slope_min.bil', 'slope10.bil', 'slope30.bil', 'slope50.bil',
+             'slope70.bil', 'slope90.bil', 'slope_max.bil']
+
+#: Proportion of area affected given the number of slope quantiles where
+#: the Newmark displacement exceeds the threshold
+QUANTILE_PROBS = np.array([0., 0.01, 0.10, 0.30, 0.50, 0.70, 0.90, 0.99])
+
+#: Newmark displacement models, see NMdisp
+DISPL_MODELS = ['J_PGA', 'J_PGA_M', 'RS_PGA_M', 'RS_PGA_PGV', 'BT_PGA_M']
+
+#: Parameters of the model the baked critical accelerations depend on
+BAKE_PARAMS = ['thick', 'uwt', 'fsthresh', 'acthresh', 'slopediv', 'codiv',
+               'nodata_cohesion', 'nodata_friction']
+
+# Inputs of _computeBlock in worker processes, set by _initWorker
+_WORKER = {}
+
+
 def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
              displmodel=None, bounds=None, slopediv=100.,
-             codiv=10., numstd=None, trimfile=None):
+             codiv=10., numstd=None, trimfile=None, rowmax=None,
+             nworkers=1, executor='thread', fastcount=None):
     """
     This function runs the Godt and others (2008) global method for a given
     ShakeMap. The Factor of Safety is calculated using infinite slope analysis
@@ -34,7 +59,10 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
     Args:
         shakefile (str): Path to shakemap xml file.
         config (ConfigObj): ConfigObj of config file containing inputs required
-            for running the model
+            for running the model. If the godt_2008 section has a bakefile
+            made by gfail_bake (see :func:`gfail.bake.bakeGodt`), the
+            precomputed critical accelerations are read instead of being
+            computed from the slope, cohesion and friction layers.
         uncertfile (str): Path to shakemap uncertainty xml file (optional).
         saveinputs (bool): Whether or not to return the model input layers,
             False (default) returns only the model output (one layer).
@@ -48,6 +76,10 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
               Saygili (2009).
             * ``'RS_PGA_PGV'`` -- PGA and PGV-based model, equation 6
               from Saygili and Rathje (2008).
+            * ``'BT_PGA_M'`` -- PGA and M-based model from Bray and
+              Travasarou (2007).
+            * ``'all'`` -- Average displacement of all the above models,
+              computed in one pass (see NMdispEnsemble).
 
         bounds (dict): Optional dictionary with keys 'xmin', 'xmax', 'ymin', 'ymax'
             that defines a subset of the shakemap area to compute.
@@ -60,6 +92,21 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
             is computed (uncertfile must be supplied).
         trimfile (str): shapefile of earth's land masses to trim offshore areas
             of model
+        rowmax (int): Number of rows to compute at once, each block of rows
+            only reads its part of the input layers; If None, all rows
+            will be computed at once.
+        nworkers (int): Number of blocks of rows to compute concurrently; If
+            1, blocks are computed one after the other.
+        executor (str): Either 'thread' or 'process', the type of pool used
+            to compute blocks concurrently (see LogisticModel.calculate).
+            Only used if nworkers > 1.
+        fastcount (bool): If True, count the slope quantiles exceeding
+            dnthresh by comparing the critical accelerations to the range
+            given by NMcritical, computed once per cell, instead of
+            computing the Newmark displacement of each quantile. Results
+            only differ for displacements within rounding of dnthresh. If
+            None, uses the fastcount parameter of the config (default
+            False).
 
     Returns:
         dict: Dictionary containing output and input layers (if
@@ -88,9 +135,8 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
 
     """
     #TODO:
-    #    - Add 'all' -- averages Dn from all four equations, add term to
-    #      convert PGA and PGV to Ia and use other equations, add Ambraseys and
-    #      Menu (1988) option.
+    #    - Add term to convert PGA and PGV to Ia and use other equations, add
+    #      Ambraseys and Menu (1988) option.
 
     # Empty refs
     slopesref = 'unknown'
@@ -147,6 +193,36 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
             print('No regression model specified, using default of J_PGA_M')
             displmodel = 'J_PGA_M'
 
+    if fastcount is None:
+        fastcount = config['godt_2008']['parameters'].as_bool('fastcount') \
+            if 'fastcount' in config['godt_2008']['parameters'] else False
+    if displmodel != 'all' and displmodel not in DISPL_MODELS:
+        raise NameError('Unknown displmodel %s' % displmodel)
+    usepgv = displmodel == 'all' or 'PGV' in displmodel
+    if fastcount and displmodel == 'all':
+        print('Critical accelerations cannot be computed for the average of '
+              'all displacement models, computing Newmark displacements '
+              'instead')
+        fastcount = False
+    if fastcount and dnthresh <= 0.:
+        print('dnthresh must be positive to count exceedances from critical '
+              'accelerations, computing Newmark displacements instead')
+        fastcount = False
+
+    # Use the critical accelerations precomputed by gfail_bake, if available
+    baked = None
+    if 'bakefile' in config['godt_2008']:
+        if saveinputs:
+            print('Input layers requested, not using baked grids')
+        else:
+            baked = readGodtBake(
+                config['godt_2008']['bakefile'],
+                getGodtBakeHash(slopefilepath, cohesionfile, frictionfile, {
+                    'thick': thick, 'uwt': uwt, 'fsthresh': fsthresh,
+                    'acthresh': acthresh, 'slopediv': slopediv,
+                    'codiv': codiv, 'nodata_cohesion': nodata_cohesion,
+                    'nodata_friction': nodata_friction}))
+
     # TO DO: ADD ERROR CATCHING ON UNITS, MAKE SURE THEY ARE WHAT THEY SHOULD
     #        BE FOR THIS MODEL
 
@@ -164,7 +240,7 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
               'Continuing')
 
     # Figure out how/if need to cut anything
-    geodict = ShakeGrid.getFileGeoDict(shakefile)  # , adjust='res')
+    geodict = getShakeGeoDict(shakefile)  # , adjust='res')
     if bounds is not None:  # Make sure bounds are within ShakeMap Grid
         if (geodict.xmin > bounds['xmin'] or
                 geodict.xmax < bounds['xmax'] or
@@ -180,8 +256,8 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
             geodict.dx, geodict.dy, inside=False)
         geodict = geodict.getBoundsWithin(tempgdict)
 
-    basegeodict, firstcol = GDALGrid.getFileGeoDict(
-        os.path.join(slopefilepath, 'slope_min.bil'))
+    basegeodict, firstcol = getCatalog().getGeoDict(
+        os.path.join(slopefilepath, 'slope_min.bil'), 'gdal')
     if basegeodict == geodict:
         sampledict = geodict
     else:
@@ -208,17 +284,17 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                 newxmin, newxmax, newymin,
                 newymax, newdx, newdy, inside=True)
 
-    tmpdir = tempfile.mkdtemp()
+    if baked is not None:
+        bakedict, firstcol = getCatalog().getGeoDict(baked['maxslope'],
+                                                     'gdal')
+        if not bakedict.contains(sampledict):
+            print('Baked grids do not cover the model area, not using them')
+            baked = None
 
     # Load in ShakeMap and get new geodictionary
-    temp = ShakeGrid.load(shakefile)  # , adjust='res')
-    junkfile = os.path.join(tmpdir, 'temp.bil')
-    GDALGrid.copyFromGrid(temp.getLayer('pga')).save(junkfile)
-    pga = quickcut(junkfile, sampledict, precise=True, method='bilinear')
-    os.remove(junkfile)
-    GDALGrid.copyFromGrid(temp.getLayer('pgv')).save(junkfile)
-    pgv = quickcut(junkfile, sampledict, precise=True, method='bilinear')
-    os.remove(junkfile)
+    temp = loadShakeGrid(shakefile)  # , adjust='res')
+    pga = getShakeLayer(shakefile, 'pga', sampledict, method='bilinear')
+    pgv = getShakeLayer(shakefile, 'pgv', sampledict, method='bilinear')
     # Update geodictionary
     sampledict = pga.getGeoDict()
 
@@ -231,146 +307,122 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
     # read in uncertainty if present
     if uncertfile is not None:
         try:
-            temp = ShakeGrid.load(uncertfile)  # , adjust='res')
-            GDALGrid.copyFromGrid(temp.getLayer('stdpga')).save(junkfile)
-            uncertpga = quickcut(junkfile, sampledict,
-                                 precise=True, method='bilinear')
-            os.remove(junkfile)
-            GDALGrid.copyFromGrid(temp.getLayer('stdpgv')).save(junkfile)
-            uncertpgv = quickcut(junkfile, sampledict,
-                                 precise=True, method='bilinear')
-            os.remove(junkfile)
+            uncertpga = getShakeLayer(uncertfile, 'stdpga', sampledict,
+                                      method='bilinear')
+            uncertpgv = getShakeLayer(uncertfile, 'stdpgv', sampledict,
+                                      method='bilinear')
         except:
             print('Could not read uncertainty file, ignoring uncertainties')
             uncertfile = None
         if numstd is None:
             numstd = 1.
 
-    # Read in all the slope files, divide all by 100 to get to slope in
-    # degrees (because input files are multiplied by 100.)
-    slopes = []
-    quantiles = ['slope_min.bil', 'slope10.bil', 'slope30.bil', 'slope50.bil',
-                 'slope70.bil', 'slope90.bil', 'slope_max.bil']
-    for quant in quantiles:
-        tmpslp = quickcut(os.path.join(slopefilepath, quant), sampledict)
-        tgd = tmpslp.getGeoDict()
-        if tgd != sampledict:
-            raise Exception('Input layers are not aligned to same geodict')
-        else:
-            slopes.append(tmpslp.getData()/slopediv)
-
-    slopestack = np.dstack(slopes)
-
-    # Change any zero slopes to a very small number to avoid dividing by
-    # zero later
-    slopestack[slopestack == 0] = 1e-8
-
-    # Read in the cohesion and friction files and duplicate layers so they
-    # are same shape as slope structure
-
-    tempco = quickcut(cohesionfile, sampledict, method='near')
-    tempco = tempco.getData()[:, :, np.newaxis]/codiv
-    cohesion = np.repeat(tempco, 7, axis=2)
-    cohesion[cohesion == -999.9] = nodata_cohesion
-    cohesion = np.nan_to_num(cohesion)
-    cohesion[cohesion == 0] = nodata_cohesion
-
-    tempfric = quickcut(frictionfile, sampledict, method='near')
-    tempfric = tempfric.getData().astype(float)[:, :, np.newaxis]
-    friction = np.repeat(tempfric, 7, axis=2)
-    friction[friction == -9999] = nodata_friction
-    friction = np.nan_to_num(friction)
-    friction[friction == 0] = nodata_friction
-
-    # Do the calculations using Jibson (2007) PGA only model for Dn
-    FS = (cohesion/(uwt*thick*np.sin(slopestack*(np.pi/180.))) +
-          np.tan(friction*(np.pi/180.))/np.tan(slopestack*(np.pi/180.)))
-    FS[FS < fsthresh] = fsthresh
-
-    # Compute critical acceleration, in g
-    # This gives ac in g, equations that multiply by g give ac in m/s2
-    Ac = (FS-1)*np.sin(slopestack*(np.pi/180.)).astype(float)
-    Ac[Ac < acthresh] = acthresh
-
     # Get PGA in g (PGA is %g in ShakeMap, convert to g)
-    PGA = np.repeat(pga.getData()[:, :, np.newaxis]/100., 7,
-                    axis=2).astype(float)
-    if 'PGV' in displmodel:  # Load in PGV also, in cm/sec
-        PGV = np.repeat(pgv.getData()[:, :, np.newaxis], 7,
-                        axis=2).astype(float)
+    PGA = (pga.getData()/100.).astype(float)
+    if usepgv:  # Load in PGV also, in cm/sec
+        PGV = pgv.getData().astype(float)
     else:
         PGV = None
+    PGAmin = PGAmax = PGVmin = PGVmax = None
 
     if uncertfile is not None:
-        stdpga = np.repeat(uncertpga.getData()[:, :, np.newaxis], 7,
-                           axis=2).astype(float)
-        stdpgv = np.repeat(uncertpgv.getData()[:, :, np.newaxis], 7,
-                           axis=2).astype(float)
+        stdpga = uncertpga.getData().astype(float)
+        stdpgv = uncertpgv.getData().astype(float)
         # estimate PGA +- 1std
         PGAmin = np.exp(np.log(PGA*100) - numstd*stdpga)/100
         PGAmax = np.exp(np.log(PGA*100) + numstd*stdpga)/100
-        if 'PGV' in displmodel:
+        if usepgv:
             PGVmin = np.exp(np.log(PGV) - numstd*stdpgv)
             PGVmax = np.exp(np.log(PGV) + numstd*stdpgv)
-        else:
-            PGVmin = None
-            PGVmax = None
 
-    # Ignore errors so still runs when Ac > PGA, just leaves nan instead
-    # of crashing.
-    np.seterr(invalid='ignore')
+    # Everything a block of rows needs to be computed on its own
+    params = {
+        'sampledict': sampledict,
+        'slopefilepath': slopefilepath,
+        'slopediv': slopediv,
+        'cohesionfile': cohesionfile,
+        'codiv': codiv,
+        'nodata_cohesion': nodata_cohesion,
+        'frictionfile': frictionfile,
+        'nodata_friction': nodata_friction,
+        'thick': thick,
+        'uwt': uwt,
+        'dnthresh': dnthresh,
+        'fsthresh': fsthresh,
+        'acthresh': acthresh,
+        'displmodel': displmodel,
+        'M': M,
+        'saveinputs': saveinputs,
+        'fastcount': fastcount,
+        'baked': baked,
+        'PGA': PGA,
+        'PGV': PGV,
+        'PGAmin': PGAmin,
+        'PGAmax': PGAmax,
+        'PGVmin': PGVmin,
+        'PGVmax': PGVmax
+    }
 
-    Dn, logDnstd, logtype = NMdisp(Ac, PGA, model=displmodel, M=M, PGV=PGV)
-    if uncertfile is not None:
-        Dnmin, logDnstdmin, logtype = NMdisp(
-            Ac, PGAmin, model=displmodel, M=M, PGV=PGVmin)
-        Dnmax, logDnstdmax, logtype = NMdisp(
-            Ac, PGAmax, model=displmodel, M=M, PGV=PGVmax)
-
-    PROB = Dn.copy()
-    PROB[PROB < dnthresh] = 0.
-    PROB[PROB >= dnthresh] = 1.
-    PROB = np.sum(PROB, axis=2)
-    if uncertfile is not None:
-        PROBmin = Dnmin.copy()
-        PROBmin[PROBmin <= dnthresh] = 0.
-        PROBmin[PROBmin > dnthresh] = 1.
-        PROBmin = np.sum(PROBmin, axis=2)
-        PROBmax = Dnmax.copy()
-        PROBmax[PROBmax <= dnthresh] = 0.
-        PROBmax[PROBmax > dnthresh] = 1.
-        PROBmax = np.sum(PROBmax, axis=2)
-
-    PROB[PROB == 1.] = 0.01
-    PROB[PROB == 2.] = 0.10
-    PROB[PROB == 3.] = 0.30
-    PROB[PROB == 4.] = 0.50
-    PROB[PROB == 5.] = 0.70
-    PROB[PROB == 6.] = 0.90
-    PROB[PROB == 7.] = 0.99
+    # Compute blocks of rows, each reading only its window of the slope,
+    # cohesion and friction files, and assemble the results
+    if rowmax is None or rowmax > sampledict.ny:
+        rowmax = sampledict.ny
+    blocks = [(rowstart, min(rowstart + rowmax, sampledict.ny))
+              for rowstart in range(0, sampledict.ny, rowmax)]
+    results = {}
+
+    def fill(block, blockresults):
+        rowstart, rowend = block
+        for name, data in blockresults.items():
+            if name not in results:
+                results[name] = np.empty((sampledict.ny, sampledict.nx),
+                                         dtype=data.dtype)
+            results[name][rowstart:rowend] = data
+
+    if nworkers is None or nworkers < 2 or len(blocks) < 2:
+        for block in blocks:
+            fill(*_computeBlock(block, params))
+    elif executor == 'thread':
+        pool = ThreadPool(min(nworkers, len(blocks)))
+        try:
+            for block, blockresults in pool.imap_unordered(
+                    lambda block: _computeBlock(block, params), blocks):
+                fill(block, blockresults)
+        finally:
+            pool.close()
+            pool.join()
+    elif executor == 'process':
+        pool = multiprocessing.Pool(min(nworkers, len(blocks)),
+                                    initializer=_initWorker,
+                                    initargs=(params,))
+        try:
+            for block, blockresults in pool.imap_unordered(_computeBlock,
+                                                           blocks):
+                fill(block, blockresults)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        raise Exception("executor must be one of ['thread', 'process']")
 
+    # Convert the number of quantiles exceeding dnthresh to the proportion
+    # of area affected
+    maxslope = results['maxslope']
+    PROB = QUANTILE_PROBS[results.pop('count')]
     if uncertfile is not None:
-        PROBmin[PROBmin == 1.] = 0.01
-        PROBmin[PROBmin == 2.] = 0.10
-        PROBmin[PROBmin == 3.] = 0.30
-        PROBmin[PROBmin == 4.] = 0.50
-        PROBmin[PROBmin == 5.] = 0.70
-        PROBmin[PROBmin == 6.] = 0.90
-        PROBmin[PROBmin == 7.] = 0.99
-        PROBmax[PROBmax == 1.] = 0.01
-        PROBmax[PROBmax == 2.] = 0.10
-        PROBmax[PROBmax == 3.] = 0.30
-        PROBmax[PROBmax == 4.] = 0.50
-        PROBmax[PROBmax == 5.] = 0.70
-        PROBmax[PROBmax == 6.] = 0.90
-        PROBmax[PROBmax == 7.] = 0.99
+        PROBmin = QUANTILE_PROBS[results.pop('countmin')]
+        PROBmax = QUANTILE_PROBS[results.pop('countmax')]
+    if saveinputs is True:
+        minFS = results['minFS']
+        cohesion = results['cohesion']
+        friction = results['friction']
 
     if slopemin is not None:
-        PROB[slopestack[:, :, 6] <= slopemin] = 0.
+        PROB[maxslope <= slopemin] = 0.
         # uncert too
         if uncertfile is not None:
-            PROBmin[slopestack[:, :, 6] <= slopemin] = 0.
-            PROBmax[slopestack[:, :, 6] <= slopemin] = 0.
+            PROBmin[maxslope <= slopemin] = 0.
+            PROBmax[maxslope <= slopemin] = 0.
 
     # Turn output and inputs into into grids and put in mapLayers dictionary
     maplayers = collections.OrderedDict()
@@ -396,7 +448,8 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
     }
     PROBgrid = GDALGrid(PROB, sampledict)
     if trimfile is not None:
-        PROBgrid = trim_ocean(PROBgrid, trimfile, nodata=float('nan'))
+        PROBgrid = trim_ocean(PROBgrid, trimfile, nodata=float('nan'),
+                              inplace=True)
 
     maplayers['model'] = {
         'grid': PROBgrid,
@@ -410,9 +463,9 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
         PROBmaxgrid = GDALGrid(PROBmax, sampledict)
         if trimfile is not None:
             PROBmingrid = trim_ocean(
-                PROBmingrid, trimfile, nodata=float('nan'))
+                PROBmingrid, trimfile, nodata=float('nan'), inplace=True)
             PROBmaxgrid = trim_ocean(
-                PROBmaxgrid, trimfile, nodata=float('nan'))
+                PROBmaxgrid, trimfile, nodata=float('nan'), inplace=True)
         maplayers['modelmin'] = {
             'grid': PROBmingrid,
             'label': 'Probability-%1.2fstd' % numstd,
@@ -428,16 +481,16 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
 
     if saveinputs is True:
         maplayers['pga'] = {
-            'grid': GDALGrid(PGA[:, :, 0], sampledict),
+            'grid': GDALGrid(PGA, sampledict),
             'label': 'PGA (g)',
             'type': 'input',
             'description': {
                 'units': 'g',
                 'shakemap': shakedetail}
         }
-        if 'PGV' in displmodel:
+        if usepgv:
             maplayers['pgv'] = {
-                'grid': GDALGrid(PGV[:, :, 0], sampledict),
+                'grid': GDALGrid(PGV, sampledict),
                 'label': 'PGV (cm/s)',
                 'type': 'input',
                 'description': {
@@ -445,14 +498,14 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                     'shakemap': shakedetail}
             }
         maplayers['minFS'] = {
-            'grid': GDALGrid(np.min(FS, axis=2), sampledict),
+            'grid': GDALGrid(minFS, sampledict),
             'label': 'Min Factor of Safety',
             'type': 'input',
             'description': {
                 'units': 'unitless'}
         }
         maplayers['max slope'] = {
-            'grid': GDALGrid(slopestack[:, :, -1], sampledict),
+            'grid': GDALGrid(maxslope, sampledict),
             'label': 'Maximum slope ($^\circ$)',
             'type': 'input',
             'description': {
@@ -461,7 +514,7 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                 'longref': slopelref}
         }
         maplayers['cohesion'] = {
-            'grid': GDALGrid(cohesion[:, :, 0], sampledict),
+            'grid': GDALGrid(cohesion, sampledict),
             'label': 'Cohesion (kPa)',
             'type': 'input',
             'description': {
@@ -470,7 +523,7 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                 'longref': cohesionlref}
         }
         maplayers['friction angle'] = {
-            'grid': GDALGrid(friction[:, :, 0], sampledict),
+            'grid': GDALGrid(friction, sampledict),
             'label': 'Friction angle ($^\circ$)',
             'type': 'input',
             'description': {
@@ -480,7 +533,7 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
         }
         if uncertfile is not None:
             maplayers['pgamin'] = {
-                'grid': GDALGrid(PGAmin[:, :, 0], sampledict),
+                'grid': GDALGrid(PGAmin, sampledict),
                 'label': 'PGA - %1.2fstd (g)' % numstd,
                 'type': 'input',
                 'description': {
@@ -488,17 +541,17 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                     'shakemap': shakedetail}
             }
             maplayers['pgamax'] = {
-                'grid': GDALGrid(PGAmax[:, :, 0], sampledict),
+                'grid': GDALGrid(PGAmax, sampledict),
                 'label': 'PGA + %1.2fstd (g)' % numstd,
                 'type': 'input',
                 'description': {
                     'units': 'g',
                     'shakemap': shakedetail}
             }
-        if 'PGV' in displmodel:
+        if usepgv:
             if uncertfile is not None:
                 maplayers['pgvmin'] = {
-                    'grid': GDALGrid(PGVmin[:, :, 0], sampledict),
+                    'grid': GDALGrid(PGVmin, sampledict),
                     'label': 'PGV - %1.2fstd (cm/s)' % numstd,
                     'type': 'input',
                     'description': {
@@ -506,7 +559,7 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                         'shakemap': shakedetail}
                 }
                 maplayers['pgvmax'] = {
-                    'grid': GDALGrid(PGVmax[:, :, 0], sampledict),
+                    'grid': GDALGrid(PGVmax, sampledict),
                     'label': 'PGV + %1.2fstd (cm/s)' % numstd,
                     'type': 'input',
                     'description': {
@@ -514,11 +567,287 @@ def godt2008(shakefile, config, uncertfile=None, saveinputs=False,
                         'shakemap': shakedetail}
                 }
 
-    shutil.rmtree(tmpdir)
-
     return maplayers
 
 
+def _initWorker(params):
+    """
+    Set the inputs used by _computeBlock in the current process.
+    """
+    _WORKER['params'] = params
+
+
+def _computeBlock(block, params=None):
+    """
+    Run the Godt and others (2008) computations of godt2008 over a block of
+    rows of the model grid, reading only the part of the slope quantile,
+    cohesion and friction files covering the block.
+
+    Args:
+        block (tuple): (rowstart, rowend) of the block.
+        params (dict): Inputs set up by godt2008, if None, the ones set by
+            _initWorker. If params['baked'] is a bake manifest, windows of
+            the baked critical accelerations are read instead of the slope,
+            cohesion and friction files.
+
+    Returns:
+        tuple: (block, results) where results is a dictionary of arrays
+        covering the block: 'count' (number of slope quantiles where the
+        Newmark displacement exceeds dnthresh), 'countmin' and 'countmax'
+        (same for the ground motions -/+ numstd, if uncertainties were
+        given), 'maxslope' and, if saveinputs, 'minFS', 'cohesion' and
+        'friction'.
+    """
+    if params is None:
+        params = _WORKER['params']
+    rowstart, rowend = block
+    p = params
+    gdict = getTileGeoDict((rowstart, rowend, None, None), p['sampledict'])
+    uncert = p['PGAmin'] is not None
+
+    def rows(data):
+        if data is None:
+            return None
+        return data[rowstart:rowend]
+
+    PGA = rows(p['PGA'])
+    PGV = rows(p['PGV'])
+    PGAmin = rows(p['PGAmin'])
+    PGAmax = rows(p['PGAmax'])
+    PGVmin = rows(p['PGVmin'])
+    PGVmax = rows(p['PGVmax'])
+
+    # Read in the cohesion and friction files, which are the same for all
+    # slope quantiles, unless the critical accelerations were baked
+    baked = p['baked']
+    if baked is None:
+        cohesion, friction = getStrength(
+            p['cohesionfile'], p['frictionfile'], gdict, codiv=p['codiv'],
+            nodata_cohesion=p['nodata_cohesion'],
+            nodata_friction=p['nodata_friction'])
+
+    # Ignore errors so still runs when Ac > PGA, just leaves nan instead
+    # of crashing.
+    np.seterr(invalid='ignore')
+
+    # Count the slope quantiles where the Newmark displacement exceeds
+    # dnthresh. Quantiles are read and computed one at a time so that only
+    # arrays of the size of the block are ever allocated.
+    results = {}
+    results['count'] = np.zeros(PGA.shape, dtype=int)
+    if uncert:
+        results['countmin'] = np.zeros(PGA.shape, dtype=int)
+        results['countmax'] = np.zeros(PGA.shape, dtype=int)
+    minFS = None
+    if p['fastcount']:
+        # Critical accelerations exceeding dnthresh only depend on the
+        # ground motions, so they are computed once for all quantiles
+        crit = NMcritical(PGA, model=p['displmodel'], M=p['M'], PGV=PGV,
+                          dnthresh=p['dnthresh'])
+        if uncert:
+            critmin = NMcritical(PGAmin, model=p['displmodel'], M=p['M'],
+                                 PGV=PGVmin, dnthresh=p['dnthresh'])
+            critmax = NMcritical(PGAmax, model=p['displmodel'], M=p['M'],
+                                 PGV=PGVmax, dnthresh=p['dnthresh'])
+    for i, quant in enumerate(QUANTILES):
+        if baked is not None:
+            Ac = getLayerCache().quickcut(baked['ac'][i], gdict)
+            Ac = Ac.getData().astype(float)
+        else:
+            slope = getSlope(os.path.join(p['slopefilepath'], quant), gdict,
+                             slopediv=p['slopediv'])
+            FS, Ac = getCriticalAcc(slope, cohesion, friction, p['thick'],
+                                    p['uwt'], p['fsthresh'], p['acthresh'])
+            if p['saveinputs'] is True:
+                minFS = FS if minFS is None else np.minimum(minFS, FS)
+            del(FS)
+
+        if p['fastcount']:
+            results['count'] += _inRange(Ac, *crit)
+            if uncert:
+                results['countmin'] += _inRange(Ac, *critmin)
+                results['countmax'] += _inRange(Ac, *critmax)
+            del(Ac)
+            continue
+
+        Dn, logDnstd, logtype = NMdisp(Ac, PGA, model=p['displmodel'],
+                                       M=p['M'], PGV=PGV)
+        results['count'] += Dn >= p['dnthresh']
+        if uncert:
+            Dnmin, logDnstdmin, logtype = NMdisp(
+                Ac, PGAmin, model=p['displmodel'], M=p['M'], PGV=PGVmin)
+            results['countmin'] += Dnmin > p['dnthresh']
+            Dnmax, logDnstdmax, logtype = NMdisp(
+                Ac, PGAmax, model=p['displmodel'], M=p['M'], PGV=PGVmax)
+            results['countmax'] += Dnmax > p['dnthresh']
+        del(Ac, Dn, logDnstd)
+
+    # The last quantile is the maximum slope
+    if baked is not None:
+        slope = getLayerCache().quickcut(baked['maxslope'], gdict)
+        slope = slope.getData().astype(float)
+    results['maxslope'] = slope
+    if p['saveinputs'] is True:
+        results['minFS'] = minFS
+        results['cohesion'] = cohesion
+        results['friction'] = friction
+    return block, results
+
+
+def getStrength(cohesionfile, frictionfile, gdict, codiv=10.,
+                nodata_cohesion=1., nodata_friction=26.):
+    """
+    Read the cohesion and friction angle layers of the Godt and others
+    (2008) model, replacing missing values.
+
+    Args:
+        cohesionfile (str): Path to the cohesion file.
+        frictionfile (str): Path to the friction angle file.
+        gdict (GeoDict): Geodictionary to cut and resample the layers to.
+        codiv (float): Divide cohesion by this number, see godt2008.
+        nodata_cohesion (float): Cohesion to use where it is missing.
+        nodata_friction (float): Friction angle to use where it is missing.
+
+    Returns:
+        tuple: (cohesion, friction) arrays, in kPa (adjusted) and degrees.
+    """
+    tempco = getLayerCache().quickcut(cohesionfile, gdict, method='near')
+    cohesion = tempco.getData()/codiv
+    cohesion[cohesion == -999.9] = nodata_cohesion
+    cohesion = np.nan_to_num(cohesion)
+    cohesion[cohesion == 0] = nodata_cohesion
+    del(tempco)
+
+    tempfric = getLayerCache().quickcut(frictionfile, gdict, method='near')
+    friction = tempfric.getData().astype(float)
+    friction[friction == -9999] = nodata_friction
+    friction = np.nan_to_num(friction)
+    friction[friction == 0] = nodata_friction
+    del(tempfric)
+    return cohesion, friction
+
+
+def getSlope(slopefile, gdict, slopediv=100.):
+    """
+    Read a slope quantile layer of the Godt and others (2008) model.
+
+    Args:
+        slopefile (str): Path to the slope quantile file.
+        gdict (GeoDict): Geodictionary to cut and resample the layer to.
+        slopediv (float): Divide slopes by this number to get degrees.
+
+    Returns:
+        array: Slopes in degrees, zero slopes are replaced by 1e-8.
+    """
+    tmpslp = getLayerCache().quickcut(slopefile, gdict)
+    tgd = tmpslp.getGeoDict()
+    if tgd != gdict:
+        raise Exception('Input layers are not aligned to same geodict')
+    # Divide slopes by 100 to get to slope in degrees (because input
+    # files are multiplied by 100.)
+    slope = tmpslp.getData()/slopediv
+    del(tmpslp)
+
+    # Change any zero slopes to a very small number to avoid dividing by
+    # zero later
+    slope[slope == 0] = 1e-8
+    return slope
+
+
+def getCriticalAcc(slope, cohesion, friction, thick, uwt, fsthresh,
+                   acthresh):
+    """
+    Compute the Factor of Safety (infinite slope analysis assuming dry
+    conditions) and critical acceleration of the Godt and others (2008)
+    model. Neither depends on shaking.
+
+    Args:
+        slope (array): Slopes in degrees.
+        cohesion (array): Cohesion in kPa.
+        friction (array): Friction angles in degrees.
+        thick (float): Thickness of the failure surface in m.
+        uwt (float): Unit weight in kN/m3.
+        fsthresh (float): Minimum Factor of Safety.
+        acthresh (float): Minimum critical acceleration in g.
+
+    Returns:
+        tuple: (FS, Ac) arrays, Ac in g.
+    """
+    with np.errstate(invalid='ignore'):
+        FS = (cohesion/(uwt*thick*np.sin(slope*(np.pi/180.))) +
+              np.tan(friction*(np.pi/180.))/np.tan(slope*(np.pi/180.)))
+        FS[FS < fsthresh] = fsthresh
+
+        # Compute critical acceleration, in g
+        # This gives ac in g, equations that multiply by g give ac in m/s2
+        Ac = (FS-1)*np.sin(slope*(np.pi/180.)).astype(float)
+        Ac[Ac < acthresh] = acthresh
+    return FS, Ac
+
+
+def getGodtBakeHash(slopefilepath, cohesionfile, frictionfile, params):
+    """
+    Get a hash identifying everything that goes into the critical
+    accelerations baked by gfail_bake (see :func:`gfail.bake.bakeGodt`), so
+    stale grids can be detected.
+
+    Args:
+        slopefilepath (str): Directory of the slope quantile files.
+        cohesionfile (str): Path to the cohesion file.
+        frictionfile (str): Path to the friction angle file.
+        params (dict): Dictionary of the other inputs of getStrength,
+            getSlope and getCriticalAcc: 'thick', 'uwt', 'fsthresh',
+            'acthresh', 'slopediv', 'codiv', 'nodata_cohesion' and
+            'nodata_friction'.
+
+    Returns:
+        str: md5 hash of the inputs.
+    """
+    files = {}
+    for name, layerfile in ([('cohesion', cohesionfile),
+                             ('friction', frictionfile)] +
+                            [(quant, os.path.join(slopefilepath, quant))
+                             for quant in QUANTILES]):
+        # Identified by path, modification time and size, so layers updated
+        # in place with the same dimensions are detected
+        files[name] = list(getFileKey(layerfile))
+    params = dict([(key, float(params[key])) for key in BAKE_PARAMS])
+    params['layers'] = files
+    params = json.dumps(params, sort_keys=True)
+    return hashlib.md5(params.encode('utf-8')).hexdigest()
+
+
+def readGodtBake(bakefile, bakehash):
+    """
+    Read the manifest of the critical accelerations of the Godt and others
+    (2008) model made by gfail_bake.
+
+    Args:
+        bakefile (str): Path to the manifest (json) file.
+        bakehash (str): Hash of the current model inputs, output by
+            getGodtBakeHash.
+
+    Returns:
+        dict: The manifest, with absolute paths to the grids, or None if the
+        manifest does not exist or the grids were made from different model
+        inputs.
+    """
+    if not os.path.exists(bakefile):
+        print('bakefile %s does not exist, not using baked grids' % bakefile)
+        return None
+    with open(bakefile, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('hash') != bakehash or 'ac' not in manifest:
+        print('Model inputs changed since %s was made, not using baked '
+              'grids' % bakefile)
+        return None
+    bakedir = os.path.dirname(os.path.abspath(bakefile))
+    manifest['ac'] = [os.path.join(bakedir, acfile)
+                      for acfile in manifest['ac']]
+    manifest['maxslope'] = os.path.join(bakedir, manifest['maxslope'])
+    return manifest
+
+
 def NMdisp(Ac, PGA, model='J_PGA', M=None, PGV=None):
     """
     PGA-based Newmark Displacement model
@@ -540,6 +869,8 @@ def NMdisp(Ac, PGA, model='J_PGA', M=None, PGV=None):
             * ``'BT_PGA_M'`` -- PGA and M-based model from Bray and
               Travasarou (2007) assuming natural fundamental period of
               sliding mass Ts = 0 (eq 6).
+            * ``'all'`` -- Average of all the above models, see
+              NMdispEnsemble.
 
         M (float): Magnitude -- only needed for models with M in the name.
         PGV (float): NxM Array of PGV values in units of cm/sec -- only needed
@@ -551,6 +882,60 @@ def NMdisp(Ac, PGA, model='J_PGA', M=None, PGV=None):
             * logDnstd: Log of standard deviation of Dn
             * logtype: Type of log used in logDnstd (log10 or ln)
     """
+    if model == 'all':
+        Dn, logDnstd, logtype, models = NMdispEnsemble(Ac, PGA, M=M, PGV=PGV)
+        return Dn, logDnstd, logtype
+    return _NMdispModels(Ac, PGA, [model], M=M, PGV=PGV)[model]
+
+
+def NMdispEnsemble(Ac, PGA, models=None, M=None, PGV=None):
+    """
+    Evaluate several Newmark displacement models (see NMdisp) in one pass.
+    Terms shared by the models, such as Ac/PGA and its powers, ln(PGA) and
+    ln(Ac), are only computed once.
+
+    Args:
+        Ac (array): NxM array of critical accelerations in units of g.
+        PGA (array): NxM Array of PGA values in units of g.
+        models (list): Names of the models to evaluate, see NMdisp, None for
+            all of them (DISPL_MODELS).
+        M (float): Magnitude -- only needed for models with M in the name.
+        PGV (float): NxM Array of PGV values in units of cm/sec -- only needed
+            for models with PGV in the name.
+
+    Returns:
+        tuple: (Dn, logDnstd, logtype, results) where:
+            * Dn: Average Newmark displacement of the models in cm
+            * logDnstd: Average standard deviation of the models, as the
+              natural log of Dn
+            * logtype: 'ln'
+            * results: OrderedDict where keys are model names and values are
+              the (Dn, logDnstd, logtype) tuples of each model, as output by
+              NMdisp
+    """
+    if models is None:
+        models = DISPL_MODELS
+    results = _NMdispModels(Ac, PGA, models, M=M, PGV=PGV)
+
+    # Average of the models, with standard deviations as natural logs
+    Dn = sum(result[0] for result in results.values())/len(results)
+    logDnstd = sum(result[1]*(np.log(10.) if result[2] == 'log10' else 1.)
+                   for result in results.values())/len(results)
+    return Dn, logDnstd, 'ln', results
+
+
+def _NMdispModels(Ac, PGA, models, M=None, PGV=None):
+    """
+    Evaluate the Newmark displacement models of NMdispEnsemble.
+
+    Returns:
+        OrderedDict: Dictionary where keys are model names and values are
+        (Dn, logDnstd, logtype) tuples, as output by NMdisp.
+    """
+    for model in models:
+        if model not in DISPL_MODELS:
+            raise Exception('Unknown Newmark displacement model %s' % model)
+
     # Deal with non-array inputs
     if isinstance(Ac, float) or isinstance(Ac, int):
         flag = 1
@@ -560,82 +945,191 @@ def NMdisp(Ac, PGA, model='J_PGA', M=None, PGV=None):
     # crashing
     np.seterr(invalid='ignore')
 
-    if model == 'J_PGA':
-        C1 = 0.215  # additive constant in newmark displacement calculation
-        C2 = 2.341  # first exponential constant
-        C3 = -1.438  # second exponential constant
-        Dn = np.array(10.**(C1 + np.log10(((1-Ac/PGA)**C2)*(Ac/PGA)**C3)))
-        Dn[np.isnan(Dn)] = 0.
-        logDnstd = np.ones(np.shape(Dn))*0.51
-        logtype = 'log10'
-
-    elif model == 'J_PGA_M':
-        if M is None:
-            raise Exception('M (magnitude) not found, cannot use RS_PGA_M '
-                            'model')
-        else:
+    # Terms shared by several models
+    ratio = Ac/PGA
+    if 'RS_PGA_M' in models or 'RS_PGA_PGV' in models:
+        ratio2 = ratio**2
+        ratio3 = ratio**3
+        ratio4 = ratio**4
+    if 'RS_PGA_M' in models or 'RS_PGA_PGV' in models or \
+            'BT_PGA_M' in models:
+        lnPGA = np.log(PGA)
+
+    results = collections.OrderedDict()
+    for model in models:
+        if model == 'J_PGA':
+            C1 = 0.215  # additive constant in newmark displacement calculation
+            C2 = 2.341  # first exponential constant
+            C3 = -1.438  # second exponential constant
+            Dn = np.array(10.**(C1 + np.log10(((1-ratio)**C2)*ratio**C3)))
+            Dn[np.isnan(Dn)] = 0.
+            logDnstd = np.ones(np.shape(Dn))*0.51
+            logtype = 'log10'
+
+        elif model == 'J_PGA_M':
+            if M is None:
+                raise Exception('M (magnitude) not found, cannot use '
+                                'J_PGA_M model')
             C1 = -2.71  # additive constant in newmark displacement calculation
             C2 = 2.335  # first exponential constant
             C3 = -1.478  # second exponential constant
             C4 = 0.424
-            Dn = np.array(10.**(C1 + np.log10(((1-Ac/PGA)**C2)*(Ac/PGA)**C3) +
+            Dn = np.array(10.**(C1 + np.log10(((1-ratio)**C2)*ratio**C3) +
                                 C4*M))
             Dn[np.isnan(Dn)] = 0.
             logDnstd = np.ones(np.shape(Dn))*0.454
             logtype = 'log10'
 
-    elif model == 'RS_PGA_M':
-        if M is None:
-            raise Exception('You must enter a value for M to use the '
-                            'RS_PGA_M model')
-        C1 = 4.89
-        C2 = -4.85
-        C3 = -19.64
-        C4 = 42.49
-        C5 = -29.06
-        C6 = 0.72
-        C7 = 0.89
-        # Equation from Saygili and Rathje (2008)/Rathje and Saygili (2009)
-        Dn = np.array(np.exp(C1 + C2*(Ac/PGA) + C3*(Ac/PGA)**2 +
-                             C4*(Ac/PGA)**3 + C5*(Ac/PGA)**4 +
-                             C6*np.log(PGA)+C7*(M-6)))
-        Dn[np.isnan(Dn)] = 0.
-        logDnstd = 0.732 + 0.789*(Ac/PGA) - 0.539*(Ac/PGA)**2
-        logtype = 'ln'
-
-    elif model == 'RS_PGA_PGV':
-        if PGV is None:
-            raise Exception('You must enter a value for M to use the '
-                            'RS_PGA_PGV model')
-        C1 = -1.56
-        C2 = -4.58
-        C3 = -20.84
-        C4 = 44.75
-        C5 = -30.50
-        C6 = -0.64
-        C7 = 1.55
-        # Equation from Saygili and Rathje (2008)/Rathje and Saygili (2009)
-        Dn = np.array(np.exp(C1 + C2*(Ac/PGA) + C3*(Ac/PGA)**2 +
-                             C4*(Ac/PGA)**3 + C5*(Ac/PGA)**4 +
-                             C6*np.log(PGA)+C7*np.log(PGV)))
-        Dn[np.isnan(Dn)] = 0.
-        logDnstd = 0.405 + 0.524*(Ac/PGA)
-        logtype = 'ln'
-
-    elif model == 'BT_PGA_M':
-        if M is None:
-            raise Exception('You must enter a value for M to use the '
-                            'BT_PGA_M model')
-        Dn = np.array(
-            np.exp(-0.22 - 2.83*np.log(Ac) - 0.333*(np.log(Ac))**2 +
-                   0.566*np.log(Ac)*np.log(PGA) +
-                   3.04*np.log(PGA) - 0.244*(np.log(PGA))**2 + 0.278*(M-7.)))
-        Dn[np.isnan(Dn)] = 0.
-        logDnstd = np.ones(np.shape(Dn))*0.66
-        logtype = 'log10'
-
-    if flag == 1:
-        Dn = float(Dn)
-        logDnstd = float(logDnstd)
-
-    return Dn, logDnstd, logtype
+        elif model == 'RS_PGA_M':
+            if M is None:
+                raise Exception('You must enter a value for M to use the '
+                                'RS_PGA_M model')
+            C1 = 4.89
+            C2 = -4.85
+            C3 = -19.64
+            C4 = 42.49
+            C5 = -29.06
+            C6 = 0.72
+            C7 = 0.89
+            # Equation from Saygili and Rathje (2008)/Rathje and Saygili
+            # (2009)
+            Dn = np.array(np.exp(C1 + C2*ratio + C3*ratio2 +
+                                 C4*ratio3 + C5*ratio4 +
+                                 C6*lnPGA+C7*(M-6)))
+            Dn[np.isnan(Dn)] = 0.
+            logDnstd = 0.732 + 0.789*ratio - 0.539*ratio2
+            logtype = 'ln'
+
+        elif model == 'RS_PGA_PGV':
+            if PGV is None:
+                raise Exception('You must enter a value for PGV to use the '
+                                'RS_PGA_PGV model')
+            C1 = -1.56
+            C2 = -4.58
+            C3 = -20.84
+            C4 = 44.75
+            C5 = -30.50
+            C6 = -0.64
+            C7 = 1.55
+            # Equation from Saygili and Rathje (2008)/Rathje and Saygili
+            # (2009)
+            Dn = np.array(np.exp(C1 + C2*ratio + C3*ratio2 +
+                                 C4*ratio3 + C5*ratio4 +
+                                 C6*lnPGA+C7*np.log(PGV)))
+            Dn[np.isnan(Dn)] = 0.
+            logDnstd = 0.405 + 0.524*ratio
+            logtype = 'ln'
+
+        elif model == 'BT_PGA_M':
+            if M is None:
+                raise Exception('You must enter a value for M to use the '
+                                'BT_PGA_M model')
+            lnAc = np.log(Ac)
+            Dn = np.array(
+                np.exp(-0.22 - 2.83*lnAc - 0.333*lnAc**2 +
+                       0.566*lnAc*lnPGA +
+                       3.04*lnPGA - 0.244*lnPGA**2 + 0.278*(M-7.)))
+            Dn[np.isnan(Dn)] = 0.
+            logDnstd = np.ones(np.shape(Dn))*0.66
+            logtype = 'log10'
+
+        if flag == 1:
+            Dn = float(Dn)
+            logDnstd = float(logDnstd)
+        results[model] = (Dn, logDnstd, logtype)
+    return results
+
+
+def NMcritical(PGA, model='J_PGA', M=None, PGV=None, dnthresh=5.):
+    """
+    Inverse of NMdisp: range of critical accelerations for which the Newmark
+    displacement of NMdisp is at least dnthresh.
+
+    Args:
+        PGA (array): NxM Array of PGA values in units of g.
+        model (str): Newmark displacement model, see NMdisp.
+        M (float): Magnitude -- only needed for models with M in the name.
+        PGV (array): NxM Array of PGV values in units of cm/sec -- only
+            needed for models with PGV in the name.
+        dnthresh (float): Threshold Newmark displacement in cm, must be
+            positive.
+
+    Returns:
+        tuple: (Acmin, Acmax) NxM arrays in units of g, the displacement
+        exceeds dnthresh where Acmin <= Ac < Acmax (up to rounding). Acmin
+        is None for models where the displacement only decreases with Ac.
+        Cells where dnthresh is never exceeded are nan.
+    """
+    if dnthresh <= 0.:
+        raise Exception('dnthresh must be positive')
+    PGA = np.asarray(PGA, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if model in ['J_PGA', 'J_PGA_M']:
+            # log10(Dn) = C1 + C2*log10(1 - r) + C3*log10(r), with r = Ac/PGA,
+            # decreases from inf to -inf for 0 < r < 1, so the threshold on r
+            # is the same for all cells and is found by bisection.
+            if model == 'J_PGA':
+                C1, C2, C3 = 0.215, 2.341, -1.438
+            elif M is None:
+                raise Exception('M (magnitude) not found, cannot use '
+                                'J_PGA_M model')
+            else:
+                C1, C2, C3 = -2.71 + 0.424*M, 2.335, -1.478
+            target = np.log10(dnthresh)
+            rlo, rhi = 0., 1.
+            for i in range(100):
+                r = (rlo + rhi)/2.
+                if C1 + C2*np.log10(1. - r) + C3*np.log10(r) >= target:
+                    rlo = r
+                else:
+                    rhi = r
+            return None, rlo*PGA
+
+        elif model in ['RS_PGA_M', 'RS_PGA_PGV']:
+            # ln(Dn) = g(r) + offset, where the polynomial g decreases for
+            # r = Ac/PGA >= 0 and offset only depends on the ground motions,
+            # so the threshold on r is looked up in a table of g.
+            if model == 'RS_PGA_M':
+                if M is None:
+                    raise Exception('You must enter a value for M to use '
+                                    'the RS_PGA_M model')
+                C = [4.89, -4.85, -19.64, 42.49, -29.06]
+                offset = 0.72*np.log(PGA) + 0.89*(M-6)
+            else:
+                if PGV is None:
+                    raise Exception('You must enter a value for PGV to use '
+                                    'the RS_PGA_PGV model')
+                C = [-1.56, -4.58, -20.84, 44.75, -30.50]
+                offset = -0.64*np.log(PGA) + 1.55*np.log(PGV)
+            r = np.linspace(0., 5., 50001)
+            g = C[0] + C[1]*r + C[2]*r**2 + C[3]*r**3 + C[4]*r**4
+            rstar = np.interp(np.log(dnthresh) - offset, g[::-1], r[::-1])
+            rstar = np.where(np.isnan(offset), np.nan, rstar)
+            return None, rstar*PGA
+
+        elif model == 'BT_PGA_M':
+            # ln(Dn) is a quadratic function of ln(Ac) that opens downward,
+            # so the displacement exceeds dnthresh between its two roots
+            if M is None:
+                raise Exception('You must enter a value for M to use the '
+                                'BT_PGA_M model')
+            L = np.log(PGA)
+            A = -0.333
+            B = -2.83 + 0.566*L
+            C = (-0.22 + 3.04*L - 0.244*L**2 + 0.278*(M-7.) -
+                 np.log(dnthresh))
+            root = np.sqrt(B**2 - 4.*A*C)
+            return np.exp((-B + root)/(2.*A)), np.exp((-B - root)/(2.*A))
+
+    raise Exception('Unknown Newmark displacement model %s' % model)
+
+
+def _inRange(Ac, Acmin, Acmax):
+    """
+    Return where critical accelerations are within the range returned by
+    NMcritical.
+    """
+    inside = Ac < Acmax
+    if Acmin is not None:
+        inside &= Ac >= Acmin
+    return inside
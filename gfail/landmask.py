@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+"""
+Cache of land masks rasterized from a shapefile of land masses.
+
+trim_ocean is applied to every output grid of every model, with the same
+shapefile and usually the same grid. A LandMask rasterizes the polygons of
+the shapefile that overlap a grid once, into a boolean array of the cells to
+mask, and keeps it in memory, and optionally on disk so it can be reused by
+later runs. Masks are keyed by the identity of the shapefile (absolute path,
+modification time and size), the geodictionary of the grid and the
+all_touched and invert options, with the same meaning as in
+rasterio.mask.mask. Both levels evict the least recently used masks when
+they exceed their size cap.
+
+Masks can also be read from a pyramid of global land masks made once from
+the shapefile by buildLandPyramid (see the gfail_landmask program), one
+GeoTIFF per resolution of the model grids (e.g., 30 arc-second base layers
+and their divfactor subdivisions). Grids aligned with one of the levels of
+the pyramid then read a window of it instead of rasterizing polygons.
+"""
+
+# stdlib imports
+import os
+import json
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+# third party imports
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from mapio.geodict import GeoDict
+
+# local imports
+from gfail.polygonstore import getPolygonStore, getFileKey
+
+
+#: Default size cap of the masks kept in memory, in bytes
+MAXBYTES = 5e8
+
+#: Default size cap of the masks kept on disk, in bytes
+MAXDISKBYTES = 5e9
+
+#: Default resolutions of the levels of land mask pyramids, in degrees: 15
+#: arc-seconds to 8 arc-minutes
+RESOLUTIONS = [1. / 240. * 2 ** i for i in range(6)]
+
+#: Largest number of cells read from a pyramid level by LandPyramid.overLand
+MAXCELLS = 4e6
+
+
+class LandMask(object):
+    def __init__(self, maxbytes=MAXBYTES, cachedir=None,
+                 maxdiskbytes=MAXDISKBYTES, pyramid=None):
+        """
+        Cache of rasterized land masks.
+
+        Args:
+            maxbytes (float): Maximum size of the masks kept in memory, 0
+                disables the memory cache.
+            cachedir (str): Directory where masks are saved so they can be
+                reused by later runs, None to only keep them in memory.
+            maxdiskbytes (float): Maximum size of the masks saved in
+                cachedir.
+            pyramid (str): Path to the manifest of a land mask pyramid made
+                by buildLandPyramid, read instead of rasterizing the
+                shapefile it was made from when grids are aligned with one
+                of its levels.
+        """
+        self.pyramid = None
+        if pyramid is not None:
+            self.pyramid = LandPyramid(pyramid)
+        self.maxbytes = maxbytes
+        self.maxdiskbytes = maxdiskbytes
+        self.cachedir = cachedir
+        if cachedir is not None and not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        self.masks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def getMask(self, mask, gdict, all_touched=True, invert=False):
+        """
+        Get the cells of a grid to mask, as rasterio.mask.mask would.
+
+        Args:
+            mask: Path to a shapefile, or list of shapes (GeoJSON-like
+                geometries or shapely shapes).
+            gdict (GeoDict): Geodictionary of the grid.
+            all_touched (bool): If True, cells touching a polygon are not
+                masked.
+            invert (bool): If True, mask the cells inside the polygons
+                instead of the cells outside.
+
+        Returns:
+            array: Boolean array of the shape of the grid, True for cells to
+            mask. Shared with the cache, must not be modified.
+        """
+        key = getMaskKey(mask, gdict, all_touched, invert)
+        if key is None:
+            return rasterizeMask(getFeatures(mask, gdict), gdict,
+                                 all_touched=all_touched, invert=invert)
+        name = hashlib.md5(json.dumps(key).encode()).hexdigest()
+        with self.lock:
+            outside = self.masks.get(name)
+            if outside is not None:
+                self.masks.move_to_end(name)
+        if outside is None:
+            outside = self._load(name, gdict)
+            if outside is not None:
+                self._keep(name, outside)
+        if outside is not None:
+            self.hits += 1
+            return outside
+        self.misses += 1
+        if self.pyramid is not None and all_touched and \
+                self.pyramid.matches(mask):
+            outside = self.pyramid.getMask(gdict, invert=invert)
+            if outside is not None:
+                outside.setflags(write=False)
+                self._keep(name, outside)
+                return outside
+        outside = rasterizeMask(getFeatures(mask, gdict), gdict,
+                                all_touched=all_touched, invert=invert)
+        outside.setflags(write=False)
+        self._keep(name, outside)
+        self._save(name, key, outside)
+        return outside
+
+    def clear(self):
+        """
+        Remove all masks from memory, masks saved on disk are kept.
+        """
+        with self.lock:
+            self.masks.clear()
+            self.nbytes = 0
+
+    def _keep(self, name, outside):
+        """
+        Keep a mask in memory, dropping the least recently used ones.
+        """
+        if outside.nbytes > self.maxbytes:
+            return
+        with self.lock:
+            if name in self.masks:
+                return
+            self.masks[name] = outside
+            self.nbytes += outside.nbytes
+            while self.nbytes > self.maxbytes:
+                oldname, oldmask = self.masks.popitem(last=False)
+                self.nbytes -= oldmask.nbytes
+
+    def _load(self, name, gdict):
+        """
+        Read a mask saved in cachedir, or return None.
+        """
+        if self.cachedir is None:
+            return None
+        npyfile = os.path.join(self.cachedir, name + '.npy')
+        try:
+            packed = np.load(npyfile)
+            os.utime(npyfile, None)  # Mark as recently used
+        except Exception:
+            return None
+        outside = np.unpackbits(packed)[:gdict.ny * gdict.nx].astype(bool)
+        outside = outside.reshape((gdict.ny, gdict.nx))
+        outside.setflags(write=False)
+        return outside
+
+    def _save(self, name, key, outside):
+        """
+        Save a mask in cachedir, as bits, and evict the least recently used
+        masks if the directory gets larger than maxdiskbytes.
+        """
+        if self.cachedir is None:
+            return
+        base = os.path.join(self.cachedir, name)
+        temp = '%s.%d.tmp' % (base, os.getpid())
+        try:
+            # Written under a temporary name first so that other runs never
+            # read partial files
+            np.save(temp + '.npy', np.packbits(outside, axis=None))
+            os.replace(temp + '.npy', base + '.npy')
+        except Exception as e:
+            print('Could not save land mask to cache directory: %s' % e)
+            return
+        files = []
+        for npyfile in glob.glob(os.path.join(self.cachedir, '*.npy')):
+            if npyfile.endswith('.tmp.npy'):
+                continue
+            try:
+                stat = os.stat(npyfile)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, npyfile))
+        total = sum(size for mtime, size, npyfile in files)
+        for mtime, size, npyfile in sorted(files):
+            if total <= self.maxdiskbytes:
+                break
+            try:
+                os.remove(npyfile)
+            except OSError:
+                pass
+            total -= size
+
+
+def getMaskKey(mask, gdict, all_touched, invert):
+    """
+    Return the cache key of a land mask, or None if mask is not the path of
+    an existing file.
+    """
+    if not isinstance(mask, str) or not os.path.isfile(mask):
+        return None
+    stat = os.stat(mask)
+    return [os.path.abspath(mask), stat.st_mtime, stat.st_size,
+            [gdict.xmin, gdict.xmax, gdict.ymin, gdict.ymax, gdict.dx,
+             gdict.dy, gdict.nx, gdict.ny], bool(all_touched), bool(invert)]
+
+
+def getFeatures(mask, gdict):
+    """
+    Get the shapes of a shapefile overlapping a grid, from the polygon
+    store of the shapefile (see :mod:`gfail.polygonstore`).
+
+    Args:
+        mask: Path to a shapefile, or list of shapes, returned as is.
+        gdict (GeoDict): Geodictionary of the grid.
+
+    Returns:
+        list: List of shapely shapes (or of the shapes of mask).
+    """
+    if type(mask) == str:
+        # Bounds of the edges of the cells, shapes that only touch the outer
+        # half of edge cells still count with all_touched
+        return getPolygonStore(mask).query(
+            (gdict.xmin - gdict.dx / 2., gdict.ymin - gdict.dy / 2.,
+             gdict.xmax + gdict.dx / 2., gdict.ymax + gdict.dy / 2.))
+    elif type(mask) == list:
+        return mask
+    raise Exception('mask is neither a link to a shapefile or a list of '
+                    'shapely shapes, cannot proceed')
+
+
+def rasterizeMask(features, gdict, all_touched=True, invert=False):
+    """
+    Rasterize shapes into the cells of a grid to mask, as rasterio.mask.mask
+    does.
+
+    Args:
+        features (list): List of GeoJSON-like geometries or shapely shapes.
+        gdict (GeoDict): Geodictionary of the grid.
+        all_touched (bool): If True, cells touching a polygon are not
+            masked.
+        invert (bool): If True, mask the cells inside the polygons instead
+            of the cells outside.
+
+    Returns:
+        array: Boolean array of the shape of the grid, True for cells to
+        mask.
+    """
+    shape = (gdict.ny, gdict.nx)
+    if not len(features):
+        # Nothing to keep, or nothing to remove if inverted
+        return np.full(shape, not invert)
+    transform = from_origin(gdict.xmin - gdict.dx / 2.,
+                            gdict.ymax + gdict.dy / 2., gdict.dx, gdict.dy)
+    return geometry_mask(features, shape, transform, all_touched=all_touched,
+                         invert=invert)
+
+
+class LandPyramid(object):
+    def __init__(self, manifest):
+        """
+        Land mask pyramid made by buildLandPyramid.
+
+        Args:
+            manifest (str): Path to the manifest (json) file of the pyramid.
+        """
+        with open(manifest, 'r') as f:
+            info = json.load(f)
+        pyrdir = os.path.dirname(os.path.abspath(manifest))
+        self.manifest = manifest
+        self.source = info['source']
+        self.levels = []
+        for level in info['levels']:
+            level = dict(level)
+            level['file'] = os.path.join(pyrdir, level['file'])
+            self.levels.append(level)
+
+    def matches(self, mask):
+        """
+        Check whether the pyramid was made from a shapefile.
+
+        Args:
+            mask: Path to a shapefile, or list of shapes.
+
+        Returns:
+            bool: True if mask is the path to the shapefile the pyramid was
+            made from and it was not modified since.
+        """
+        if not isinstance(mask, str) or not os.path.isfile(mask):
+            return False
+        return self.source == _getSource(mask)
+
+    def getMask(self, gdict, invert=False):
+        """
+        Get the cells of a grid to mask, as LandMask.getMask would with
+        all_touched, from the level of the pyramid the grid is aligned with.
+
+        Args:
+            gdict (GeoDict): Geodictionary of the grid.
+            invert (bool): If True, mask the cells on land instead of the
+                cells offshore.
+
+        Returns:
+            array: Boolean array of the shape of the grid, True for cells to
+            mask, or None if the grid is not aligned with any level or is
+            not fully covered.
+        """
+        for level in self.levels:
+            window = _getAlignedWindow(level, gdict)
+            if window is None:
+                continue
+            with rasterio.open(level['file'], 'r') as src:
+                land = src.read(1, window=window).astype(bool)
+            if invert:
+                return land
+            return ~land
+        return None
+
+    def overLand(self, xmin, xmax, ymin, ymax):
+        """
+        Check whether any land is within a box, from the finest level of the
+        pyramid the box spans at most MAXCELLS cells of.
+
+        Args:
+            xmin (float): Western edge of the box.
+            xmax (float): Eastern edge of the box.
+            ymin (float): Southern edge of the box.
+            ymax (float): Northern edge of the box.
+
+        Returns:
+            bool: True if any cell of the level touching the box touches
+            land, so land may be up to one cell of the level outside the
+            box; None if the box is not covered by the pyramid.
+        """
+        for level in self.levels:
+            col0 = int(np.floor((xmin - level['xmin']) / level['dx']))
+            col1 = int(np.ceil((xmax - level['xmin']) / level['dx']))
+            row0 = int(np.floor((level['ymax'] - ymax) / level['dy']))
+            row1 = int(np.ceil((level['ymax'] - ymin) / level['dy']))
+            if col0 < 0 or row0 < 0 or col1 > level['nx'] or \
+                    row1 > level['ny']:
+                return None
+            if (col1 - col0) * (row1 - row0) > MAXCELLS and \
+                    level is not self.levels[-1]:
+                continue
+            window = Window(col0, row0, max(col1 - col0, 1),
+                            max(row1 - row0, 1))
+            with rasterio.open(level['file'], 'r') as src:
+                return bool(src.read(1, window=window).any())
+        return None
+
+
+def buildLandPyramid(trimfile, outdir, resolutions=None, bounds=None,
+                     rowmax=1000):
+    """
+    Rasterize a shapefile of land masses once at several resolutions, so
+    LandMask can read windows of the masks instead of rasterizing polygons
+    for each grid.
+
+    Args:
+        trimfile (str): Shapefile of earth's land masses.
+        outdir (str): Directory where the levels of the pyramid and its
+            manifest are saved.
+        resolutions (list): Cell sizes of the levels, in degrees, default
+            RESOLUTIONS. Grids are only read from a level if they have the
+            same cell size and their cell edges line up with the level.
+        bounds (dict): Default of None covers the whole globe, otherwise a
+            dictionary of boundaries like
+
+            .. code-block:: python
+
+                bounds = {
+                    'xmin': lonmin, 'xmax': lonmax,
+                    'ymin': latmin, 'ymax': latmax
+                }
+
+            Cell edges line up with xmin and ymax.
+        rowmax (int): Number of rows to rasterize at once.
+
+    Returns:
+        str: Path to the manifest file of the pyramid.
+    """
+    if resolutions is None:
+        resolutions = RESOLUTIONS
+    if bounds is None:
+        bounds = {'xmin': -180., 'xmax': 180., 'ymin': -90., 'ymax': 90.}
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    manifest = {'source': _getSource(trimfile), 'levels': []}
+    for i, res in enumerate(sorted(resolutions)):
+        nx = int(np.ceil((bounds['xmax'] - bounds['xmin']) / res - 1e-6))
+        ny = int(np.ceil((bounds['ymax'] - bounds['ymin']) / res - 1e-6))
+        level = {'file': 'landmask_%d.tif' % i, 'dx': res, 'dy': res,
+                 'xmin': bounds['xmin'], 'ymax': bounds['ymax'],
+                 'nx': nx, 'ny': ny}
+        profile = {
+            'driver': 'GTiff',
+            'height': ny,
+            'width': nx,
+            'count': 1,
+            'dtype': 'uint8',
+            'nbits': 1,
+            'crs': 'EPSG:4326',
+            'transform': from_origin(bounds['xmin'], bounds['ymax'], res,
+                                     res),
+            'compress': 'deflate',
+            'BIGTIFF': 'IF_SAFER'
+        }
+        if nx >= 256 and ny >= 256:
+            profile.update(tiled=True, blockxsize=256, blockysize=256)
+        with rasterio.open(os.path.join(outdir, level['file']), 'w',
+                           **profile) as dst:
+            for rowstart in range(0, ny, rowmax):
+                start = timer()
+                rowend = min(rowstart + rowmax, ny)
+                blockdict = GeoDict({
+                    'xmin': bounds['xmin'] + res / 2.,
+                    'xmax': bounds['xmin'] + (nx - 0.5) * res,
+                    'ymin': bounds['ymax'] - (rowend - 0.5) * res,
+                    'ymax': bounds['ymax'] - (rowstart + 0.5) * res,
+                    'dx': res, 'dy': res,
+                    'ny': rowend - rowstart, 'nx': nx})
+                land = rasterizeMask(getFeatures(trimfile, blockdict),
+                                     blockdict, all_touched=True,
+                                     invert=True)
+                dst.write(land.astype('uint8'), 1,
+                          window=Window(0, rowstart, nx, rowend - rowstart))
+                print('Rasterized rows %d to %d of %d at %g deg: %1.1f sec'
+                      % (rowstart, rowend, ny, res, timer() - start))
+        manifest['levels'].append(level)
+
+    # Written last, so an interrupted pyramid is never used
+    manifestfile = os.path.join(outdir, 'landmask.json')
+    with open(manifestfile, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifestfile
+
+
+def _getSource(trimfile):
+    """
+    Identify the shapefile a pyramid is made from by absolute path,
+    modification time and size, as the masks cached by LandMask are.
+    """
+    return list(getFileKey(trimfile))
+
+
+def _getAlignedWindow(level, gdict, tol=1e-3):
+    """
+    Get the window of a pyramid level covering a grid, or None if the grid
+    does not have the cell size of the level, its cells do not line up with
+    the cells of the level, or it is not fully inside the level.
+    """
+    dx = level['dx']
+    dy = level['dy']
+    if abs(gdict.dx - dx) > 1e-6 * dx or abs(gdict.dy - dy) > 1e-6 * dy:
+        return None
+    col = (gdict.xmin - dx / 2. - level['xmin']) / dx
+    row = (level['ymax'] - gdict.ymax - dy / 2.) / dy
+    if abs(col - round(col)) > tol or abs(row - round(row)) > tol:
+        return None
+    col = int(round(col))
+    row = int(round(row))
+    if col < 0 or row < 0 or col + gdict.nx > level['nx'] or \
+            row + gdict.ny > level['ny']:
+        return None
+    return Window(col, row, gdict.nx, gdict.ny)
+
+
+_CACHE = [LandMask()]
+
+
+def getLandMask():
+    """
+    Return the land mask cache used by trim_ocean in this process.
+    """
+    return _CACHE[0]
+
+
+def setLandMask(maxbytes=MAXBYTES, cachedir=None,
+                maxdiskbytes=MAXDISKBYTES, pyramid=None):
+    """
+    Replace the land mask cache used by trim_ocean in this process, see
+    LandMask for the arguments.
+
+    Returns:
+        LandMask: The new cache.
+    """
+    _CACHE[0] = LandMask(maxbytes=maxbytes, cachedir=cachedir,
+                         maxdiskbytes=maxdiskbytes, pyramid=pyramid)
+    return _CACHE[0]
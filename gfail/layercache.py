@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Cache of predictor layers resampled with quickcut.
+
+Several models cut the same global layers to the same event grid, and
+updated versions of a ShakeMap usually lead to the same grid again. A
+LayerCache keeps the resampled grids in memory, up to a size given by the
+caller (none by default), and optionally on disk so they can be reused by
+later runs, keyed by the identity of the source file
+(absolute path, modification time and size), the target geodictionary, the
+interpolation method and whether the cut was precise. Both levels evict the
+least recently used layers when they exceed their size cap.
+"""
+
+# stdlib imports
+import os
+import json
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+
+# third party imports
+import numpy as np
+from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
+
+# local imports
+from gfail.spatial import quickcut
+
+
+#: Default size cap of the layers kept in memory, in bytes, none are kept
+#: unless a cap is given (see the --cache-memory option of gfail)
+MAXBYTES = 0
+
+#: Default size cap of the layers kept on disk, in bytes
+MAXDISKBYTES = 20e9
+
+
+class LayerCache(object):
+    def __init__(self, maxbytes=MAXBYTES, cachedir=None,
+                 maxdiskbytes=MAXDISKBYTES):
+        """
+        Cache of resampled layers.
+
+        Args:
+            maxbytes (float): Maximum size of the layers kept in memory, 0
+                disables the memory cache.
+            cachedir (str): Directory where resampled layers are saved so
+                they can be reused by later runs, None to only keep them in
+                memory.
+            maxdiskbytes (float): Maximum size of the layers saved in
+                cachedir.
+        """
+        self.maxbytes = maxbytes
+        self.maxdiskbytes = maxdiskbytes
+        self.cachedir = cachedir
+        if cachedir is not None and not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        self.layers = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def quickcut(self, filename, gdict, precise=True, method='bilinear'):
+        """
+        Cached version of gfail.spatial.quickcut for files.
+
+        Args:
+            filename (str): Path to the file to cut.
+            gdict (GeoDict): Geodictionary to cut and resample to.
+            precise (bool): See quickcut.
+            method (str): Interpolation method, see quickcut.
+
+        Returns:
+            Grid2D: Resampled layer, which the caller may modify (layers
+            kept in memory are returned as copies).
+        """
+        key = getLayerKey(filename, gdict, method, precise)
+        if key is None:
+            return quickcut(filename, gdict, precise=precise, method=method)
+        name = hashlib.md5(json.dumps(key).encode()).hexdigest()
+        with self.lock:
+            grid = self.layers.get(name)
+            if grid is not None:
+                self.layers.move_to_end(name)
+        if grid is not None:
+            self.hits += 1
+            return Grid2D.copyFromGrid(grid)
+        grid = self._load(name)
+        if grid is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            grid = quickcut(filename, gdict, precise=precise, method=method)
+            self._save(name, key, grid)
+        if self._keep(name, grid):
+            return Grid2D.copyFromGrid(grid)
+        return grid
+
+    def clear(self):
+        """
+        Remove all layers from memory, layers saved on disk are kept.
+        """
+        with self.lock:
+            self.layers.clear()
+            self.nbytes = 0
+
+    def _keep(self, name, grid):
+        """
+        Keep a layer in memory, dropping the least recently used ones.
+        Returns True if grid itself is kept.
+        """
+        nbytes = grid.getData().nbytes
+        if nbytes > self.maxbytes:
+            return False
+        with self.lock:
+            if name in self.layers:
+                return False
+            self.layers[name] = grid
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                oldname, oldgrid = self.layers.popitem(last=False)
+                self.nbytes -= oldgrid.getData().nbytes
+        return True
+
+    def _load(self, name):
+        """
+        Read a layer saved in cachedir, or return None.
+        """
+        if self.cachedir is None:
+            return None
+        base = os.path.join(self.cachedir, name)
+        try:
+            with open(base + '.json', 'r') as f:
+                gdict = GeoDict(json.load(f)['geodict'])
+            data = np.load(base + '.npy')
+            os.utime(base + '.npy', None)  # Mark as recently used
+        except Exception:
+            return None
+        return Grid2D(data, gdict)
+
+    def _save(self, name, key, grid):
+        """
+        Save a layer in cachedir and evict the least recently used layers
+        if the directory gets larger than maxdiskbytes.
+        """
+        if self.cachedir is None:
+            return
+        base = os.path.join(self.cachedir, name)
+        temp = '%s.%d.tmp' % (base, os.getpid())
+        gdict = grid.getGeoDict()
+        try:
+            # Written under temporary names first so that other runs never
+            # read partial files
+            np.save(temp + '.npy', grid.getData())
+            with open(temp + '.json', 'w') as f:
+                json.dump({'key': key, 'geodict': {
+                    'xmin': gdict.xmin, 'xmax': gdict.xmax,
+                    'ymin': gdict.ymin, 'ymax': gdict.ymax,
+                    'dx': gdict.dx, 'dy': gdict.dy,
+                    'nx': gdict.nx, 'ny': gdict.ny}}, f)
+            os.replace(temp + '.npy', base + '.npy')
+            os.replace(temp + '.json', base + '.json')
+        except Exception as e:
+            print('Could not save layer to cache directory: %s' % e)
+            return
+        files = []
+        for npyfile in glob.glob(os.path.join(self.cachedir, '*.npy')):
+            if npyfile.endswith('.tmp.npy'):
+                continue
+            try:
+                stat = os.stat(npyfile)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, npyfile))
+        total = sum(size for mtime, size, npyfile in files)
+        for mtime, size, npyfile in sorted(files):
+            if total <= self.maxdiskbytes:
+                break
+            for filename in [npyfile, npyfile[:-4] + '.json']:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            total -= size
+
+
+def getLayerKey(filename, gdict, method, precise):
+    """
+    Return the cache key of a resampled layer, or None if filename is not
+    the path of an existing file.
+    """
+    if not isinstance(filename, str) or not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_mtime, stat.st_size,
+            [gdict.xmin, gdict.xmax, gdict.ymin, gdict.ymax, gdict.dx,
+             gdict.dy, gdict.nx, gdict.ny], method, bool(precise)]
+
+
+_CACHE = [LayerCache()]
+
+
+def getLayerCache():
+    """
+    Return the layer cache used by the models of this process.
+    """
+    return _CACHE[0]
+
+
+def setLayerCache(maxbytes=MAXBYTES, cachedir=None,
+                  maxdiskbytes=MAXDISKBYTES):
+    """
+    Replace the layer cache used by the models of this process, see
+    LayerCache for the arguments.
+
+    Returns:
+        LayerCache: The new cache.
+    """
+    _CACHE[0] = LayerCache(maxbytes=maxbytes, cachedir=cachedir,
+                           maxdiskbytes=maxdiskbytes)
+    return _CACHE[0]
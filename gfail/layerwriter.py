@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Write ground failure layers to disk one tile at a time.
+
+Results are written to an HDF5 file with the layout of
+:func:`gfail.utilities.savelayers` (a MapIO MultiHazardGrid file), so they
+can be read back with :func:`gfail.utilities.loadlayers`, but the layers are
+chunked datasets filled as the tiles are computed, so the full grids never
+need to be held in memory.
+"""
+
+# stdlib imports
+import threading
+
+# third party imports
+import h5py
+import numpy as np
+
+
+#: Default number of rows and columns of the chunks of the layer datasets
+CHUNKSIZE = 256
+
+
+class LayerWriter(object):
+    def __init__(self, filename, geodict, layers, chunks=None):
+        """
+        Create the output file and its empty layers.
+
+        Args:
+            filename (str): Path to the hdf5 file to create, overwritten if
+                it exists.
+            geodict (GeoDict): Geodictionary of all layers.
+            layers (OrderedDict): Dictionary where keys are layer names and
+                values are dictionaries with the 'label', 'type' and
+                'description' of each layer, as in the ground failure layers
+                object without the 'grid' key.
+            chunks (tuple): Shape (rows, columns) of the chunks of the layer
+                datasets, by default CHUNKSIZE x CHUNKSIZE clipped to the
+                grid.
+        """
+        self.filename = filename
+        self.geodict = geodict
+        self.layers = layers
+        self.names = list(layers.keys())
+        self.ranges = dict([(name, [np.inf, -np.inf]) for name in layers])
+        self.lock = threading.Lock()
+        if chunks is None:
+            chunks = (CHUNKSIZE, CHUNKSIZE)
+        chunks = (max(1, min(chunks[0], geodict.ny)),
+                  max(1, min(chunks[1], geodict.nx)))
+
+        self.file = h5py.File(filename, 'w')
+        f = self.file
+        # Same attributes and groups as MultiHazardGrid.save
+        f.attrs['Conventions'] = 'COARDS, CF-1.5'
+        f.attrs['title'] = 'filename'
+        f.attrs['history'] = 'Created with python LayerWriter(%s)' % filename
+        f.attrs['GMT_version'] = 'NA'
+        f.create_group('header')
+        f.create_group('origin')
+        metadata = f.create_group('metadata')
+        for name, layer in layers.items():
+            _saveDict(metadata.create_group(name), {
+                'description': layer['description'],
+                'type': layer['type'],
+                'label': layer['label']})
+
+        xvar = np.linspace(geodict.xmin, geodict.xmax, geodict.nx)
+        yvar = np.linspace(geodict.ymin, geodict.ymax, geodict.ny)
+        for i, (dim, var) in enumerate([('x', xvar), ('y', yvar)]):
+            dset = f.create_dataset(dim, data=var, compression='gzip')
+            dset.attrs['CLASS'] = 'DIMENSION_SCALE'
+            dset.attrs['NAME'] = dim
+            dset.attrs['_Netcdf4Dimid'] = i
+            dset.attrs['long_name'] = dim
+            dset.attrs['actual_range'] = np.array((var[0], var[-1]))
+
+        for name in self.names:
+            dset = f.create_dataset(
+                name, shape=(geodict.ny, geodict.nx), dtype=np.float64,
+                chunks=chunks, compression='gzip', fillvalue=np.nan)
+            dset.attrs['long_name'] = name
+
+    def write(self, name, data, rowstart=None, rowend=None, colstart=None,
+              colend=None):
+        """
+        Write a tile of a layer. Can be called from several threads.
+
+        Args:
+            name (str): Name of the layer.
+            data (array): Values of the tile.
+            rowstart (int): First row of the tile, None for the first row of
+                the grid.
+            rowend (int): Row after the last row of the tile, None for the
+                end of the grid.
+            colstart (int): First column of the tile.
+            colend (int): Column after the last column of the tile.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.size and not np.isnan(data).all():
+            lo = np.nanmin(data)
+            hi = np.nanmax(data)
+        else:
+            lo = np.inf
+            hi = -np.inf
+        with self.lock:
+            self.file[name][rowstart:rowend, colstart:colend] = data
+            rng = self.ranges[name]
+            rng[0] = min(rng[0], lo)
+            rng[1] = max(rng[1], hi)
+
+    def close(self):
+        """
+        Record the range of each layer and close the file.
+        """
+        if self.file is None:
+            return
+        for name in self.names:
+            lo, hi = self.ranges[name]
+            if lo > hi:
+                lo = hi = np.nan
+            self.file[name].attrs['actual_range'] = np.array((lo, hi))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _saveDict(group, mydict):
+    """
+    Recursively save a dictionary as attributes and subgroups of an hdf5
+    group, as MultiHazardGrid does for metadata.
+    """
+    for key, value in mydict.items():
+        if isinstance(value, dict):
+            _saveDict(group.create_group(key), value)
+        else:
+            group.attrs[key] = value
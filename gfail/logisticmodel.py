@@ -13,18 +13,27 @@ import copy
 # from scipy import sparse
 import shutil
 import tempfile
+import json
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from timeit import default_timer as timer
 
 # third party imports
-from mapio.shake import ShakeGrid
-from mapio.shake import getHeaderData
-from mapio.gmt import GMTGrid
-from mapio.gdal import GDALGrid
 from mapio.grid2d import Grid2D
 from mapio.geodict import GeoDict
 
-from gfail.temphdf import TempHdf
-from gfail.spatial import quickcut, trim_ocean
+from gfail.temphdf import getTempStore, chooseBackend, BACKENDS
+from gfail.termcompiler import TermKernel
+from gfail.spatial import trim_ocean
+from gfail.landmask import getLandMask
+from gfail.layercache import getLayerCache
+from gfail.catalog import getCatalog
+from gfail.polygonstore import getFileKey
+from gfail.layerwriter import LayerWriter
+from gfail.shakecache import (getShakeHeader, getShakeGeoDict,
+                              loadShakeGrid, getShakeLayer)
 
 # temporary until mapio is updated
 import warnings
@@ -44,12 +53,16 @@ INTPAT = '[0-9]+'
 OPERATORPAT = '[\+\-\*\/]*'
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
           'Nov', 'Dec']
+EXECUTORS = ['thread', 'process']
+
+# Compiled kernel and layer stores of the model run by a worker process
+_WORKER = {}
 
 
 class LogisticModel(object):
     def __init__(self, shakefile, config, uncertfile=None, saveinputs=False,
                  slopefile=None, bounds=None, numstd=1, slopemod=None,
-                 trimfile=None):
+                 trimfile=None, store=None, stores=None):
         """
         Sets up the logistic model
 
@@ -82,6 +95,19 @@ class LogisticModel(object):
                 already).
             trimfile (str): shapefile of earth's landmasses to use to cut
                 offshore areas.
+            store (str): Where to keep the resampled layers, one of
+                'hdf5' (compressed temporary files), 'memory' (in RAM) or
+                'memmap' (uncompressed memory-mapped temporary files).
+                OVERWRITES VALUE IN CONFIG. If not given in either place,
+                'memory' is used when the layers fit in the available memory
+                and 'hdf5' otherwise.
+            stores (dict): Optional dictionary of layer stores shared by
+                several models (see :class:`gfail.batch.LogisticBatch`).
+                Layers that another model already stored with the same
+                file, grid, interpolation and clipping are reused instead of
+                being stored again, and new ones are added to it. The
+                temporary directories of all models sharing stores must be
+                kept until all of them are calculated.
         """
         mnames = getLogisticModelNames(config)
         if len(mnames) == 0:
@@ -109,6 +135,7 @@ class LogisticModel(object):
         self.numstd = numstd
         self.clips = validateClips(cmodel, self.layers, self.gmused)
         self.notes = ''
+        self.stores = stores
 
         if cmodel['baselayer'] not in list(self.layers.keys()):
             raise Exception('You must specify a base layer corresponding to '
@@ -145,11 +172,11 @@ class LogisticModel(object):
 
         # Get month of event
         griddict, eventdict, specdict, fields, uncertainties = \
-            getHeaderData(shakefile)
+            getShakeHeader(shakefile)
         MONTH = MONTHS[(eventdict['event_timestamp'].month) - 1]
 
         # Figure out how/if need to cut anything
-        geodict = ShakeGrid.getFileGeoDict(shakefile, adjust='res')
+        geodict = getShakeGeoDict(shakefile, adjust='res')
         if bounds is not None:  # Make sure bounds are within ShakeMap Grid
             if (geodict.xmin > bounds['xmin'] or
                     geodict.xmax < bounds['xmax'] or
@@ -172,20 +199,16 @@ class LogisticModel(object):
         basefile = self.layers[cmodel['baselayer']]
         ftype = getFileType(basefile)
         if ftype == 'esri':
-            basegeodict, firstcol = GDALGrid.getFileGeoDict(basefile)
-            if basegeodict == gdict:
-                sampledict = gdict
-            else:
-                sampledict = basegeodict.getBoundsWithin(gdict)
+            basegeodict, firstcol = getCatalog().getGeoDict(basefile, 'gdal')
         elif ftype == 'gmt':
-            basegeodict, firstcol = GMTGrid.getFileGeoDict(basefile)
-            if basegeodict == gdict:
-                sampledict = gdict
-            else:
-                sampledict = basegeodict.getBoundsWithin(gdict)
+            basegeodict, firstcol = getCatalog().getGeoDict(basefile, 'gmt')
         else:
             raise Exception('All predictor variable grids must be a valid '
                             'GMT or ESRI file type.')
+        if basegeodict == gdict:
+            sampledict = gdict
+        else:
+            sampledict = basegeodict.getBoundsWithin(gdict)
 
         # Do we need to subdivide baselayer?
         if 'divfactor' in self.config[self.model].keys():
@@ -220,42 +243,53 @@ class LogisticModel(object):
                 self.slopemin = 'none'
                 self.slopemax = 'none'
 
-        # Make temporary directory for hdf5 pytables file storage
+        # Choose where to store the resampled layers
+        if store is None and 'store' in cmodel:
+            store = cmodel['store']
+        if store is None:
+            nlayers = 2 + len(self.layers)
+            if uncertfile is not None:
+                nlayers += len(self.gmused)
+            store = chooseBackend(8 * nlayers * sampledict.nx * sampledict.ny)
+        if store not in BACKENDS:
+            raise Exception('store must be one of %s' % BACKENDS)
+        self.store = store
+
+        # Make temporary directory for layer storage
         self.tempdir = tempfile.mkdtemp()
 
         # now load the shakemap, resampling and padding if necessary
-        temp = ShakeGrid.load(shakefile)  # , adjust='res')
+        temp = loadShakeGrid(shakefile)  # , adjust='res')
         self.shakedict = temp.getShakeDict()
         self.eventdict = temp.getEventDict()
         self.shakemap = {}
+        gdictkey = tuple(sorted(sampledict.asDict().items()))
 
         # Read both PGA and PGV in, may need them for thresholds
         for gm in ['pga', 'pgv']:
-            junkfile = os.path.join(self.tempdir, 'temp.bil')
-            GDALGrid.copyFromGrid(temp.getLayer(gm)).save(junkfile)
             if gm in self.interpolations.keys():
                 intermeth = self.interpolations[gm]
             else:
                 intermeth = 'bilinear'
-            junkgrid = quickcut(junkfile, sampledict, precise=True,
-                                method=intermeth)
+            junkgrid = getShakeLayer(shakefile, gm, sampledict,
+                                     method=intermeth)
             if gm in self.clips:
                 junkgrid.setData(np.clip(junkgrid.getData(),
                                          self.clips[gm][0], self.clips[gm][1]))
-            self.shakemap[gm] = TempHdf(
-                junkgrid, os.path.join(self.tempdir, '%s.hdf5' % gm))
-            os.remove(junkfile)
+            self.shakemap[gm] = self._getTempStore(
+                junkgrid, gm, ('shakemap', intermeth, self.clips.get(gm),
+                               gdictkey))
         del(temp)
 
         # get updated geodict
         sampledict = junkgrid.getGeoDict()
+        gdictkey = tuple(sorted(sampledict.asDict().items()))
 
         # take uncertainties into account, if available
         if uncertfile is not None:
             self.uncert = {}
             try:
                 # Only read in the ones that will be needed
-                temp = ShakeGrid.load(uncertfile)
                 for gm in self.gmused:
                     if 'pgv' in gm:
                         gmsimp = 'pgv'
@@ -263,24 +297,20 @@ class LogisticModel(object):
                         gmsimp = 'pga'
                     elif 'mmi' in gm:
                         gmsimp = 'mmi'
-                    junkfile = os.path.join(self.tempdir, 'temp.bil')
-                    GDALGrid.copyFromGrid(temp.getLayer(
-                        'std%s' % gmsimp)).save(junkfile)
                     if gmsimp in self.interpolations.keys():
                         intermeth = self.interpolations[gmsimp]
                     else:
                         intermeth = 'bilinear'
-                    junkgrid = quickcut(junkfile, sampledict, precise=True,
-                                        method=intermeth)
+                    junkgrid = getShakeLayer(uncertfile, 'std%s' % gmsimp,
+                                             sampledict, method=intermeth)
                     if gmsimp in self.clips:
                         junkgrid.setData(
                             np.clip(junkgrid.getData(), self.clips[gmsimp][0],
                                     self.clips[gmsimp][1]))
-                    self.uncert['std' + gmsimp] = TempHdf(
-                        junkgrid, os.path.join(self.tempdir,
-                                               'std%s.hdf5' % gmsimp))
-                    os.remove(junkfile)
-                del(temp)
+                    self.uncert['std' + gmsimp] = self._getTempStore(
+                        junkgrid, 'std%s' % gmsimp,
+                        ('uncert', intermeth, self.clips.get(gmsimp),
+                         gdictkey))
             except:
                 print('Could not read uncertainty file, ignoring '
                       'uncertainties')
@@ -288,40 +318,62 @@ class LogisticModel(object):
         else:
             self.uncert = None
 
-        # Load the predictor layers, save as hdf5 temporary files, put file
-        # locations into a dictionary.
+        # Load the predictor layers and put them in temporary layer stores,
+        # kept in a dictionary.
 
         # Will be replaced in the next section if a slopefile was defined
         self.nonzero = None
 
+        # Use the precomputed static grids made by gfail_bake, if available
+        self.baked = None
+        if 'bakefile' in cmodel:
+            if saveinputs:
+                print('Input layers requested, not using baked grids')
+            elif timeField is not None:
+                print('Model has time dependent layers, not using baked '
+                      'grids')
+            else:
+                self.baked = readBake(
+                    cmodel['bakefile'],
+                    getBakeHash(self.terms, self.coeffs, self.layers,
+                                self.interpolations, self.clips))
+        looplayers = self.layers
+        if self.baked is not None:
+            # Only read the layers needed for thresholds
+            looplayers = dict([(layername, layerfile) for layername, layerfile
+                               in self.layers.items()
+                               if layername == 'vs30' and
+                               'vs30max' in cmodel])
+
         # key = layer name, value = grid object
         self.layerdict = {}
 
         didslope = False
-        for layername, layerfile in self.layers.items():
+        for layername, layerfile in looplayers.items():
             start = timer()
             if isinstance(layerfile, list):
-                for lfile in layerfile:
-                    if timeField == 'MONTH':
-                        if lfile.find(MONTH) > -1:
-                            layerfile = lfile
-                            ftype = getFileType(layerfile)
-                            interp = self.interpolations[layername]
-                            temp = quickcut(layerfile, sampledict,
-                                            precise=True, method=interp)
-                            if layername in self.clips:
-                                temp.setData(
-                                    np.clip(temp.getData(),
-                                            self.clips[layername][0],
-                                            self.clips[layername][1]))
-                            self.layerdict[layername] = TempHdf(
-                                temp, os.path.join(self.tempdir,
-                                                   '%s.hdf5' % layername))
-                            del(temp)
+                if timeField == 'MONTH':
+                    layerfile = getCatalog().getTimeFiles(
+                        layerfile, MONTHS).get(MONTH)
+                    if layerfile is not None:
+                        interp = self.interpolations[layername]
+                        temp = getLayerCache().quickcut(
+                            layerfile, sampledict, precise=True,
+                            method=interp)
+                        if layername in self.clips:
+                            temp.setData(
+                                np.clip(temp.getData(),
+                                        self.clips[layername][0],
+                                        self.clips[layername][1]))
+                        self.layerdict[layername] = self._getTempStore(
+                            temp, layername,
+                            ('layerdict', layerfile, interp,
+                             self.clips.get(layername), gdictkey))
+                        del(temp)
             else:
                 interp = self.interpolations[layername]
-                temp = quickcut(layerfile, sampledict,
-                                precise=True, method=interp)
+                temp = getLayerCache().quickcut(
+                    layerfile, sampledict, precise=True, method=interp)
                 if layername in self.clips:
                     temp.setData(
                         np.clip(temp.getData(),
@@ -332,8 +384,10 @@ class LogisticModel(object):
                     sub1[sub1 <= -3.21] = -1.36  # Change to mixed sedimentary rock coeff
                     temp.setData(sub1)
                     self.notes += 'unconsolidated sediment coefficient changed to -1.36 (weaker) from -3.22 to better reflect that this unit is not actually strong\n'
-                self.layerdict[layername] = TempHdf(
-                    temp, os.path.join(self.tempdir, '%s.hdf5' % layername))
+                self.layerdict[layername] = self._getTempStore(
+                    temp, layername,
+                    ('layerdict', layerfile, interp,
+                     self.clips.get(layername), gdictkey))
                 td = temp.getGeoDict()
                 if td != sampledict:
                     raise Exception(
@@ -373,10 +427,27 @@ class LogisticModel(object):
             print('Loading %s layer: %1.1f sec'
                   % (layername, timer() - start))
 
+        if self.baked is not None:
+            bakedgrids = [('baked_static', self.baked['static'])]
+            for i, factor in enumerate(self.baked['factors']):
+                if 'file' in factor:
+                    bakedgrids.append(('baked_coeff%d' % i, factor['file']))
+            for layername, layerfile in bakedgrids:
+                start = timer()
+                temp = getLayerCache().quickcut(
+                    layerfile, sampledict, precise=True, method='bilinear')
+                self.layerdict[layername] = self._getTempStore(
+                    temp, layername,
+                    ('layerdict', layerfile, 'bilinear', None, gdictkey))
+                del(temp)
+                print('Loading %s layer: %1.1f sec'
+                      % (layername, timer() - start))
+            self.notes += self.baked['notes']
+
         if didslope is False and self.slopefile is not None:
             # Slope didn't get read in yet
-            temp = quickcut(self.slopefile, sampledict, precise=True,
-                            method='bilinear')
+            temp = getLayerCache().quickcut(
+                self.slopefile, sampledict, precise=True, method='bilinear')
             flag = 0
             if self.slopemin == 'none' and self.slopemax == 'none':
                 flag = 1
@@ -404,14 +475,21 @@ class LogisticModel(object):
                 self.nonzero = nonzero[0, :, :]
                 del(slope1)
 
-        self.nuggets = [str(self.coeffs['b0'])]
-
-        ckeys = list(self.terms.keys())
-        ckeys.sort()
-        for key in ckeys:
-            term = self.terms[key]
-            coeff = self.coeffs[key]
-            self.nuggets.append('(%g * %s)' % (coeff, term))
+        if self.baked is not None:
+            # Static part plus the shaking factors times their coefficients
+            self.nuggets = [
+                "self.layerdict['baked_static'].getSlice(rowstart, rowend, "
+                "colstart, colend, name='baked_static')"]
+            for i, factor in enumerate(self.baked['factors']):
+                if 'file' in factor:
+                    coeff = ("self.layerdict['baked_coeff%d'].getSlice("
+                             "rowstart, rowend, colstart, colend, "
+                             "name='baked_coeff%d')" % (i, i))
+                else:
+                    coeff = repr(factor['value'])
+                self.nuggets.append('(%s * %s)' % (coeff, factor['factor']))
+        else:
+            self.nuggets = getNuggets(self.terms, self.coeffs)
 
         self.equation = ' + '.join(self.nuggets)
 
@@ -446,6 +524,12 @@ class LogisticModel(object):
             self.equationmin = None
             self.equationmax = None
 
+        # Compile the equations into a single kernel that reads each layer
+        # once per tile and shares terms between the median, min and max
+        self.kernel = TermKernel(
+            [self.equation, self.equationmin, self.equationmax],
+            scope={'self': self, 'np': np})
+
         self.geodict = sampledict
 
     def getEquations(self):
@@ -473,7 +557,120 @@ class LogisticModel(object):
         """
         return self.geodict
 
-    def calculate(self, cleanup=True, rowmax=300, colmax=None):
+    def getExclusionMask(self, tile=None):
+        """
+        Returns the cells where the model is set to zero before the coverage
+        equation is applied, because of the vs30max, minpgv or minpga limits
+        of the model.
+
+        Args:
+            tile (tuple): (rowstart, rowend, colstart, colend) of the part of
+                the grid to return, None for the whole grid.
+
+        Returns:
+            array: Boolean array, or None if the model has none of these
+            limits.
+        """
+        if tile is None:
+            tile = (None, None, None, None)
+        cmodel = self.config[self.model]
+        exclude = None
+        if 'vs30max' in cmodel.keys():
+            vs30 = self.layerdict['vs30'].getSlice(*tile, name='vs30')
+            exclude = _union(exclude, vs30 > float(cmodel['vs30max']))
+        if 'minpgv' in cmodel.keys():
+            pgv = self.shakemap['pgv'].getSlice(*tile, name='pgv')
+            exclude = _union(exclude, pgv < float(cmodel['minpgv']))
+        if 'minpga' in cmodel.keys():
+            pga = self.shakemap['pga'].getSlice(*tile, name='pga')
+            exclude = _union(exclude, pga < float(cmodel['minpga']))
+        return exclude
+
+    def getEvaluationMask(self, tile=None):
+        """
+        Returns the cells where the model equation needs to be evaluated,
+        i.e., the cells that are neither excluded by getExclusionMask nor by
+        the slope thresholds.
+
+        Args:
+            tile (tuple): (rowstart, rowend, colstart, colend) of the part of
+                the grid to return, None for the whole grid.
+
+        Returns:
+            array: Boolean array.
+        """
+        if tile is None:
+            tile = (None, None, None, None)
+        keep = np.ones(_getTileShape(tile, self.geodict), dtype=bool)
+        exclude = self.getExclusionMask(tile)
+        if exclude is not None:
+            keep &= ~exclude
+        if self.slopefile is not None and self.nonzero is not None:
+            keep &= self.nonzero[_getTileIndex(tile)]
+        return keep
+
+    def _getProbability(self, X, exclude, keep=None):
+        """
+        Apply the logistic function, the limits of getExclusionMask and the
+        coverage equation of the model (if any) to an evaluated equation.
+        If keep (see getEvaluationMask) is given, only those cells are
+        computed and the other cells get the value the limits give them.
+        """
+        if keep is None:
+            P = 1/(1 + np.exp(-X))
+            if exclude is not None:
+                P[exclude] = 0.0
+            return self._getCoverage(P)
+        P = np.zeros(X.shape)
+        P[keep] = self._getCoverage(1/(1 + np.exp(-X[keep])))
+        if exclude is not None:
+            P[exclude] = self._getCoverage(np.zeros(1))[0]
+        return P
+
+    def _getCoverage(self, P):
+        """
+        Apply the coverage equation of the model, if any, to probabilities P.
+        """
+        if 'coverage' in self.config[self.model].keys():
+            eqn = self.config[self.model]['coverage']['eqn']
+            P = eval(eqn)
+        return P
+
+    def _getTempStore(self, grid, name, key):
+        """
+        Put a layer in a temporary layer store, or return the store of the
+        same layer if another model sharing stores already made it.
+
+        Args:
+            grid: grid2d object of the layer.
+            name (str): Name of the layer in the store.
+            key (tuple): Description of how the layer was made (source, file,
+                interpolation, clipping and grid), used to identify layers
+                shared by several models.
+
+        Returns:
+            TempStore: Layer store.
+        """
+        key = (name,) + key
+        if self.stores is not None and key in self.stores:
+            return self.stores[key]
+        store = getTempStore(
+            grid, os.path.join(self.tempdir, '%s.hdf5' % name),
+            backend=self.store)
+        if self.stores is not None:
+            self.stores[key] = store
+        return store
+
+    def _getStores(self):
+        """
+        Returns the layer stores read by the compiled kernel, keyed by the
+        name of the attribute that holds them (e.g., 'layerdict').
+        """
+        sources = set([leaf[0] for leaf in self.kernel.getLeaves()])
+        return dict([(source, getattr(self, source)) for source in sources])
+
+    def calculate(self, cleanup=True, rowmax=300, colmax=None, nworkers=1,
+                  executor='thread', sparse=False, outfile=None):
         """
         Calculate the model.
 
@@ -483,103 +680,177 @@ class LogisticModel(object):
                 will be computed at once.
             colmax (int): Number of columns to compute at once; If None, all
                 columns will be computed at once.
+            nworkers (int): Number of tiles to compute concurrently; If 1,
+                tiles are computed one after the other.
+            executor (str): Either 'thread' (tiles computed by a pool of
+                threads) or 'process' (tiles computed by a pool of processes,
+                each reading the layers on its own). Only used if
+                nworkers > 1.
+            sparse (bool): If True, the limits of the model (vs30max, minpga,
+                minpgv and slope limits) are applied before the equations
+                are evaluated, so excluded cells are never computed and
+                tiles without any remaining cell are skipped. Results are
+                the same except at cells excluded by the slope limits, which
+                are 0 instead of nan.
+            outfile (str): If given, each tile of the results is written to
+                this hdf5 file as soon as it is computed, in the format of
+                :func:`gfail.utilities.savelayers`, instead of being
+                returned, so the full grids are never held in memory.
         Returns:
             dict: Dictionary containing the model results (and model inputs if
             saveinputs was set to True). See
             `the description <https://github.com/usgs/groundfailure#api-for-model-output>`_
-            of the structure.
+            of the structure. If outfile was given, the path of outfile
+            instead.
         """
         tk = list(self.shakemap.keys())[0]
         # Figure out what slices to do
         rowstarts, rowends, colstarts, colends = \
             self.shakemap[tk].getSliceDiv(rowmax, colmax)
+        tiles = list(zip(rowstarts, rowends, colstarts, colends))
+        mask = self.getEvaluationMask() if sparse else None
 
-        # Make empty matrix to fill
+        if outfile is not None:
+            writer = self.openWriter(outfile)
+            lock = threading.RLock()
+            try:
+                def write(tile, results):
+                    with lock:
+                        self.writeTile(writer, tile, results, sparse=sparse)
+
+                runTiles(tiles, self.kernel, self._getStores(), write,
+                         nworkers=nworkers, executor=executor, mask=mask,
+                         lock=lock)
+                if mask is not None:
+                    # Tiles skipped by runTiles still need their zeros
+                    for tile in tiles:
+                        if not mask[_getTileIndex(tile)].any():
+                            self.writeTile(writer, tile, [None, None, None],
+                                           sparse=sparse)
+            finally:
+                writer.close()
+                if cleanup:
+                    shutil.rmtree(self.tempdir)
+            return outfile
+
+        # Make empty matrices to fill
         X = np.empty([self.geodict.ny, self.geodict.nx])
+        if self.uncert is not None:
+            Xmin = np.empty([self.geodict.ny, self.geodict.nx])
+            Xmax = Xmin.copy()
+        else:
+            Xmin = None
+            Xmax = None
 
-        # Loop through slices, appending output each time
-        for rowstart, rowend, colstart, colend in \
-                zip(rowstarts, rowends, colstarts, colends):
-            X[rowstart:rowend, colstart:colend] = eval(self.equation)
+        def fill(tile, results):
+            rowstart, rowend, colstart, colend = tile
+            x, xmin, xmax = results
+            X[rowstart:rowend, colstart:colend] = x
+            if self.uncert is not None:
+                Xmin[rowstart:rowend, colstart:colend] = xmin
+                Xmax[rowstart:rowend, colstart:colend] = xmax
 
-        P = 1/(1 + np.exp(-X))
+        # Evaluate all equations of each slice in a single pass
+        runTiles(tiles, self.kernel, self._getStores(), fill,
+                 nworkers=nworkers, executor=executor, mask=mask)
+        return self.finalize(X, Xmin, Xmax, cleanup=cleanup, sparse=sparse)
 
-        if 'vs30max' in self.config[self.model].keys():
-            vs30 = self.layerdict['vs30'].getSlice(
-                None, None, None, None, name='vs30')
-            P[vs30 > float(self.config[self.model]['vs30max'])] = 0.0
+    def finalize(self, X, Xmin=None, Xmax=None, cleanup=True, sparse=False):
+        """
+        Turn the evaluated model equations into probabilities, apply the
+        thresholds of the model and build the output dictionary. Used by
+        calculate, and by :class:`gfail.batch.LogisticBatch` which evaluates
+        the equations of several models at once.
 
-        if 'minpgv' in self.config[self.model].keys():
-            pgv = self.shakemap['pgv'].getSlice(
-                None, None, None, None, name='pgv')
-            P[pgv < float(self.config[self.model]['minpgv'])] = 0.0
+        Args:
+            X (array): Model equation evaluated over the model grid.
+            Xmin (array): Same as X for the min equation, if uncertainties
+                were given.
+            Xmax (array): Same as X for the max equation, if uncertainties
+                were given.
+            cleanup (bool): If True, delete temporary hdf5 files
+            sparse (bool): If True, X, Xmin and Xmax only need to be valid
+                where getEvaluationMask is True.
 
-        if 'minpga' in self.config[self.model].keys():
-            pga = self.shakemap['pga'].getSlice(
-                None, None, None, None, name='pga')
-            P[pga < float(self.config[self.model]['minpga'])] = 0.0
+        Returns:
+            dict: Dictionary containing the model results, see calculate.
+        """
+        if self.slopefile is not None and self.nonzero is not None:
+            print('applying slope thresholds')
+        info = self.getOutputInfo()
+        layers = self._getOutputLayers(
+            info, (None, None, None, None), [X, Xmin, Xmax], sparse)
 
-        if 'coverage' in self.config[self.model].keys():
-            eqn = self.config[self.model]['coverage']['eqn']
-            P = eval(eqn)
+        # Stuff into Grid2D objects
+        rdict = collections.OrderedDict()
+        for name, layer in info.items():
+            grid = Grid2D(layers.pop(name), self.geodict)
+            if layer['type'] == 'output' and self.trimfile is not None:
+                # Turn all offshore cells to nan
+                grid = trim_ocean(grid, self.trimfile, nodata=float('nan'),
+                                  inplace=True)
+            rdict[name] = {
+                'grid': grid,
+                'label': layer['label'],
+                'type': layer['type'],
+                'description': layer['description']
+            }
+        if cleanup:
+            shutil.rmtree(self.tempdir)
+        return rdict
 
-        if self.uncert is not None:
-            # Make empty matrix to fill
-            Xmin = np.empty([self.geodict.ny, self.geodict.nx])
-            Xmax = Xmin.copy()
-            # Loop through slices, appending output each time
-            for rowstart, rowend, colstart, colend in \
-                    zip(rowstarts, rowends, colstarts, colends):
-                Xmin[rowstart:rowend, colstart:colend] = eval(self.equationmin)
-                Xmax[rowstart:rowend, colstart:colend] = eval(self.equationmax)
-
-            Pmin = 1/(1 + np.exp(-Xmin))
-            Pmax = 1/(1 + np.exp(-Xmax))
-
-            if 'vs30max' in self.config[self.model].keys():
-                vs30 = self.layerdict['vs30'].getSlice(
-                    None, None, None, None, name='vs30')
-                Pmin[vs30 > float(self.config[self.model]['vs30max'])] = 0.0
-                Pmax[vs30 > float(self.config[self.model]['vs30max'])] = 0.0
-
-            if 'minpgv' in self.config[self.model].keys():
-                pgv = self.shakemap['pgv'].getSlice(
-                    None, None, None, None, name='pgv')
-                Pmin[pgv < float(self.config[self.model]['minpgv'])] = 0.0
-                Pmax[pgv < float(self.config[self.model]['minpgv'])] = 0.0
-
-            if 'minpga' in self.config[self.model].keys():
-                pga = self.shakemap['pgv'].getSlice(
-                    None, None, None, None, name='pga')
-                Pmin[pga < float(self.config[self.model]['minpga'])] = 0.0
-                Pmax[pga < float(self.config[self.model]['minpga'])] = 0.0
-
-            if 'coverage' in self.config[self.model].keys():
-                eqnmin = eqn.replace('P', 'Pmin')
-                eqnmax = eqn.replace('P', 'Pmax')
-                Pmin = eval(eqnmin)
-                Pmax = eval(eqnmax)
-
-            #Pmin[np.isnan(Pmin)] = 0.0
-            #Pmax[np.isnan(Pmax)] = 0.0
-
-        #P[np.isnan(P)] = 0.0
+    def openWriter(self, outfile):
+        """
+        Create the output file of a streamed calculation, see calculate.
 
+        Args:
+            outfile (str): Path to the hdf5 file to create.
+
+        Returns:
+            LayerWriter: Writer of the output layers of the model, to be
+            filled with writeTile and closed by the caller.
+        """
         if self.slopefile is not None and self.nonzero is not None:
-            # Apply slope min/max limits
             print('applying slope thresholds')
-            P = P * self.nonzero
-            #P[P==0.0] = float('nan')
-            #P[np.isnan(P)] = 0.0
-            if self.uncert is not None:
-                Pmin = Pmin * self.nonzero
-                Pmax = Pmax * self.nonzero
-                #Pmin[Pmin==0.0] = float('nan')
-                #Pmax[Pmax==0.0] = float('nan')
-                #Pmin[np.isnan(Pmin)] = 0.0
-                #Pmax[np.isnan(Pmax)] = 0.0
-
-        # Stuff into Grid2D object
+        return LayerWriter(outfile, self.geodict, self.getOutputInfo())
+
+    def writeTile(self, writer, tile, results, sparse=False):
+        """
+        Turn the evaluated model equations of one tile into probabilities,
+        apply the thresholds of the model and write all output layers of the
+        tile.
+
+        Args:
+            writer (LayerWriter): Writer returned by openWriter.
+            tile (tuple): (rowstart, rowend, colstart, colend) of the tile.
+            results (list): Model equation, min and max equation evaluated
+                over the tile (None for equations that were not evaluated).
+            sparse (bool): If True, results only need to be valid where
+                getEvaluationMask is True.
+        """
+        layers = self._getOutputLayers(writer.layers, tile, results, sparse)
+        outside = None
+        for name, layer in writer.layers.items():
+            data = layers[name]
+            if layer['type'] == 'output' and self.trimfile is not None:
+                # Offshore cells of the tile, from the mask of the full grid
+                # that is rasterized once and shared by all tiles
+                if outside is None:
+                    outside = getLandMask().getMask(
+                        self.trimfile, self.geodict)[_getTileIndex(tile)]
+                data = np.where(outside, np.nan, data)
+            writer.write(name, data, *tile)
+
+    def getOutputInfo(self):
+        """
+        Returns the label, type and description of each layer output by the
+        model.
+
+        Returns:
+            OrderedDict: Dictionary where keys are the names of the layers
+            in the output of calculate and values are dictionaries with the
+            'label', 'type' and 'description' of each layer.
+        """
         if 'Jessee' in self.modelrefs['shortref']:
             if 'coverage' not in self.config[self.model].keys():
                 units5 = 'Relative Hazard'
@@ -609,28 +880,15 @@ class LogisticModel(object):
         if 'minpgv' in self.config[self.model].keys():
             description['minpgv'] = float(self.config[self.model]['minpgv'])
 
-        Pgrid = Grid2D(P, self.geodict)
-        if self.trimfile is not None:
-            # Turn all offshore cells to nan
-            Pgrid = trim_ocean(Pgrid, self.trimfile, nodata=float('nan'))
-        rdict = collections.OrderedDict()
-        rdict['model'] = {
-            'grid': Pgrid,
+        info = collections.OrderedDict()
+        info['model'] = {
             'label': ('%s %s') % (self.modeltype.capitalize(),
                                   units5.title()),
             'type': 'output',
             'description': description
         }
         if self.uncert is not None:
-            Pmingrid = Grid2D(Pmin, self.geodict)
-            Pmaxgrid = Grid2D(Pmax, self.geodict)
-            if self.trimfile is not None:
-                Pmingrid = trim_ocean(
-                    Pmingrid, self.trimfile, nodata=float('nan'))
-                Pmaxgrid = trim_ocean(
-                    Pmaxgrid, self.trimfile, nodata=float('nan'))
-            rdict['modelmin'] = {
-                'grid': Pmingrid,
+            info['modelmin'] = {
                 'label': ('%s %s (-%0.1f std ground motion)'
                           % (self.modeltype.capitalize(),
                              units5.title(),
@@ -638,8 +896,7 @@ class LogisticModel(object):
                 'type': 'output',
                 'description': description
             }
-            rdict['modelmax'] = {
-                'grid': Pmaxgrid,
+            info['modelmax'] = {
                 'label': ('%s %s (+%0.1f std ground motion)'
                           % (self.modeltype.capitalize(),
                              units5.title(),
@@ -650,16 +907,11 @@ class LogisticModel(object):
 
         # This step might swamp memory for higher resolution runs
         if self.saveinputs is True:
-            for layername, layergrid in list(self.layerdict.items()):
+            for layername in list(self.layerdict.keys()):
                 units = self.units[layername]
                 if units is None:
                     units = ''
-                rdict[layername] = {
-                    'grid': Grid2D(
-                        layergrid.getSlice(
-                            None, None, None, None, name=layername),
-                        self.geodict
-                    ),
+                info[layername] = {
                     'label': '%s (%s)' % (layername, units),
                     'type': 'input',
                     'description': {
@@ -683,13 +935,10 @@ class LogisticModel(object):
                     # Layer is derived from several input layers, skip
                     # outputting this layer
 
-                if getkey in rdict:
+                if getkey in info:
                     continue
 
-                layer = self.shakemap[getkey].getSlice(
-                    None, None, None, None, name=getkey)
-                rdict[getkey] = {
-                    'grid': Grid2D(layer, self.geodict),
+                info[getkey] = {
                     'label': '%s (%s)' % (getkey.upper(), units),
                     'type': 'input',
                     'description': {
@@ -698,11 +947,7 @@ class LogisticModel(object):
                     }
                 }
                 if self.uncert is not None:
-                    uncertlayer = self.uncert[getkey].getSlice(
-                        None, None, None, None, name='std'+getkey)
-                    layer1 = np.exp(np.log(layer) - uncertlayer)
-                    rdict[getkey + 'modelmin'] = {
-                        'grid': Grid2D(layer1, self.geodict),
+                    info[getkey + 'modelmin'] = {
                         'label': ('%s - %0.1f std (%s)'
                                   % (getkey.upper(),
                                      self.numstd, units)),
@@ -710,9 +955,7 @@ class LogisticModel(object):
                         'description': {'units': units,
                                         'shakemap': shakedetail}
                     }
-                    layer2 = np.exp(np.log(layer) + uncertlayer)
-                    rdict[getkey + 'modelmax'] = {
-                        'grid': Grid2D(layer2, self.geodict),
+                    info[getkey + 'modelmax'] = {
                         'label': ('%s + %0.1f std (%s)'
                                   % (getkey.upper(),
                                      self.numstd, units)),
@@ -720,9 +963,145 @@ class LogisticModel(object):
                         'description': {'units': units,
                                         'shakemap': shakedetail}
                     }
-        if cleanup:
-            shutil.rmtree(self.tempdir)
-        return rdict
+        return info
+
+    def _getOutputLayers(self, info, tile, results, sparse=False):
+        """
+        Compute the data of the output layers listed in info (see
+        getOutputInfo) over a tile of the grid from the evaluated model
+        equations of the tile.
+        """
+        X, Xmin, Xmax = results
+        shape = _getTileShape(tile, self.geodict)
+        exclude = self.getExclusionMask(tile)
+        keep = self.getEvaluationMask(tile) if sparse else None
+        nonzero = None
+        if self.slopefile is not None and self.nonzero is not None:
+            nonzero = self.nonzero[_getTileIndex(tile)]
+
+        layers = {}
+        for name, x in [('model', X), ('modelmin', Xmin),
+                        ('modelmax', Xmax)]:
+            if name not in info:
+                continue
+            if x is None:
+                x = np.full(shape, np.nan)
+            P = self._getProbability(x, exclude, keep)
+            if nonzero is not None:
+                # Apply slope min/max limits
+                P = P * nonzero
+            layers[name] = P
+
+        for name, layer in info.items():
+            if layer['type'] != 'input':
+                continue
+            if name in self.layerdict:
+                layers[name] = self.layerdict[name].getSlice(*tile, name=name)
+                continue
+            getkey = name.replace('modelmin', '').replace('modelmax', '')
+            data = self.shakemap[getkey].getSlice(*tile, name=getkey)
+            if name != getkey:
+                uncertlayer = self.uncert['std' + getkey].getSlice(
+                    *tile, name='std' + getkey)
+                if name.endswith('modelmin'):
+                    data = np.exp(np.log(data) - uncertlayer)
+                else:
+                    data = np.exp(np.log(data) + uncertlayer)
+            layers[name] = data
+        return layers
+
+
+def getNuggets(terms, coeffs):
+    """
+    Get the nuggets of a model equation, i.e., the intercept and each term
+    multiplied by its coefficient, which are added together to form the
+    equation.
+
+    Args:
+        terms (dict): Dictionary of terms output by validateTerms.
+        coeffs (dict): Dictionary of coefficients output by
+            validateCoefficients.
+
+    Returns:
+        list: List of equation strings.
+    """
+    nuggets = [str(coeffs['b0'])]
+    ckeys = list(terms.keys())
+    ckeys.sort()
+    for key in ckeys:
+        term = terms[key]
+        coeff = coeffs[key]
+        nuggets.append('(%g * %s)' % (coeff, term))
+    return nuggets
+
+
+def getBakeHash(terms, coeffs, layers, interpolations, clips):
+    """
+    Get a hash identifying everything that goes into the static grids of a
+    model made by gfail_bake (see :mod:`gfail.bake`), so stale grids can be
+    detected.
+
+    Args:
+        terms (dict): Dictionary of terms output by validateTerms.
+        coeffs (dict): Dictionary of coefficients output by
+            validateCoefficients.
+        layers (dict): Dictionary of layer files output by validateLayers.
+        interpolations (dict): Dictionary of interpolation methods output by
+            validateInterpolations.
+        clips (dict): Dictionary of clip values output by validateClips.
+
+    Returns:
+        str: md5 hash of the model inputs.
+    """
+    # Layer files are identified by path, modification time and size, so
+    # layers updated in place with the same dimensions are detected
+    files = {}
+    for layername, layerfile in layers.items():
+        if isinstance(layerfile, list):
+            files[layername] = [list(getFileKey(lfile))
+                                for lfile in layerfile]
+        else:
+            files[layername] = list(getFileKey(layerfile))
+    params = {
+        'terms': dict(terms),
+        'coeffs': dict(coeffs),
+        'layers': files,
+        'interpolations': dict(interpolations),
+        'clips': dict([(key, list(value)) for key, value in clips.items()])
+    }
+    params = json.dumps(params, sort_keys=True)
+    return hashlib.md5(params.encode('utf-8')).hexdigest()
+
+
+def readBake(bakefile, bakehash):
+    """
+    Read the manifest of the static grids of a model made by gfail_bake.
+
+    Args:
+        bakefile (str): Path to the manifest (json) file.
+        bakehash (str): Hash of the current model inputs, output by
+            getBakeHash.
+
+    Returns:
+        dict: The manifest, with absolute paths to the grids, or None if the
+        manifest does not exist or the grids were made from different model
+        inputs.
+    """
+    if not os.path.exists(bakefile):
+        print('bakefile %s does not exist, not using baked grids' % bakefile)
+        return None
+    with open(bakefile, 'r') as f:
+        manifest = json.load(f)
+    if manifest['hash'] != bakehash:
+        print('Model inputs changed since %s was made, not using baked '
+              'grids' % bakefile)
+        return None
+    bakedir = os.path.dirname(os.path.abspath(bakefile))
+    manifest['static'] = os.path.join(bakedir, manifest['static'])
+    for factor in manifest['factors']:
+        if 'file' in factor:
+            factor['file'] = os.path.join(bakedir, factor['file'])
+    return manifest
 
 
 def getLogisticModelNames(config):
@@ -748,6 +1127,7 @@ def getLogisticModelNames(config):
 def getFileType(filename):
     """
     Determine whether input file is a shapefile or a grid (ESRI or GMT).
+    Files are probed once, see gfail.catalog.LayerCatalog.
 
     Args:
         filename (str): Path to candidate filename.
@@ -755,21 +1135,7 @@ def getFileType(filename):
     Returns:
         str: 'shapefile', 'grid', or 'unknown'.
     """
-    #TODO MOVE TO MAPIO.
-    if os.path.isdir(filename):
-        return 'dir'
-    ftype = GMTGrid.getFileType(filename)
-    if ftype != 'unknown':
-        return 'gmt'
-    # Skip over ESRI header files
-    if filename.endswith('.hdr'):
-        return 'unknown'
-    try:
-        GDALGrid.getFileGeoDict(filename)
-        return 'esri'
-    except:
-        pass
-    return 'unknown'
+    return getCatalog().getFileType(filename)
 
 
 def getAllGridFiles(indir):
@@ -781,15 +1147,7 @@ def getAllGridFiles(indir):
     Returns:
         list: List of file names.
     """
-    #TODO MOVE TO MAPIO
-    tflist = os.listdir(indir)
-    flist = []
-    for tf in tflist:
-        fullfile = os.path.join(indir, tf)
-        ftype = getFileType(fullfile)
-        if ftype in ['gmt', 'esri']:
-            flist.append(fullfile)
-    return flist
+    return getCatalog().getGridFiles(indir)
 
 
 def validateCoefficients(cmodel):
@@ -1087,6 +1445,151 @@ def validateRefs(cmodel):
     return modelrefs, longrefs, shortrefs
 
 
+def runTiles(tiles, kernel, stores, fill, nworkers=1, executor='thread',
+             mask=None, lock=None):
+    """
+    Evaluate a compiled kernel over tiles of the model grid.
+
+    Args:
+        tiles (list): List of (rowstart, rowend, colstart, colend) tuples.
+        kernel (TermKernel): Compiled equations.
+        stores (dict): Layer stores keyed by the source names used by the
+            kernel, each a dictionary of TempStore objects.
+        fill (function): Function called as ``fill(tile, results)`` with the
+            list of kernel outputs of each tile, in any order.
+        nworkers (int): Number of tiles to compute concurrently; If 1,
+            tiles are computed one after the other.
+        executor (str): Either 'thread' or 'process', see
+            LogisticModel.calculate. Only used if nworkers > 1.
+        mask (array): Optional boolean array of the cells to evaluate, the
+            other cells of the outputs are nan. Tiles without any of these
+            cells are not read.
+        lock: Lock held by the threads while reading the layers, for callers
+            whose fill function reads layers too. By default a lock is only
+            used if some layers cannot be read by several threads at once.
+    """
+    if mask is not None:
+        tiles = [tile for tile in tiles if mask[_getTileIndex(tile)].any()]
+    if nworkers is None or nworkers < 2 or len(tiles) < 2:
+        for tile in tiles:
+            fill(*_evaluateTile(tile, kernel, stores, mask=mask))
+    elif executor == 'thread':
+        # Computations release the GIL, but hdf5 reads must not overlap
+        for source in stores.values():
+            if lock is None and not all([layer.threadsafe
+                                         for layer in source.values()]):
+                lock = threading.Lock()
+
+        def work(tile):
+            fill(*_evaluateTile(tile, kernel, stores, lock, mask))
+
+        pool = ThreadPool(min(nworkers, len(tiles)))
+        try:
+            pool.map(work, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    elif executor == 'process':
+        pool = multiprocessing.Pool(min(nworkers, len(tiles)),
+                                    initializer=_initWorker,
+                                    initargs=(kernel, stores, mask))
+        try:
+            for tile, results in pool.imap_unordered(_evaluateTile, tiles):
+                fill(tile, results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        raise Exception('executor must be one of %s' % EXECUTORS)
+
+
+def _initWorker(kernel, stores, mask=None):
+    """
+    Set the compiled kernel, the layer stores and the mask used by
+    _evaluateTile in the current process.
+    """
+    _WORKER['kernel'] = kernel
+    _WORKER['stores'] = stores
+    _WORKER['mask'] = mask
+
+
+def _evaluateTile(tile, kernel=None, stores=None, lock=None, mask=None):
+    """
+    Evaluate a compiled kernel over one tile.
+
+    Args:
+        tile (tuple): (rowstart, rowend, colstart, colend) of the tile.
+        kernel (TermKernel): Compiled equations; if None, uses the kernel
+            set by _initWorker.
+        stores (dict): Layer stores keyed by the source names used by the
+            kernel; if None, uses the stores set by _initWorker.
+        lock: Lock held while reading the layers, if not None.
+        mask (array): Optional boolean array of the cells to evaluate, only
+            these cells are gathered from the layers and the other cells of
+            the results are nan.
+
+    Returns:
+        tuple: (tile, results) where results is the list returned by
+        kernel.evaluate.
+    """
+    if kernel is None:
+        kernel = _WORKER['kernel']
+        stores = _WORKER['stores']
+        mask = _WORKER['mask']
+    rowstart, rowend, colstart, colend = tile
+    if mask is not None:
+        mask = mask[_getTileIndex(tile)]
+
+    def fetch(source, key, name):
+        layer = stores[source][key]
+        if lock is None:
+            data = layer.getSlice(rowstart, rowend, colstart, colend,
+                                  name=name)
+        else:
+            with lock:
+                data = layer.getSlice(rowstart, rowend, colstart, colend,
+                                      name=name)
+        if mask is not None:
+            data = data[mask]
+        return data
+
+    results = kernel.evaluate(fetch)
+    if mask is not None:
+        # Scatter the evaluated cells back into the tile
+        for i, result in enumerate(results):
+            if result is not None:
+                results[i] = np.full(mask.shape, np.nan)
+                results[i][mask] = result
+    return tile, results
+
+
+def _getTileIndex(tile):
+    """
+    Return the index of a (rowstart, rowend, colstart, colend) tile in an
+    array of the whole grid.
+    """
+    rowstart, rowend, colstart, colend = tile
+    return slice(rowstart, rowend), slice(colstart, colend)
+
+
+def _getTileShape(tile, geodict):
+    """
+    Return the (rows, columns) shape of a tile of a grid.
+    """
+    rowstart, rowend, colstart, colend = tile
+    return (len(range(geodict.ny)[rowstart:rowend]),
+            len(range(geodict.nx)[colstart:colend]))
+
+
+def _union(mask1, mask2):
+    """
+    Return the union of two boolean arrays, where None is an empty mask.
+    """
+    if mask1 is None:
+        return mask2
+    return mask1 | mask2
+
+
 def checkTerm(term, layers):
     """Checks terms of equation and replaces text with machine readable operators
 
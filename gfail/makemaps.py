@@ -35,7 +35,6 @@ import folium
 from folium import plugins, GeoJson
 from folium.features import GeoJson as GeoJson1
 from folium.features import RectangleMarker
-from mapio.shake import ShakeGrid
 from impactutils.io.cmd import get_command_output
 from bs4 import BeautifulSoup
 
@@ -45,7 +44,9 @@ from mapio.gdal import GDALGrid
 from mapio.geodict import GeoDict
 from mapio.grid2d import Grid2D
 from mapio.basemapcity import BasemapCities
-from gfail.stats import computeStats
+from gfail.statstore import getStatsStore
+from gfail.shakecache import loadShakeGrid
+from gfail.tiles import getNativeZoom, writeTiles
 from gfail.utilities import get_event_comcat, parseConfigLayers
 
 
@@ -185,8 +186,10 @@ def modelMap(grids, shakefile=None,
     defaultcolormap = cm.CMRmap_r
 
     if shakefile is not None:
-        edict = ShakeGrid.load(shakefile, adjust='res').getEventDict()
-        temp = ShakeGrid.load(shakefile, adjust='res').getShakeDict()
+        shakegrid = loadShakeGrid(shakefile, adjust='res')
+        # Copied, the ShakeGrid is shared through the cache
+        edict = dict(shakegrid.getEventDict())
+        temp = shakegrid.getShakeDict()
         edict['eventid'] = temp['shakemap_id']
         edict['version'] = temp['shakemap_version']
     else:
@@ -976,7 +979,8 @@ def interactiveMap(grids, shakefile=None, plotorder=None,
                    outfilename=None, tiletype='Stamen Terrain',
                    smcontourfile=None, faultfile=None, separate=True,
                    onkey=None, sepcolorbar=False, floatcb=True,
-                   savefiles=True, mapid=None, clear_zero=False, sync=False):
+                   savefiles=True, mapid=None, clear_zero=False, sync=False,
+                   tiles=False, nworkers=None):
     """
     This function creates interactive html plots of mapio grid layers
     (e.g. liquefaction or landslide models with their input layers).
@@ -1060,6 +1064,11 @@ def interactiveMap(grids, shakefile=None, plotorder=None,
             If a grid layer shortref is specified (e.g. 'Nowicki and others (2014)'),
             all maps will have colorbars synced to the colors of the one
             specified, but they must all have the same number of bins
+        tiles (bool): If True and savefiles is True, each layer is saved as a
+            web mercator tile pyramid next to the html files (see
+            gfail.tiles) and added as a tile layer, instead of being
+            embedded as one image.
+        nworkers (int): Number of tiles to render concurrently.
 
     Returns:
         * Interactive plot (html file) of all grids listed in plotorder
@@ -1102,8 +1111,10 @@ def interactiveMap(grids, shakefile=None, plotorder=None,
         colormaps = np.repeat(defaultcolormap, len(plotorder))
 
     if shakefile is not None:
-        edict = ShakeGrid.load(shakefile, adjust='res').getEventDict()
-        temp = ShakeGrid.load(shakefile, adjust='res').getShakeDict()
+        shakegrid = loadShakeGrid(shakefile, adjust='res')
+        # Copied, the ShakeGrid is shared through the cache
+        edict = dict(shakegrid.getEventDict())
+        temp = shakegrid.getShakeDict()
         edict['eventid'] = temp['shakemap_id']
         edict['version'] = temp['shakemap_version']
         if 'scenario' in temp['shakemap_event_type'].lower():
@@ -1126,7 +1137,6 @@ def interactiveMap(grids, shakefile=None, plotorder=None,
     if not os.path.isdir(outfolder):
         os.makedirs(outfolder)
 
-    #TODO ADD IN DOWNSAMPLING CODE FROM MODELMAP HERE - OR CREATE TILES?
     filenames = []
     maps = []
     images = []
@@ -1313,13 +1323,29 @@ def interactiveMap(grids, shakefile=None, plotorder=None,
                 control=False,
                 overlay=not overlay).add_to(map1)
 
-        images.append(plugins.ImageOverlay(rgba_img,
+        if tiles and savefiles:
+            # Tiles are read relative to the html files
+            tilename = '%s_%s_tiles' % (outfilename, keyS)
+            maxzoom = getNativeZoom(gd)
+            writeTiles(rgba_img, gd, os.path.join(outfolder, tilename),
+                       maxzoom=maxzoom, nworkers=nworkers, data=dat)
+            images.append(folium.TileLayer(tiles='%s/{z}/{x}/{y}.png' % tilename,
+                                           attr=sref or key,
+                                           max_zoom=14,
+                                           max_native_zoom=maxzoom,
                                            opacity=ALPHA,
                                            bounds=[[minlat, minlon], [maxlat, maxlon]],
-                                           mercator_project=True,
                                            name=sref,
                                            overlay=overlay,
                                            zIndex=k))
+        else:
+            images.append(plugins.ImageOverlay(rgba_img,
+                                               opacity=ALPHA,
+                                               bounds=[[minlat, minlon], [maxlat, maxlon]],
+                                               mercator_project=True,
+                                               name=sref,
+                                               overlay=overlay,
+                                               zIndex=k))
 
         images[k].add_to(map1)
         # Save list of layers that should not be visible initially but should be in legend
@@ -1428,7 +1454,8 @@ def GFSummary(maplayerlist, configs, web_template, shakemap, outfolder=None,
               includeunc=False, cleanup=True, faultfile=None,
               shakethreshtype='pga', point=False, pop_file=None,
               statlist=['Max', 'Std', 'Hagg_0.10g', 'exp_pop_0.10g'],
-              probthresh=None, shakethresh=[5., 10.], statement=None):
+              probthresh=None, shakethresh=[5., 10.], statement=None,
+              proj='ellipsoid'):
     """
     Create an interactive html that summarizes all ground failure results for
     a given earthquake in side-by-side plots and with summary tables
@@ -1462,6 +1489,8 @@ def GFSummary(maplayerlist, configs, web_template, shakemap, outfolder=None,
             page. Alert statements will be appended prior to this statement,
             Point source warnings for >M7 will be appended after this
             statement. If None, will use a generic explanatory statement.
+        proj (str): How cell areas of the statistics are computed, see
+            gfail.stats.computeHagg.
 
     Returns:
         Folder where webpage files are located
@@ -1553,12 +1582,15 @@ def GFSummary(maplayerlist, configs, web_template, shakemap, outfolder=None,
                 # placeholder zeros before computing stats
                 statprobthresh = 0.0
 
-            stats = computeStats(maplayer['model']['grid'],
-                                 probthresh=probthresh,
-                                 shakefile=shakemap,
-                                 shakethresh=shakethresh,
-                                 statprobthresh=statprobthresh,
-                                 pop_file=pop_file)
+            stats = getStatsStore(outfolder).getStats(
+                maplayer['model']['grid'],
+                probthresh=probthresh,
+                shakefile=shakemap,
+                shakethresh=shakethresh,
+                statprobthresh=statprobthresh,
+                pop_file=pop_file,
+                model=maplayer['model']['description']['name'],
+                proj=proj)
 
             if il == 0:
                 on = True
@@ -1581,12 +1613,15 @@ def GFSummary(maplayerlist, configs, web_template, shakemap, outfolder=None,
             colLQ.append(colormaps[0])
             concLQ[title] = maplayer['model']
 
-            stats = computeStats(maplayer['model']['grid'],
-                                 probthresh=probthresh,
-                                 shakefile=shakemap,
-                                 shakethresh=shakethresh,
-                                 statprobthresh=statprobthresh,
-                                 pop_file=pop_file)
+            stats = getStatsStore(outfolder).getStats(
+                maplayer['model']['grid'],
+                probthresh=probthresh,
+                shakefile=shakemap,
+                shakethresh=shakethresh,
+                statprobthresh=statprobthresh,
+                pop_file=pop_file,
+                model=maplayer['model']['description']['name'],
+                proj=proj)
 
             if iq == 0:
                 on = True
@@ -1873,8 +1908,9 @@ def write_summary(shakemap, outputdir, imgoutputdir, statement=None,
     Returns:
         Markdown file that summarizes the event and model used by GFSummary
     """
-    edict = ShakeGrid.load(shakemap, adjust='res').getEventDict()
-    smdict = ShakeGrid.load(shakemap, adjust='res').getShakeDict()
+    shakegrid = loadShakeGrid(shakemap, adjust='res')
+    edict = shakegrid.getEventDict()
+    smdict = shakegrid.getShakeDict()
 
     if event_url is None:
         event_url = 'https://earthquake.usgs.gov/earthquakes/eventpage/%s#executive' % edict['event_id']
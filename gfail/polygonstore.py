@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Polygons of a shapefile kept in memory with a spatial index.
+
+The shapefile of land masses (trimfile) is used for every output grid by
+trim_ocean and for every event by callgf. A PolygonStore reads it once,
+builds an STRtree of its geometries and answers bounding box queries,
+intersection tests and clipping from memory. getPolygonStore keeps one
+store per file for the life of the process, reloaded when the file is
+modified.
+"""
+
+# stdlib imports
+import os
+import threading
+
+# third party imports
+import fiona
+import numpy as np
+from shapely.geometry import shape, box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+class PolygonStore(object):
+    def __init__(self, filename):
+        """
+        Read the geometries of a shapefile and index them.
+
+        Args:
+            filename (str): Path to the shapefile.
+        """
+        self.filename = filename
+        self.key = getFileKey(filename)
+        with fiona.open(filename, 'r') as shapefile:
+            self.geoms = [shape(feature['geometry'])
+                          for feature in shapefile
+                          if feature['geometry'] is not None]
+        self.tree = STRtree(self.geoms)
+        self.index = dict([(id(geom), i)
+                           for i, geom in enumerate(self.geoms)])
+        self.prepared = [None] * len(self.geoms)
+
+    def query(self, bbox):
+        """
+        Get the geometries intersecting a box, as
+        fiona.Collection.items(bbox=bbox) does for shapefiles.
+
+        Args:
+            bbox (tuple): (xmin, ymin, xmax, ymax) of the box.
+
+        Returns:
+            list: List of shapely geometries.
+        """
+        qbox = box(*bbox)
+        return [self.geoms[i] for i in self._query(qbox)
+                if self._getPrepared(i).intersects(qbox)]
+
+    def intersects(self, geom):
+        """
+        Check whether a geometry intersects any of the geometries.
+
+        Args:
+            geom: Shapely geometry, e.g., a box.
+
+        Returns:
+            bool: True if geom intersects at least one geometry.
+        """
+        for i in self._query(geom):
+            if self._getPrepared(i).intersects(geom):
+                return True
+        return False
+
+    def clip(self, bbox):
+        """
+        Get the parts of the geometries within a box.
+
+        Args:
+            bbox (tuple): (xmin, ymin, xmax, ymax) of the box.
+
+        Returns:
+            list: List of non empty shapely geometries.
+        """
+        clipbox = box(*bbox)
+        pbox = prep(clipbox)
+        clipped = []
+        for i in self._query(clipbox):
+            if pbox.contains(self.geoms[i]):
+                clipped.append(self.geoms[i])
+            elif self._getPrepared(i).intersects(clipbox):
+                geom = self.geoms[i].intersection(clipbox)
+                if not geom.is_empty:
+                    clipped.append(geom)
+        return clipped
+
+    def _query(self, geom):
+        """
+        Indices of the geometries whose bounding boxes intersect the
+        bounding box of geom, in file order.
+        """
+        hits = self.tree.query(geom)
+        if len(hits) and not isinstance(hits[0], (int, np.integer)):
+            # shapely < 2 returns geometries
+            hits = [self.index[id(hit)] for hit in hits]
+        return sorted(hits)
+
+    def _getPrepared(self, i):
+        """
+        Prepared geometry for fast repeated predicates, made on first use.
+        """
+        if self.prepared[i] is None:
+            self.prepared[i] = prep(self.geoms[i])
+        return self.prepared[i]
+
+
+def getFileKey(filename):
+    """
+    Return the identity of a file, used to detect changes.
+    """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+
+_STORES = {}
+_LOCK = threading.Lock()
+
+
+def getPolygonStore(filename):
+    """
+    Return the polygon store of a shapefile, read the first time it is
+    requested in this process or when the file changed since it was read.
+
+    Args:
+        filename (str): Path to the shapefile.
+
+    Returns:
+        PolygonStore: Store of the geometries of the shapefile.
+    """
+    key = getFileKey(filename)
+    with _LOCK:
+        store = _STORES.get(key[0])
+        if store is None or store.key != key:
+            store = PolygonStore(filename)
+            _STORES[key[0]] = store
+        return store
+
+
+def clearPolygonStores():
+    """
+    Forget all polygon stores of this process.
+    """
+    with _LOCK:
+        _STORES.clear()
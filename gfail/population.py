@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Population grid read by window for exposure statistics.
+
+get_exposures cuts the population file (e.g., LandScan) around every model
+of an event, and every cut opens the file again. convertPopulation converts
+the population file once to an uncompressed array on disk (see the
+gfail_population program) that is memory-mapped, so a window is read by
+slicing the array without decoding the file. A PopulationGrid keeps the
+last window it read, and later windows inside of it, e.g., for the other
+models of the same event, are cut from memory. getPopulationGrid keeps one
+PopulationGrid per file for the life of the process, reloaded when the file
+is modified.
+
+The manifest records the absolute path, modification time and size of the
+population file the array was made from. If that file changed since, it is
+read instead of the array, with a warning.
+
+Windows are the same as quickcut(pop_file, gdict, precise=False,
+extrasamp=extrasamp) would cut from the original file.
+"""
+
+# stdlib imports
+import os
+import json
+import threading
+from timeit import default_timer as timer
+
+# third party imports
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
+
+# local imports
+from gfail.catalog import getCatalog
+from gfail.spatial import getProjWin, getCellWindow, getWindowDict
+from gfail.polygonstore import getFileKey
+
+
+class PopulationGrid(object):
+    def __init__(self, filename):
+        """
+        Population grid.
+
+        Args:
+            filename (str): Path to the manifest (json) file made by
+                convertPopulation, or to a raster file that is read with
+                rasterio.
+        """
+        self.filename = filename
+        self.key = getFileKey(filename)
+        self.source = None
+        self.window = None
+        self.lock = threading.RLock()
+        self.data = None
+        if filename.endswith('.json'):
+            with open(filename, 'r') as f:
+                info = json.load(f)
+            self.source = info['source'][0]
+            # Identity of the source when the grid was opened
+            self.sourcekey = _getSourceKey(self.source)
+            if self.sourcekey is not None and \
+                    self.sourcekey != info['source']:
+                print('%s changed since %s was made, reading it instead, run '
+                      'gfail_population again to update it'
+                      % (self.source, filename))
+            else:
+                if self.sourcekey is None:
+                    print('Cannot check whether %s is up to date, %s no '
+                          'longer exists' % (filename, self.source))
+                popdir = os.path.dirname(os.path.abspath(filename))
+                self.geodict = GeoDict(info['geodict'])
+                self.nodata = info['nodata']
+                self.data = np.load(os.path.join(popdir, info['file']),
+                                    mmap_mode='r')
+        if self.data is None:
+            rasterfile = filename if self.source is None else self.source
+            self.geodict = getCatalog().getGeoDict(rasterfile)[0]
+            with rasterio.open(rasterfile, 'r') as src:
+                self.nodata = src.nodata
+            self.rasterfile = rasterfile
+        gd = self.geodict
+        self.west = gd.xmin - gd.dx / 2.
+        self.north = gd.ymax + gd.dy / 2.
+
+    def changed(self):
+        """
+        Check whether the file the grid was converted from changed since
+        the grid was opened.
+
+        Returns:
+            bool: True if the source changed, False if it did not or the grid
+            is not a converted grid.
+        """
+        if self.source is None:
+            return False
+        return _getSourceKey(self.source) != self.sourcekey
+
+    def getWindow(self, gdict, extrasamp=2.):
+        """
+        Cut the population grid around a geodictionary, without resampling.
+
+        Args:
+            gdict (GeoDict): Geodictionary to cut around.
+            extrasamp (float): Number of extra cells to cut around each edge
+                of gdict.
+
+        Returns:
+            Grid2D: Window of the population grid, nodata cells of floating
+            point grids are nan.
+        """
+        gd = self.geodict
+        projwin = None
+        if gd != gdict:
+            projwin = getProjWin(gd, gdict, extrasamp)
+        row0, row1, col0, col1 = getCellWindow(
+            self.west, self.north, gd.dx, gd.dy, gd.nx, gd.ny, projwin)
+        with self.lock:
+            if self.window is not None:
+                wrow0, wrow1, wcol0, wcol1, wdata = self.window
+                if row0 >= wrow0 and row1 <= wrow1 and \
+                        col0 >= wcol0 and col1 <= wcol1:
+                    data = wdata[row0 - wrow0:row1 - wrow0,
+                                 col0 - wcol0:col1 - wcol0].copy()
+                    return Grid2D(data, getWindowDict(
+                        self.west, self.north, gd.dx, gd.dy,
+                        row0, row1, col0, col1))
+            data = self._read(row0, row1, col0, col1)
+            self.window = (row0, row1, col0, col1, data)
+        return Grid2D(data.copy(), getWindowDict(
+            self.west, self.north, gd.dx, gd.dy, row0, row1, col0, col1))
+
+    def _read(self, row0, row1, col0, col1):
+        """
+        Read the cells row0:row1, col0:col1 from the array on disk or the
+        raster file.
+        """
+        if self.data is not None:
+            data = np.array(self.data[row0:row1, col0:col1])
+        else:
+            with rasterio.open(self.rasterfile, 'r') as src:
+                data = src.read(1, window=Window(col0, row0, col1 - col0,
+                                                 row1 - row0))
+        # NaNs only valid for floating point data, as in GDALGrid.load
+        if self.nodata is not None and \
+                data.dtype in [np.float32, np.float64]:
+            data[data == self.nodata] = np.nan
+        return data
+
+
+def convertPopulation(pop_file, outdir, rowmax=1000):
+    """
+    Convert a population file once to an array that PopulationGrid reads by
+    memory mapping.
+
+    Args:
+        pop_file (str): Path to the population raster file, e.g., LandScan.
+        outdir (str): Directory where the array (population.npy) and its
+            manifest (population.json) are saved.
+        rowmax (int): Number of rows to convert at once.
+
+    Returns:
+        str: Path to the manifest file, to use as population file.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    gdict = getCatalog().getGeoDict(pop_file)[0]
+    datafile = os.path.join(outdir, 'population.npy')
+    temp = '%s.%d.tmp' % (datafile, os.getpid())
+    with rasterio.open(pop_file, 'r') as src:
+        nx, ny = src.width, src.height
+        nodata = src.nodata
+        data = np.lib.format.open_memmap(temp, mode='w+',
+                                         dtype=src.dtypes[0],
+                                         shape=(ny, nx))
+        for rowstart in range(0, ny, rowmax):
+            start = timer()
+            rowend = min(rowstart + rowmax, ny)
+            data[rowstart:rowend] = src.read(
+                1, window=Window(0, rowstart, nx, rowend - rowstart))
+            print('Converted rows %d to %d of %d: %1.1f sec'
+                  % (rowstart, rowend, ny, timer() - start))
+        data.flush()
+        del data
+    os.replace(temp, datafile)
+
+    manifest = {'source': _getSourceKey(pop_file),
+                'file': 'population.npy',
+                'geodict': {'xmin': gdict.xmin, 'xmax': gdict.xmax,
+                            'ymin': gdict.ymin, 'ymax': gdict.ymax,
+                            'dx': gdict.dx, 'dy': gdict.dy,
+                            'nx': gdict.nx, 'ny': gdict.ny},
+                'nodata': nodata}
+    # Written last, so an interrupted conversion is never used
+    manifestfile = os.path.join(outdir, 'population.json')
+    with open(manifestfile, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifestfile
+
+
+def _getSourceKey(pop_file):
+    """
+    Identify the file a grid is converted from by absolute path,
+    modification time and size, or None if it does not exist.
+    """
+    try:
+        return list(getFileKey(pop_file))
+    except OSError:
+        return None
+
+
+_GRIDS = {}
+_LOCK = threading.Lock()
+
+
+def getPopulationGrid(filename):
+    """
+    Return the population grid of a file, opened the first time it is
+    requested in this process or when the file changed since it was opened.
+
+    Args:
+        filename (str): Path to a manifest made by convertPopulation or to a
+            population raster file.
+
+    Returns:
+        PopulationGrid: Population grid of the file.
+    """
+    key = getFileKey(filename)
+    with _LOCK:
+        grid = _GRIDS.get(key[0])
+        if grid is None or grid.key != key or grid.changed():
+            grid = PopulationGrid(filename)
+            _GRIDS[key[0]] = grid
+        return grid
+
+
+def clearPopulationGrids():
+    """
+    Forget all population grids of this process.
+    """
+    with _LOCK:
+        _GRIDS.clear()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Process wide cache of ShakeMap grid.xml files.
+
+A single gfail run reads the same ShakeMap many times (header data, extent,
+layers for every model, statistics and maps). The functions in this module
+parse each file only once, keep a ShakeGrid with read-only float32 layers
+along with the header dictionaries, and hand out the shared ShakeGrid or
+copies of its layers resampled to other grids.
+
+Files are identified by their absolute path, modification time and size, so
+an updated ShakeMap is read again. File objects are never cached.
+"""
+
+# stdlib imports
+import os
+import copy
+import threading
+from collections import OrderedDict
+
+# third party imports
+import numpy as np
+from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
+from mapio.shake import ShakeGrid, getHeaderData, readShakeFile
+
+# local imports
+from gfail.spatial import quickcut
+
+
+#: Number of ShakeMap files kept in the cache
+MAXGRIDS = 4
+
+#: Number of resampled layers kept in the cache
+MAXLAYERS = 16
+
+_HEADERS = OrderedDict()
+_GRIDS = OrderedDict()
+_LAYERS = OrderedDict()
+_LOCK = threading.RLock()
+
+
+def getShakeHeader(shakefile):
+    """
+    Cached version of mapio.shake.getHeaderData.
+
+    Args:
+        shakefile (str): Path to ShakeMap grid.xml file.
+
+    Returns:
+        tuple: griddict, eventdict, specdict, fields, uncertainties, as
+        returned by getHeaderData, copies that the caller may modify.
+    """
+    key = _getFileKey(shakefile)
+    if key is None:
+        return getHeaderData(shakefile)
+    with _LOCK:
+        if key not in _HEADERS:
+            _HEADERS[key] = getHeaderData(shakefile)
+            _trim(_HEADERS, MAXGRIDS)
+        return copy.deepcopy(_HEADERS[key])
+
+
+def getShakeGeoDict(shakefile, adjust='bounds'):
+    """
+    Cached version of ShakeGrid.getFileGeoDict.
+
+    Args:
+        shakefile (str): Path to ShakeMap grid.xml file.
+        adjust (str): 'bounds' or 'res', see ShakeGrid.getFileGeoDict.
+
+    Returns:
+        GeoDict: Geodictionary of the ShakeMap layers.
+    """
+    if _getFileKey(shakefile) is None:
+        return ShakeGrid.getFileGeoDict(shakefile, adjust=adjust)
+    return _getGeoDict(getShakeHeader(shakefile)[2], adjust)
+
+
+def loadShakeGrid(shakefile, adjust='bounds'):
+    """
+    Cached version of ShakeGrid.load for the full ShakeMap grid.
+
+    The returned ShakeGrid is shared by all callers and its layers are
+    read-only, use getShakeLayer or copy the data before modifying them.
+    Copy its event and shake dictionaries before modifying them too.
+
+    Args:
+        shakefile (str): Path to ShakeMap grid.xml file.
+        adjust (str): 'bounds' or 'res', see ShakeGrid.load.
+
+    Returns:
+        ShakeGrid: ShakeGrid object of the full file.
+    """
+    key = _getFileKey(shakefile)
+    if key is None:
+        return ShakeGrid.load(shakefile, adjust=adjust)
+    gridkey = key + (adjust,)
+    with _LOCK:
+        if gridkey in _GRIDS:
+            _GRIDS.move_to_end(gridkey)
+            return _GRIDS[gridkey]
+        # The layers only depend on the file, not on adjust
+        shakedict, eventdict, specdict, fields, uncertdict = \
+            getShakeHeader(shakefile)
+        parsed = [grid for (gkey, grid) in _GRIDS.items()
+                  if gkey[:len(key)] == key]
+        if parsed:
+            layers = OrderedDict(
+                (name, parsed[0].getLayer(name).getData())
+                for name in parsed[0].getLayerNames())
+        else:
+            with open(shakefile, 'r') as f:
+                layers = readShakeFile(f, adjust=adjust)[0]
+        geodict = _getGeoDict(specdict, adjust)
+        grid = ShakeGrid(layers, geodict, eventdict, shakedict, uncertdict)
+        for name in grid.getLayerNames():
+            data = grid.getLayer(name).getData()
+            data[np.isinf(data)] = np.nan  # same as ShakeGrid.load
+            data.flags.writeable = False
+        _GRIDS[gridkey] = grid
+        _trim(_GRIDS, MAXGRIDS)
+        return grid
+
+
+def getShakeLayer(shakefile, layer, sampledict=None, method='bilinear',
+                  adjust='bounds'):
+    """
+    Return one layer of a ShakeMap, optionally resampled to another grid
+    with quickcut. Resampled layers are cached too.
+
+    Args:
+        shakefile (str): Path to ShakeMap grid.xml file.
+        layer (str): Name of the layer, e.g. 'pga' or 'stdpgv'.
+        sampledict (GeoDict): Grid to resample the layer to, if None, the
+            layer is returned on the ShakeMap grid.
+        method (str): Interpolation method passed to quickcut.
+        adjust (str): 'bounds' or 'res', see ShakeGrid.load.
+
+    Returns:
+        Grid2D: Copy of the layer that the caller may modify.
+    """
+    grid = loadShakeGrid(shakefile, adjust=adjust).getLayer(layer)
+    if sampledict is None:
+        return Grid2D.copyFromGrid(grid)
+    key = _getFileKey(shakefile)
+    if key is None:
+        return quickcut(grid, sampledict, precise=True, method=method)
+    layerkey = key + (layer, adjust, method) + _getGeoDictKey(sampledict)
+    with _LOCK:
+        if layerkey in _LAYERS:
+            _LAYERS.move_to_end(layerkey)
+            return Grid2D.copyFromGrid(_LAYERS[layerkey])
+    result = quickcut(grid, sampledict, precise=True, method=method)
+    with _LOCK:
+        _LAYERS[layerkey] = Grid2D.copyFromGrid(result)
+        _trim(_LAYERS, MAXLAYERS)
+    return result
+
+
+def clearShakeCache():
+    """
+    Remove all ShakeMaps from the cache.
+    """
+    with _LOCK:
+        _HEADERS.clear()
+        _GRIDS.clear()
+        _LAYERS.clear()
+
+
+def _getFileKey(shakefile):
+    """
+    Return the key identifying a ShakeMap file, or None if shakefile is not
+    the path of an existing file.
+    """
+    if not isinstance(shakefile, str) or not os.path.isfile(shakefile):
+        return None
+    stat = os.stat(shakefile)
+    return (os.path.abspath(shakefile), stat.st_mtime, stat.st_size)
+
+
+def _getGeoDict(specdict, adjust):
+    """
+    Build the geodictionary of a ShakeMap from its grid_specification
+    element, as ShakeGrid.getFileGeoDict does.
+    """
+    return GeoDict({
+        'xmin': specdict['lon_min'],
+        'xmax': specdict['lon_max'],
+        'ymin': specdict['lat_min'],
+        'ymax': specdict['lat_max'],
+        'dx': specdict['nominal_lon_spacing'],
+        'dy': specdict['nominal_lat_spacing'],
+        'ny': specdict['nlat'],
+        'nx': specdict['nlon']}, adjust=adjust)
+
+
+def _getGeoDictKey(gdict):
+    return (gdict.xmin, gdict.xmax, gdict.ymin, gdict.ymax, gdict.dx,
+            gdict.dy, gdict.nx, gdict.ny)
+
+
+def _trim(cache, maxsize):
+    """
+    Drop the oldest entries of an OrderedDict cache.
+    """
+    while len(cache) > maxsize:
+        cache.popitem(last=False)
@@ -6,21 +6,31 @@ Spatial functions used by all models
 
 import os
 import tempfile
-import fiona
 import shutil
+import numpy as np
 import rasterio
 import rasterio.mask
+from rasterio.windows import Window
 
 from mapio.gdal import GDALGrid
 from mapio.shake import ShakeGrid
 from mapio.gmt import GMTGrid
 from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
 from impactutils.io.cmd import get_command_output
 
+# local imports
+from gfail.landmask import getLandMask, getFeatures
+from gfail.catalog import getCatalog
 
-def trim_ocean(grid2D, mask, all_touched=True, crop=False, invert=False, nodata=0.):
+
+def trim_ocean(grid2D, mask, all_touched=True, crop=False, invert=False,
+               nodata=0., inplace=False):
     """Use the mask (a shapefile) to trim offshore areas
 
+    The cells to mask are rasterized once per grid and shapefile and cached,
+    see :mod:`gfail.landmask`.
+
     Args:
         grid2D: MapIO grid2D object of results that need trimming
         mask: list of shapely polygon features already loaded in or string of file extension of shapefile to use
@@ -29,28 +39,37 @@ def trim_ocean(grid2D, mask, all_touched=True, crop=False, invert=False, nodata=
         crop (bool): crop boundaries of raster to new masked area
         invert (bool): if True, will mask areas that do not overlap with the polygon
         nodata (flt): value to use as mask
+        inplace (bool): if True, mask the data of grid2D and return grid2D
+            instead of a copy (not used if crop is True)
 
     Returns:
         grid2D file with ocean masked
     """
+    if crop:
+        return _cropOcean(grid2D, mask, all_touched=all_touched,
+                          invert=invert, nodata=nodata)
     gdict = grid2D.getGeoDict()
+    outside = getLandMask().getMask(mask, gdict, all_touched=all_touched,
+                                    invert=invert)
+    data = grid2D.getData()
+    if np.isnan(nodata) and data.dtype.kind != 'f':
+        # nan needs floats
+        grid2D = GDALGrid(data.astype(float), gdict)
+    elif not inplace:
+        grid2D = GDALGrid(data.copy(), gdict)
+    np.putmask(grid2D.getData(), outside, nodata)
+    return grid2D
 
-    tempdir = tempfile.mkdtemp()
-    tempfile1 = os.path.join(tempdir, 'temp.tif')
-    tempfile2 = os.path.join(tempdir, 'temp2.tif')
 
-    # Get shapes ready
-    if type(mask) == str:
-        with fiona.open(mask, 'r') as shapefile:
-            hits = list(shapefile.items(bbox=(gdict.xmin, gdict.ymin, gdict.xmax, gdict.ymax)))
-            features = [feature[1]["geometry"] for feature in hits]
-            #hits = list(shapefile)
-            #features = [feature["geometry"] for feature in hits]
-    elif type(mask) == list:
-        features = mask
-    else:
-        raise Exception('mask is neither a link to a shapefile or a list of shapely shapes, cannot proceed')
+def _cropOcean(grid2D, mask, all_touched=True, invert=False, nodata=0.):
+    """
+    Trim offshore areas and crop the grid to the masked area with
+    rasterio.mask.mask, see trim_ocean.
+    """
+    gdict = grid2D.getGeoDict()
+    features = getFeatures(mask, gdict)
 
+    tempdir = tempfile.mkdtemp()
     tempfilen = os.path.join(tempdir, 'temp.bil')
     tempfile1 = os.path.join(tempdir, 'temp.tif')
     tempfile2 = os.path.join(tempdir, 'temp2.tif')
@@ -58,27 +77,11 @@ def trim_ocean(grid2D, mask, all_touched=True, crop=False, invert=False, nodata=
     cmd = 'gdal_translate -a_srs EPSG:4326 -of GTiff %s %s' % (tempfilen, tempfile1)
     rc, so, se = get_command_output(cmd)
 
-    # #Convert grid2D to rasterio format
-    #
-    # source_crs = rasterio.crs.CRS.from_string(gdict.projection)
-    # src_transform = rasterio.Affine.from_gdal(gdict.xmin - gdict.dx/2.0,
-    #                                           gdict.dx, 0.0,  gdict.ymax + gdict.dy/2.0,
-    #                                           0.0, -1*gdict.dy)  # from mapio.grid2D
-    # with rasterio.open(tempfile1, 'w', driver='GTIff',
-    #                    height=gdict.ny,    # numpy of rows
-    #                    width=gdict.nx,     # number of columns
-    #                    count=1,                        # number of bands
-    #                    dtype=rasterio.dtypes.float64,  # this must match the dtype of our array
-    #                    crs=source_crs,
-    #                    transform=src_transform) as src_raster:
-    #     src_raster.write(grid2D.getData().astype(float), 1)  # optional second parameter is the band number to write to
-    #     #ndvi_raster.nodata = -1  # set the raster's nodata value
-
     if rc:
         with rasterio.open(tempfile1, 'r') as src_raster:
-            out_image, out_transform = rasterio.mask.mask(src_raster, features,
-                                                          all_touched=all_touched,
-                                                          crop=crop)
+            out_image, out_transform = rasterio.mask.mask(
+                src_raster, features, all_touched=all_touched, crop=True,
+                invert=invert, nodata=nodata)
             out_meta = src_raster.meta.copy()
             out_meta.update({"driver": "GTiff",
                              "height": out_image.shape[1],
@@ -90,24 +93,27 @@ def trim_ocean(grid2D, mask, all_touched=True, crop=False, invert=False, nodata=
         newgrid = GDALGrid.load(tempfile2)
 
     else:
-        raise Exception('ocean trimming failed')
-        print(se)
+        shutil.rmtree(tempdir)
+        raise Exception('ocean trimming failed: %s' % se)
 
     shutil.rmtree(tempdir)
     return newgrid
 
 
 def quickcut(filename, gdict, tempname=None, extrasamp=5., method='bilinear',
-             precise=True, cleanup=True, verbose=False):
+             precise=True, cleanup=True, verbose=False, inprocess=True):
     """
-    Use gdal to trim a large global file down quickly so mapio can read it
-    efficiently. (Cannot read Shakemap.xml files, must save as .bil filrst)
+    Trim a large global file down quickly so mapio can read it efficiently.
+    By default, the window around gdict is read directly into memory with
+    rasterio; gdal_translate is used if that fails or if inprocess is False.
+    (Cannot read Shakemap.xml files, pass the layer Grid2D instead)
 
     Args:
-        filename (str): File path to original input file (raster).
+        filename (str): File path to original input file (raster), or a
+            Grid2D object already in memory.
         gdict (geodict): Geodictionary to cut around and align with.
         tempname (str): File path to desired location of clipped part of
-            filename.
+            filename (only used by gdal_translate).
         extrasamp (int): Number of extra cells to cut around each edge of
             geodict to have resampling buffer for future steps.
         method (str): If resampling is necessary, method to use.
@@ -115,33 +121,15 @@ def quickcut(filename, gdict, tempname=None, extrasamp=5., method='bilinear',
             possible, if False it will just roughly cut around the area of
             interest without changing resolution
         cleanup (bool): if True, delete tempname after reading it back in
+        verbose (bool): if True, print output of gdal_translate.
+        inprocess (bool): if True, read the window with rasterio instead of
+            running gdal_translate.
     Returns: New grid2D layer
 
-    Note: This function uses the subprocess approach because ``gdal.Translate`` doesn't hang on the
+    Note: The gdal_translate fallback uses the subprocess approach because ``gdal.Translate`` doesn't hang on the
     command until the file is created which causes problems in the next steps.
     """
 
-    try:
-        filegdict = GDALGrid.getFileGeoDict(filename)
-    except:
-        try:
-            filegdict = GMTGrid.getFileGeoDict(filename)
-        except:
-            raise Exception('Cannot get geodict for %s' % filename)
-
-    if tempname is None:
-        tempdir = tempfile.mkdtemp()
-        tempname = os.path.join(tempdir, 'junk.tif')
-        deltemp = True
-    else:
-        deltemp = False
-
-    #if os.path.exists(tempname):
-    #    os.remove(tempname)
-    #    print('Temporary file already there, removing file')
-
-    filegdict = filegdict[0]
-
     # Get the right methods for mapio (method) and gdal (method2)
     if method == 'linear':
         method2 = 'bilinear'
@@ -156,41 +144,34 @@ def quickcut(filename, gdict, tempname=None, extrasamp=5., method='bilinear',
     else:
         method2 = method
 
+    if isinstance(filename, Grid2D):
+        filegdict = filename.getGeoDict()
+    else:
+        filegdict = getCatalog().getGeoDict(filename)[0]
+
     if filegdict != gdict:
         # First cut without resampling
-        tempgdict = GeoDict.createDictFromBox(
-            gdict.xmin, gdict.xmax, gdict.ymin, gdict.ymax,
-            filegdict.dx, filegdict.dy, inside=True)
-
-        try:
-            egdict = filegdict.getBoundsWithin(tempgdict)
-
-            ulx = egdict.xmin - extrasamp * egdict.dx
-            uly = egdict.ymax + extrasamp * egdict.dy
-            lrx = egdict.xmax + extrasamp * egdict.dx
-            lry = egdict.ymin - extrasamp * egdict.dy
-
-            cmd = 'gdal_translate -a_srs EPSG:4326 -of GTiff -projwin %1.8f %1.8f \
-            %1.8f %1.8f -r %s %s %s' % (ulx, uly, lrx, lry, method2, filename, tempname)
-        except:  # When ShakeMap is being loaded, sometimes they won't align right because it's already cut to the area, so just load the whole file in
-            cmd = 'gdal_translate -a_srs EPSG:4326 -of GTiff -r %s %s %s' % (method2, filename, tempname)
-        rc, so, se = get_command_output(cmd)
-        if not rc:
-            raise Exception(se.decode())
-        else:
-            if verbose:
-                print(so.decode())
+        projwin = getProjWin(filegdict, gdict, extrasamp)
+
+        newgrid2d = None
+        if isinstance(filename, Grid2D):
+            newgrid2d = _cutGrid(filename, projwin)
+        elif inprocess:
+            try:
+                newgrid2d = _readWindow(filename, projwin)
+            except Exception as e:
+                print('Could not read %s with rasterio, using gdal_translate '
+                      'instead: %s' % (filename, e))
+        if newgrid2d is None:
+            newgrid2d = _translate(filename, projwin, method2, tempname,
+                                   cleanup, verbose)
 
-        newgrid2d = GDALGrid.load(tempname)
         if precise:
             # Resample to exact geodictionary
             newgrid2d = newgrid2d.interpolate2(gdict, method=method)
-        if cleanup:
-            os.remove(tempname)
-
-        if deltemp:
-            shutil.rmtree(tempdir)
 
+    elif isinstance(filename, Grid2D):
+        newgrid2d = Grid2D(filename.getData(), filegdict.copy())
     else:
         ftype = GMTGrid.getFileType(filename)
         if ftype != 'unknown':
@@ -201,3 +182,192 @@ def quickcut(filename, gdict, tempname=None, extrasamp=5., method='bilinear',
             newgrid2d = GDALGrid.load(filename)
 
     return newgrid2d
+
+
+def getTileGeoDict(tile, geodict):
+    """
+    Return the geodictionary of a tile of a grid.
+
+    Args:
+        tile (tuple): (rowstart, rowend, colstart, colend), slice bounds of
+            the rows and columns of the tile, None for the start or end of
+            the grid.
+        geodict (GeoDict): Geodictionary of the grid.
+
+    Returns:
+        GeoDict: Geodictionary of the cells of the tile.
+    """
+    rowstart, rowend, colstart, colend = tile
+    rows = range(geodict.ny)[rowstart:rowend]
+    cols = range(geodict.nx)[colstart:colend]
+    return GeoDict({'xmin': geodict.xmin + cols[0] * geodict.dx,
+                    'xmax': geodict.xmin + cols[-1] * geodict.dx,
+                    'ymin': geodict.ymax - rows[-1] * geodict.dy,
+                    'ymax': geodict.ymax - rows[0] * geodict.dy,
+                    'dx': geodict.dx, 'dy': geodict.dy,
+                    'nx': len(cols), 'ny': len(rows)})
+
+
+def _readWindow(filename, projwin):
+    """
+    Read the window of a raster file that covers projwin (ulx, uly, lrx, lry),
+    or the whole file if projwin is None, like gdal_translate -projwin.
+
+    Returns: New grid2D layer
+    """
+    with rasterio.open(filename, 'r') as src:
+        transform = src.transform
+        dx = transform.a
+        dy = -transform.e
+        row0, row1, col0, col1 = getCellWindow(
+            transform.c, transform.f, dx, dy, src.width, src.height, projwin)
+        data = src.read(1, window=Window(col0, row0, col1 - col0,
+                                         row1 - row0))
+        nodata = src.nodata
+
+    # NaNs only valid for floating point data, as in GDALGrid.load
+    if nodata is not None and data.dtype in [np.float32, np.float64]:
+        data[data == nodata] = np.nan
+    newdict = getWindowDict(transform.c, transform.f, dx, dy,
+                             row0, row1, col0, col1)
+    return Grid2D(data, newdict)
+
+
+def _cutGrid(grid2D, projwin):
+    """
+    Cut a Grid2D object to the cells that cover projwin (ulx, uly, lrx, lry),
+    or copy all of it if projwin is None.
+
+    Returns: New grid2D layer
+    """
+    gdict = grid2D.getGeoDict()
+    row0, row1, col0, col1 = getCellWindow(
+        gdict.xmin - gdict.dx / 2., gdict.ymax + gdict.dy / 2.,
+        gdict.dx, gdict.dy, gdict.nx, gdict.ny, projwin)
+    newdict = GeoDict({'xmin': gdict.xmin + col0 * gdict.dx,
+                       'xmax': gdict.xmin + (col1 - 1) * gdict.dx,
+                       'ymin': gdict.ymax - (row1 - 1) * gdict.dy,
+                       'ymax': gdict.ymax - row0 * gdict.dy,
+                       'dx': gdict.dx, 'dy': gdict.dy,
+                       'ny': row1 - row0, 'nx': col1 - col0})
+    return Grid2D(grid2D.getData()[row0:row1, col0:col1], newdict)
+
+
+def getProjWin(filegdict, gdict, extrasamp):
+    """
+    Area of a file to cut around a geodictionary, as quickcut does.
+
+    Args:
+        filegdict (GeoDict): Geodictionary of the file.
+        gdict (GeoDict): Geodictionary to cut around.
+        extrasamp (float): Number of extra cells of the file to cut around
+            each edge of gdict.
+
+    Returns:
+        tuple: (ulx, uly, lrx, lry), or None to use the whole file.
+    """
+    tempgdict = GeoDict.createDictFromBox(
+        gdict.xmin, gdict.xmax, gdict.ymin, gdict.ymax,
+        filegdict.dx, filegdict.dy, inside=True)
+
+    try:
+        egdict = filegdict.getBoundsWithin(tempgdict)
+
+        ulx = egdict.xmin - extrasamp * egdict.dx
+        uly = egdict.ymax + extrasamp * egdict.dy
+        lrx = egdict.xmax + extrasamp * egdict.dx
+        lry = egdict.ymin - extrasamp * egdict.dy
+        projwin = (ulx, uly, lrx, lry)
+    except:  # When ShakeMap is being loaded, sometimes they won't align right because it's already cut to the area, so just load the whole file in
+        projwin = None
+    return projwin
+
+
+def getWindowDict(west, north, dx, dy, row0, row1, col0, col1):
+    """
+    Geodictionary of the cells row0:row1, col0:col1 of a grid.
+
+    Args:
+        west (float): Longitude of the left edge of the grid.
+        north (float): Latitude of the top edge of the grid.
+        dx (float): Width of the cells.
+        dy (float): Height of the cells.
+        row0, row1, col0, col1 (int): Rows and columns of the cells.
+
+    Returns:
+        GeoDict: Geodictionary of the cells.
+    """
+    xmin = west + (col0 + 0.5) * dx
+    ymax = north - (row0 + 0.5) * dy
+    return GeoDict({'xmin': xmin, 'xmax': xmin + (col1 - col0 - 1) * dx,
+                    'ymin': ymax - (row1 - row0 - 1) * dy, 'ymax': ymax,
+                    'dx': dx, 'dy': dy,
+                    'ny': row1 - row0, 'nx': col1 - col0})
+
+
+def getCellWindow(west, north, dx, dy, nx, ny, projwin):
+    """
+    Rows and columns of the cells of a grid that overlap an area.
+
+    Args:
+        west (float): Longitude of the left edge of the grid.
+        north (float): Latitude of the top edge of the grid.
+        dx (float): Width of the cells.
+        dy (float): Height of the cells.
+        nx (int): Number of columns of the grid.
+        ny (int): Number of rows of the grid.
+        projwin (tuple): Area (ulx, uly, lrx, lry), or None for the whole
+            grid.
+
+    Returns:
+        tuple: (row0, row1, col0, col1), cells row0:row1, col0:col1.
+
+    Raises:
+        Exception: If the area does not overlap the grid.
+    """
+    if projwin is None:
+        return 0, ny, 0, nx
+    ulx, uly, lrx, lry = projwin
+    col0 = max(int(np.floor((ulx - west) / dx)), 0)
+    col1 = min(int(np.ceil((lrx - west) / dx)), nx)
+    row0 = max(int(np.floor((north - uly) / dy)), 0)
+    row1 = min(int(np.ceil((north - lry) / dy)), ny)
+    if col1 <= col0 or row1 <= row0:
+        raise Exception('Area to cut does not overlap the grid')
+    return row0, row1, col0, col1
+
+
+def _translate(filename, projwin, method2, tempname=None, cleanup=True,
+               verbose=False):
+    """
+    Cut filename to projwin (ulx, uly, lrx, lry), or convert the whole file
+    if projwin is None, with gdal_translate.
+
+    Returns: New grid2D layer
+    """
+    if tempname is None:
+        tempdir = tempfile.mkdtemp()
+        tempname = os.path.join(tempdir, 'junk.tif')
+        deltemp = True
+    else:
+        deltemp = False
+
+    if projwin is not None:
+        cmd = 'gdal_translate -a_srs EPSG:4326 -of GTiff -projwin %1.8f %1.8f \
+        %1.8f %1.8f -r %s %s %s' % (projwin + (method2, filename, tempname))
+    else:
+        cmd = 'gdal_translate -a_srs EPSG:4326 -of GTiff -r %s %s %s' % (method2, filename, tempname)
+    rc, so, se = get_command_output(cmd)
+    if not rc:
+        raise Exception(se.decode())
+    else:
+        if verbose:
+            print(so.decode())
+
+    newgrid2d = GDALGrid.load(tempname)
+    if cleanup:
+        os.remove(tempname)
+
+    if deltemp:
+        shutil.rmtree(tempdir)
+    return newgrid2d
@@ -4,21 +4,30 @@
 # stdlib imports
 import numpy as np
 import collections
-import shutil
-import tempfile
 import os
+import threading
 
 
 # local imports
-from mapio.shake import ShakeGrid
-from mapio.gdal import GDALGrid
 from mapio.geodict import GeoDict
-from gfail.spatial import quickcut
+from gfail.population import getPopulationGrid
+from gfail.shakecache import loadShakeGrid, getShakeLayer
 from mapio.grid2d import Grid2D
 from skimage.measure import block_reduce
+from scipy import sparse
 
 from configobj import ConfigObj
 
+#: Semi-major axis (km) and flattening of the WGS84 ellipsoid
+WGS84_A = 6378.137
+WGS84_F = 1. / 298.257223563
+
+#: Number of geodictionaries whose cell areas are kept
+MAXAREAS = 32
+
+_AREAS = collections.OrderedDict()
+_AREALOCK = threading.Lock()
+
 # Make fonts readable and recognizable by illustrator
 import matplotlib as mpl
 mpl.rcParams['pdf.fonttype'] = 42
@@ -29,7 +38,7 @@ mpl.rcParams['font.sans-serif'] = ['Arial',
 
 def computeStats(grid2D, probthresh=None, shakefile=None,
                  shakethreshtype='pga', shakethresh=0.0,
-                 statprobthresh=None, pop_file=None):
+                 statprobthresh=None, pop_file=None, proj='moll'):
     """
     Compute summary stats of a ground failure model output.
 
@@ -46,6 +55,8 @@ def computeStats(grid2D, probthresh=None, shakefile=None,
         statprobthresh: Optional, None or float, exclude any cells with probabilities
             less than or equal to this value
         pop_file (str): File path to population file to use to compute exposure stats
+        proj: Optional, how cell areas are computed for Hagg and Parea, see
+            computeHagg.
 
     Returns:
         dict: Dictionary with the following keys:
@@ -56,70 +67,298 @@ def computeStats(grid2D, probthresh=None, shakefile=None,
             - Parea_# where # is the probability threshold
             - exp_pop_# where # is the shaking threshold (if pop_file specified)
     """
-    stats = collections.OrderedDict()
-    grid = grid2D.getData().copy()
-    if statprobthresh is not None:
-        grid = grid[grid > statprobthresh]
-    else:
-        statprobthresh = 0.0
+    if pop_file is None:
+        pop_file = getDefaultPopFile()
 
-    if len(grid) == 0:
-        print('no probability values above statprobthresh')
-        stats['Max'] = float('nan')
-        stats['Median'] = float('nan')
-        stats['Std'] = float('nan')
-    else:
-        stats['Max'] = float(np.nanmax(grid))
-        stats['Median'] = float(np.nanmedian(grid))
-        stats['Std'] = float(np.nanstd(grid))
-    Hagg = computeHagg(grid2D, probthresh=statprobthresh, shakefile=shakefile,
-                       shakethreshtype=shakethreshtype,
-                       shakethresh=shakethresh)
-    if type(Hagg) != list and type(Hagg) != list:
-        shakethresh = [shakethresh]
-        Hagg = [Hagg]
-
-    for T, H in zip(shakethresh, Hagg):
-        if T == 0.:
-            stats['Hagg'] = float(H)
+    engine = StatsEngine(grid2D, shakefile=shakefile,
+                         shakethreshtype=shakethreshtype,
+                         statprobthresh=statprobthresh, pop_file=pop_file,
+                         proj=proj)
+    return engine.getStats(probthresh=probthresh, shakethresh=shakethresh)
+
+
+def getDefaultPopFile():
+    """
+    Get the population file from .gfail_defaults.
+
+    Returns:
+        str: Path to the population file, or None if it is not set.
+    """
+    try:
+        # Try to find population file in .gfail_defaults
+        default_file = os.path.join(
+            os.path.expanduser('~'), '.gfail_defaults')
+        defaults = ConfigObj(default_file)
+        return defaults['popfile']
+    except:
+        print('No population file specified nor found in .gfail_defaults, '
+              'skipping exp_pop')
+    return None
+
+
+class StatsEngine(object):
+    def __init__(self, grid2D, shakefile=None, shakethreshtype='pga',
+                 statprobthresh=None, pop_file=None, proj='moll'):
+        """
+        Summary stats of a ground failure model output for any number of
+        thresholds. The model, shaking and population grids are resampled
+        once, and the cells are sorted by shaking (Hagg, exposure) or by
+        probability (Parea) so each threshold is a lookup in cumulative
+        sums.
+
+        Args:
+            grid2D: grid2D object of model output.
+            shakefile: Optional, path to shakemap file to use for ground
+                motion thresholds.
+            shakethreshtype: Optional, Type of ground motion to use for
+                shaking thresholds, 'pga', 'pgv', or 'mmi'.
+            statprobthresh: Optional, None or float, exclude any cells with
+                probabilities less than or equal to this value
+            pop_file (str): Optional, path to population file to use to
+                compute exposure stats.
+            proj: Optional, how cell areas are computed for Hagg and Parea,
+                see computeHagg.
+        """
+        if statprobthresh is not None and statprobthresh < 0.:
+            raise Exception('probability threshold must be equal or greater '
+                            'than zero')
+        self.grid2D = grid2D
+        self.shakefile = shakefile
+        self.shakethreshtype = shakethreshtype
+        self.statprobthresh = statprobthresh
+        self.pop_file = pop_file
+        self.proj = proj
+        self._hagg = None
+        self._parea = None
+        self._exposure = None
+
+    def getSummary(self):
+        """
+        Max, median and standard deviation of the model, of the cells
+        above statprobthresh if set.
+
+        Returns:
+            OrderedDict: Dictionary with keys Max, Median and Std.
+        """
+        stats = collections.OrderedDict()
+        grid = self.grid2D.getData()
+        if self.statprobthresh is not None:
+            grid = grid[grid > self.statprobthresh]
+
+        if len(grid) == 0:
+            print('no probability values above statprobthresh')
+            stats['Max'] = float('nan')
+            stats['Median'] = float('nan')
+            stats['Std'] = float('nan')
         else:
-            newkey = 'Hagg_%1.2fg' % (T/100.)
-            stats[newkey] = float(H)
+            stats['Max'] = float(np.nanmax(grid))
+            stats['Median'] = float(np.nanmedian(grid))
+            stats['Std'] = float(np.nanstd(grid))
+        return stats
+
+    def getHagg(self, shakethresh=0.0):
+        """
+        Aggregate hazard of the cells with shaking of at least each
+        threshold, see computeHagg.
+
+        Args:
+            shakethresh: Float or list of shaking thresholds.
+
+        Returns:
+            list: Aggregate hazard for each threshold, only one value if
+            there is no shakefile.
+        """
+        shakethresh = _asList(shakethresh)
+        for shaket in shakethresh:
+            if shaket < 0.:
+                raise Exception('shaking threshold must be equal or greater '
+                                'than zero')
+        if self._hagg is None:
+            shk = None
+            if self.shakefile is not None:
+                geodict = self.grid2D.getGeoDict()
+                shk = getShakeLayer(self.shakefile, self.shakethreshtype,
+                                    geodict, method='bilinear')
+                if shk.getGeoDict() != geodict:
+                    raise Exception('shakemap was not resampled to exactly '
+                                    'the same geodict as the model')
+            model, cell_area_km2, shkdat = _getAreaArrays(
+                self.grid2D, self.proj, shk)
+            probthresh = self.statprobthresh
+            if probthresh is None:
+                probthresh = 0.0
+            keep = model >= probthresh  # Never true for nan
+            hazard = (model * cell_area_km2)[keep]
+            if shkdat is None:
+                self._hagg = _CumulativeSum(None, hazard)
+            else:
+                # nan shaking is below all thresholds
+                self._hagg = _CumulativeSum(
+                    np.where(np.isnan(shkdat), -1., shkdat)[keep], hazard)
+        if self.shakefile is None:
+            return [self._hagg.total]
+        return [self._hagg.above(shaket) for shaket in shakethresh]
+
+    def getParea(self, probthresh):
+        """
+        Area of the cells with probability of at least each threshold, see
+        computeParea.
+
+        Args:
+            probthresh: Float or list of probability thresholds.
+
+        Returns:
+            list: Area for each threshold.
+        """
+        probthresh = _asList(probthresh)
+        for probt in probthresh:
+            if probt < 0.:
+                raise Exception('probability threshold must be equal or '
+                                'greater than zero')
+        if self._parea is None:
+            model, cell_area_km2, shkdat = _getAreaArrays(self.grid2D,
+                                                          self.proj)
+            # nan probabilities are below all thresholds
+            model = np.where(np.isnan(model), -1., model)
+            self._parea = _CumulativeSum(
+                model.ravel(),
+                np.broadcast_to(cell_area_km2, model.shape).ravel())
+        return [self._parea.above(probt) for probt in probthresh]
+
+    def getExposures(self, shakethresh=0.0):
+        """
+        Population exposure of the cells with shaking above each threshold,
+        see get_exposures.
+
+        Args:
+            shakethresh: Float or list of shaking thresholds.
+
+        Returns:
+            OrderedDict: Dictionary with keys named exp_pop_# where # is the
+            shaking threshold, empty if there is no pop_file.
+        """
+        exp_pop = collections.OrderedDict()
+        if self.pop_file is None:
+            return exp_pop
+        if self._exposure is None:
+            probthresh = self.statprobthresh
+            if probthresh is None:
+                probthresh = 0.0
+            exposed, shkdat = _getExposureArrays(
+                self.grid2D, self.pop_file, self.shakefile,
+                self.shakethreshtype, probthresh)
+            exposed = np.where(np.isnan(exposed), 0., exposed).ravel()
+            if shkdat is None:
+                self._exposure = _CumulativeSum(None, exposed)
+            else:
+                # nan shaking is not above any threshold
+                self._exposure = _CumulativeSum(
+                    np.where(np.isnan(shkdat), -np.inf, shkdat).ravel(),
+                    exposed)
+        if self.shakefile is None:
+            exp_pop[_getExposureName(0.)] = self._exposure.total
+            return exp_pop
+        for shaket in _asList(shakethresh):
+            exp_pop[_getExposureName(shaket)] = self._exposure.above(
+                shaket, strict=True)
+        return exp_pop
+
+    def getStats(self, probthresh=None, shakethresh=0.0):
+        """
+        All summary stats, see computeStats for the arguments and the
+        returned dictionary.
+        """
+        stats = self.getSummary()
+        shakethresh = _asList(shakethresh)
+        for T, H in zip(shakethresh, self.getHagg(shakethresh)):
+            stats[_getHaggName(T)] = float(H)
+
+        if probthresh is not None:
+            probthresh = _asList(probthresh)
+            for T, P in zip(probthresh, self.getParea(probthresh)):
+                stats[_getPareaName(T)] = float(P)
+
+        stats.update(self.getExposures(shakethresh))
+        return stats
+
+
+def getStatNames(probthresh=None, shakethresh=0.0, shakefile=True,
+                 pop_file=True):
+    """
+    Names of the stats returned by computeStats.
 
+    Args:
+        probthresh: Float or list of probability thresholds, or None.
+        shakethresh: Float or list of shaking thresholds.
+        shakefile: Whether a shakefile is used.
+        pop_file: Whether a population file is used.
+
+    Returns:
+        list: Names of the stats, in the order computeStats returns them.
+    """
+    shakethresh = _asList(shakethresh)
+    if not shakefile:
+        # Only one Hagg without shaking thresholds
+        shakethresh = shakethresh[:1]
+    names = ['Max', 'Median', 'Std']
+    names += [_getHaggName(T) for T in shakethresh]
     if probthresh is not None:
-        Parea = computeParea(grid2D, probthresh=probthresh, shakefile=None,
-                             shakethreshtype=shakethreshtype, shakethresh=0.0)
-        if type(Parea) != list and type(Parea) != np.ndarray:
-            probthresh = [probthresh]
-            Parea = [Parea]
-
-        for T, P in zip(probthresh, Parea):
-            if T == 0.:
-                stats['Parea'] = float(P)
-            else:
-                newkey = 'Parea_%1.2f' % T
-                stats[newkey] = float(P)
+        names += [_getPareaName(T) for T in _asList(probthresh)]
+    if pop_file:
+        if shakefile:
+            names += [_getExposureName(T) for T in shakethresh]
+        else:
+            names.append(_getExposureName(0.))
+    return list(collections.OrderedDict.fromkeys(names))
 
-    if pop_file is None:
-        try:
-            # Try to find population file in .gfail_defaults
-            default_file = os.path.join(
-                os.path.expanduser('~'), '.gfail_defaults')
-            defaults = ConfigObj(default_file)
-            pop_file = defaults['popfile']
-        except:
-            print('No population file specified nor found in .gfail_defaults, '
-                  'skipping exp_pop')
-
-    if pop_file is not None:
-        exp_dict = get_exposures(grid2D, pop_file, shakefile=shakefile,
-                                 shakethreshtype=shakethreshtype,
-                                 shakethresh=shakethresh,
-                                 probthresh=statprobthresh)
-        for k, v in exp_dict.items():
-            stats[k] = v
-
-    return stats
+
+def _getHaggName(shaket):
+    if shaket == 0.:
+        return 'Hagg'
+    return 'Hagg_%1.2fg' % (shaket/100.)
+
+
+def _getPareaName(probt):
+    if probt == 0.:
+        return 'Parea'
+    return 'Parea_%1.2f' % probt
+
+
+def _getExposureName(shaket):
+    return 'exp_pop_%1.2fg' % (shaket/100.,)
+
+
+class _CumulativeSum(object):
+    def __init__(self, keys, values):
+        """
+        Sums of values over the keys above any threshold, from the values
+        sorted by key. Without keys only the total is available.
+        """
+        self.total = np.sum(values)
+        if keys is None:
+            return
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        # Summed from the largest keys so small sums keep their precision
+        self.sums = np.concatenate(([0.], np.cumsum(values[order][::-1])))
+
+    def above(self, thresh, strict=False):
+        """
+        Sum of the values with keys of at least thresh, or above thresh if
+        strict.
+        """
+        side = 'right' if strict else 'left'
+        count = len(self.keys) - np.searchsorted(self.keys, thresh, side=side)
+        return self.sums[count]
+
+
+def _asList(value):
+    """
+    Threshold or list of thresholds as a list.
+    """
+    if type(value) != list and type(value) != np.ndarray:
+        return [value]
+    return list(value)
 
 
 def computeHagg(grid2D, proj='moll', probthresh=0.0, shakefile=None,
@@ -132,7 +371,9 @@ def computeHagg(grid2D, proj='moll', probthresh=0.0, shakefile=None,
     Args:
         grid2D: grid2D object of model output.
         proj: projection to use to obtain equal area, 'moll'  mollweide, or
-            'laea' lambert equal area.
+            'laea' lambert equal area, or 'ellipsoid' to use the areas of the
+            cells on the WGS84 ellipsoid without reprojecting, see
+            getCellAreas.
         probthresh: Probability threshold, any values less than this will not
             be included in aggregate hazard estimation.
         shakefile: Optional, path to shakemap file to use for ground motion
@@ -146,13 +387,9 @@ def computeHagg(grid2D, proj='moll', probthresh=0.0, shakefile=None,
         otherwise, a list of floats of aggregate hazard for all shakethresh values.
     """
     Hagg = []
-    bounds = grid2D.getBounds()
-    lat0 = np.mean((bounds[2], bounds[3]))
-    lon0 = np.mean((bounds[0], bounds[1]))
-    projs = ('+proj=%s +lat_0=%f +lon_0=%f +x_0=0 +y_0=0 +ellps=WGS84 '
-             '+units=km +no_defs' % (proj, lat0, lon0))
     geodict = grid2D.getGeoDict()
 
+    shk = None
     if shakefile is not None:
         if type(shakethresh) != list and type(shakethresh) != np.ndarray:
             shakethresh = [shakethresh]
@@ -160,13 +397,9 @@ def computeHagg(grid2D, proj='moll', probthresh=0.0, shakefile=None,
             if shaket < 0.:
                 raise Exception('shaking threshold must be equal or greater '
                                 'than zero')
-        tmpdir = tempfile.mkdtemp()
         # resample shakemap to grid2D
-        temp = ShakeGrid.load(shakefile)
-        junkfile = os.path.join(tmpdir, 'temp.bil')
-        GDALGrid.copyFromGrid(temp.getLayer(shakethreshtype)).save(junkfile)
-        shk = quickcut(junkfile, geodict, precise=True, method='bilinear')
-        shutil.rmtree(tmpdir)
+        shk = getShakeLayer(shakefile, shakethreshtype, geodict,
+                            method='bilinear')
         if shk.getGeoDict() != geodict:
             raise Exception('shakemap was not resampled to exactly the same '
                             'geodict as the model')
@@ -175,23 +408,19 @@ def computeHagg(grid2D, proj='moll', probthresh=0.0, shakefile=None,
         raise Exception('probability threshold must be equal or greater '
                         'than zero')
 
-    grid = grid2D.project(projection=projs, method='bilinear')
-    geodictRS = grid.getGeoDict()
-    cell_area_km2 = geodictRS.dx * geodictRS.dy
-    model = grid.getData()
+    model, cell_area_km2, shkdat = _getAreaArrays(grid2D, proj, shk)
     model[np.isnan(model)] = -1.
     if shakefile is not None:
+        # use -1 to avoid nan errors and warnings, will always be thrown
+        # out because default is 0.
+        shkdat[np.isnan(shkdat)] = -1.
         for shaket in shakethresh:
             modcop = model.copy()
-            shkgrid = shk.project(projection=projs)
-            shkdat = shkgrid.getData()
-            # use -1 to avoid nan errors and warnings, will always be thrown
-            # out because default is 0.
-            shkdat[np.isnan(shkdat)] = -1.
             modcop[shkdat < shaket] = -1.
-            Hagg.append(np.sum(modcop[modcop >= probthresh] * cell_area_km2))
+            Hagg.append(np.sum((modcop * cell_area_km2)[
+                modcop >= probthresh]))
     else:
-        Hagg.append(np.sum(model[model >= probthresh] * cell_area_km2))
+        Hagg.append(np.sum((model * cell_area_km2)[model >= probthresh]))
     if len(Hagg) == 1:
         Hagg = Hagg[0]
     return Hagg
@@ -206,7 +435,9 @@ def computeParea(grid2D, proj='moll', probthresh=0.0, shakefile=None,
     Args:
         grid2D: grid2D object of model output.
         proj: projection to use to obtain equal area, 'moll'  mollweide, or
-            'laea' lambert equal area.
+            'laea' lambert equal area, or 'ellipsoid' to use the areas of the
+            cells on the WGS84 ellipsoid without reprojecting, see
+            getCellAreas.
         probthresh: Optional, Float or list of probability thresholds.
         shakefile: Optional, path to shakemap file to use for ground motion
             threshold.
@@ -224,62 +455,119 @@ def computeParea(grid2D, proj='moll', probthresh=0.0, shakefile=None,
         probthresh = [probthresh]
 
     Parea = []
-    bounds = grid2D.getBounds()
-    lat0 = np.mean((bounds[2], bounds[3]))
-    lon0 = np.mean((bounds[0], bounds[1]))
-    projs = ('+proj=%s +lat_0=%f +lon_0=%f +x_0=0 +y_0=0 +ellps=WGS84 '
-             '+units=km +no_defs' % (proj, lat0, lon0))
     geodict = grid2D.getGeoDict()
 
+    shk = None
     if shakefile is not None:
         if shakethresh < 0.:
             raise Exception('shaking threshold must be equal or greater '
                             'than zero')
-        tmpdir = tempfile.mkdtemp()
         # resample shakemap to grid2D
-        temp = ShakeGrid.load(shakefile)
-        junkfile = os.path.join(tmpdir, 'temp.bil')
-        GDALGrid.copyFromGrid(temp.getLayer(shakethreshtype)).save(junkfile)
-        shk = quickcut(junkfile, geodict, precise=True,
-                       method='bilinear')
-        shutil.rmtree(tmpdir)
+        shk = getShakeLayer(shakefile, shakethreshtype, geodict,
+                            method='bilinear')
         if shk.getGeoDict() != geodict:
             raise Exception('shakemap was not resampled to exactly the same '
                             'geodict as the model')
 
-    grid = grid2D.project(projection=projs)
-    geodictRS = grid.getGeoDict()
-    cell_area_km2 = geodictRS.dx * geodictRS.dy
-    model = grid.getData()
+    model, cell_area_km2, shkdat = _getAreaArrays(grid2D, proj, shk)
     model[np.isnan(model)] = -1.
+    if shakefile is not None:
+        # use -1 to avoid nan errors and warnings, will always be thrown
+        # out because default probthresh is 0 and must be positive.
+        shkdat[np.isnan(shkdat)] = -1.
     for probt in probthresh:
         if probt < 0.:
             raise Exception('probability threshold must be equal or greater '
                             'than zero')
         modcop = model.copy()
         if shakefile is not None:
-            shkgrid = shk.project(projection=projs)
-            shkdat = shkgrid.getData()
-            # use -1 to avoid nan errors and warnings, will always be thrown
-            # out because default probthresh is 0 and must be positive.
-            shkdat[np.isnan(shkdat)] = -1.
             modcop[shkdat < shakethresh] = -1.
         one_mat = np.ones_like(modcop)
-        Parea.append(np.sum(one_mat[modcop >= probt] * cell_area_km2))
+        Parea.append(np.sum((one_mat * cell_area_km2)[modcop >= probt]))
 
     if len(Parea) == 1:
         Parea = Parea[0]
     return Parea
 
 
+def getCellAreas(geodict):
+    """
+    Areas of the cells of each row of a lat/lon grid on the WGS84 ellipsoid.
+
+    The area of a cell between latitudes phi1 and phi2 and longitudes
+    dlambda apart is a**2 * (1 - e**2) * dlambda * (q(phi2) - q(phi1)) / 2,
+    where q is the authalic latitude function, so it only depends on the row.
+    Areas are kept for the last geodictionaries asked for. Hagg and Parea
+    computed with these areas are within about 2% of the values computed by
+    reprojecting to an equal area projection, which resamples the grid and
+    adds cells at its edges; 'moll' and 'laea' differ by as much.
+
+    Args:
+        geodict (GeoDict): Geodictionary of the grid.
+
+    Returns:
+        ndarray: Read only array of ny cell areas in km2, from north to south.
+    """
+    key = (geodict.ymax, geodict.dy, geodict.ny, geodict.dx)
+    with _AREALOCK:
+        areas = _AREAS.get(key)
+        if areas is not None:
+            _AREAS.move_to_end(key)
+            return areas
+    edges = np.radians(np.clip(
+        geodict.ymax + geodict.dy * (0.5 - np.arange(geodict.ny + 1)),
+        -90., 90.))
+    ecc = np.sqrt(WGS84_F * (2. - WGS84_F))
+    sin = np.sin(edges)
+    q = (sin / (1. - (ecc * sin)**2) +
+         np.log((1. + ecc * sin) / (1. - ecc * sin)) / (2. * ecc))
+    areas = (WGS84_A**2 * (1. - ecc**2) * np.radians(geodict.dx) *
+             (q[:-1] - q[1:]) / 2.)
+    areas.setflags(write=False)
+    with _AREALOCK:
+        _AREAS[key] = areas
+        while len(_AREAS) > MAXAREAS:
+            _AREAS.popitem(last=False)
+    return areas
+
+
+def _getAreaArrays(grid2D, proj, shk=None):
+    """
+    Model data, cell areas in km2 and shakemap data (or None) of a grid
+    projected with proj, or on its own lat/lon grid for 'ellipsoid', as
+    arrays that the caller may modify.
+    """
+    if proj == 'ellipsoid':
+        areas = getCellAreas(grid2D.getGeoDict())[:, np.newaxis]
+        model = grid2D.getData().astype(float)
+        shkdat = None
+        if shk is not None:
+            shkdat = shk.getData().astype(float)
+        return model, np.broadcast_to(areas, model.shape), shkdat
+
+    bounds = grid2D.getBounds()
+    lat0 = np.mean((bounds[2], bounds[3]))
+    lon0 = np.mean((bounds[0], bounds[1]))
+    projs = ('+proj=%s +lat_0=%f +lon_0=%f +x_0=0 +y_0=0 +ellps=WGS84 '
+             '+units=km +no_defs' % (proj, lat0, lon0))
+    grid = grid2D.project(projection=projs, method='bilinear')
+    geodictRS = grid.getGeoDict()
+    cell_area_km2 = geodictRS.dx * geodictRS.dy
+    shkdat = None
+    if shk is not None:
+        shkdat = shk.project(projection=projs).getData()
+    return grid.getData(), cell_area_km2, shkdat
+
+
 def get_exposures(grid, pop_file, shakefile=None, shakethreshtype=None,
-                  shakethresh=None, probthresh=None):
+                  shakethresh=None, probthresh=None, method='exact'):
     """
     Get exposure-based statistics.
 
     Args:
         grid: Model grid.
-        pop_file (str):  Path to the landscan population grid.
+        pop_file (str):  Path to the landscan population grid, or to a
+            manifest made by gfail.population.convertPopulation.
         shakefile (str): Optional, path to shakemap file to use for ground
             motion threshold.
         shakethreshtype(str): Optional, Type of ground motion to use for
@@ -288,11 +576,39 @@ def get_exposures(grid, pop_file, shakefile=None, shakethreshtype=None,
             pga, cm/s for pgv, float for mmi.
         probthresh: Optional, None or float, exclude any cells with probabilities
             less than or equal to this value
+        method (str): How the model is averaged over the population cells,
+            'exact' weights the model cells by the area they share with each
+            population cell, 'upsample' interpolates the model to a multiple
+            of the population resolution and block averages it.
 
     Returns:
         dict: Dictionary with keys named exp_pop_# where # is the shakethresh
     """
 
+    exposed, shkdat = _getExposureArrays(grid, pop_file, shakefile,
+                                         shakethreshtype, probthresh, method)
+
+    exp_pop = {}
+    if shakefile is not None:
+        for shaket in shakethresh:
+            threshmult = shkdat > shaket
+            threshmult = threshmult.astype(float)
+            exp_pop['exp_pop_%1.2fg' % (shaket/100.,)] = np.nansum(
+                exposed * threshmult)
+
+    else:
+        exp_pop['exp_pop_0.00g'] = np.nansum(exposed)
+
+    return exp_pop
+
+
+def _getExposureArrays(grid, pop_file, shakefile=None, shakethreshtype=None,
+                       probthresh=None, method='exact'):
+    """
+    Population of each cell of the population grid times the model
+    probability over the cell, and the shaking on the population grid (or
+    None), see get_exposures.
+    """
     # If probthresh defined, zero out any areas less than or equal to probthresh
     # before proceeding
 
@@ -306,12 +622,99 @@ def get_exposures(grid, pop_file, shakefile=None, shakethreshtype=None,
 
     mdict = grid.getGeoDict()
 
-    # Cut out area from population file
-    popcut = quickcut(pop_file, mdict, precise=False,
-                      extrasamp=2., method='nearest')
+    # Cut out area from population file, the window is kept for the other
+    # models of the event
+    popcut = getPopulationGrid(pop_file).getWindow(mdict, extrasamp=2.)
     popdat = popcut.getData()
     pdict = popcut.getGeoDict()
 
+    if method == 'exact':
+        # nan and areas outside of the model count as zero probability
+        prop = 1.
+        modresamp = resampleArea(moddat, mdict, pdict)
+    elif method == 'upsample':
+        prop, modresamp = _upsampleModel(moddat, mdict, pdict)
+    else:
+        raise Exception('Unknown exposure method %s' % method)
+
+    shkdat = None
+    if shakefile is not None:
+        # Resample shakefile to population grid
+        # , doPadding=True, padValue=0.)
+        shakemap = loadShakeGrid(shakefile).getLayer(shakethreshtype)
+        shakemap = shakemap.interpolate2(pdict)
+        shkdat = shakemap.getData()
+    return popdat * prop * modresamp, shkdat
+
+
+def resampleArea(data, gdict, newgdict):
+    """
+    Average a grid over the cells of another grid, weighting each cell by
+    the exact area it shares with the new cell. Both grids are axis aligned
+    lat/lon grids, so the weights are the products of the overlaps of the
+    rows and of the columns and the average is two sparse matrix products.
+
+    Args:
+        data (ndarray): Data of the grid.
+        gdict (GeoDict): Geodictionary of data.
+        newgdict (GeoDict): Geodictionary of the new grid.
+
+    Returns:
+        ndarray: Array of the shape of newgdict, where nan cells of data and
+        parts of new cells outside of gdict count as zero.
+    """
+    wx = getOverlapMatrix(gdict.xmin - gdict.dx/2., gdict.dx, gdict.nx,
+                          newgdict.xmin - newgdict.dx/2., newgdict.dx,
+                          newgdict.nx)
+    # Rows go from north to south
+    wy = getOverlapMatrix(-gdict.ymax - gdict.dy/2., gdict.dy, gdict.ny,
+                          -newgdict.ymax - newgdict.dy/2., newgdict.dy,
+                          newgdict.ny)
+    data = np.where(np.isnan(data), 0., data)
+    return np.asarray(wy.dot(wx.dot(data.T).T))
+
+
+def getOverlapMatrix(start, step, n, newstart, newstep, newn):
+    """
+    Fractions of the cells of a 1-D grid covered by the cells of another.
+
+    Args:
+        start (float): Left edge of the first cell of the grid.
+        step (float): Width of the cells of the grid.
+        n (int): Number of cells of the grid.
+        newstart (float): Left edge of the first cell of the new grid.
+        newstep (float): Width of the cells of the new grid.
+        newn (int): Number of cells of the new grid.
+
+    Returns:
+        scipy.sparse.csr_matrix: Matrix of shape (newn, n) where element
+        (i, j) is the fraction of new cell i covered by cell j.
+    """
+    edges = start + step * np.arange(n + 1)
+    newedges = newstart + newstep * np.arange(newn + 1)
+    # Split the axis into pieces that are each within one cell of each grid
+    cuts = np.union1d(edges, newedges)
+    cuts = cuts[(cuts >= max(edges[0], newedges[0])) &
+                (cuts <= min(edges[-1], newedges[-1]))]
+    if len(cuts) < 2:
+        return sparse.csr_matrix((newn, n))
+    mids = (cuts[:-1] + cuts[1:]) / 2.
+    cols = np.clip(np.searchsorted(edges, mids) - 1, 0, n - 1)
+    rows = np.clip(np.searchsorted(newedges, mids) - 1, 0, newn - 1)
+    weights = np.diff(cuts) / newstep
+    return sparse.coo_matrix((weights, (rows, cols)),
+                             shape=(newn, n)).tocsr()
+
+
+def _upsampleModel(moddat, mdict, pdict):
+    """
+    Resample the model to the population grid by interpolating it to an
+    integer multiple of the population resolution and block averaging it.
+
+    Returns:
+        tuple: (prop, modresamp), the proportion of each population cell
+        with model values and the mean of these values.
+    """
     # Pad grid with nans to beyond extent of pdict
     pad_dict = {}
     pad_dict['padleft'] = int(
@@ -349,22 +752,4 @@ def get_exposures(grid, pop_file, shakefile=None, shakethreshtype=None,
     modresamp = block_reduce(grid2.getData().copy(),
                              block_size=(int(factor), int(factor)),
                              cval=float('nan'), func=np.nanmean)
-
-    exp_pop = {}
-    if shakefile is not None:
-        # Resample shakefile to population grid
-        # , doPadding=True, padValue=0.)
-        shakemap = ShakeGrid.load(shakefile, resample=False)
-        shakemap = shakemap.getLayer(shakethreshtype)
-        shakemap = shakemap.interpolate2(pdict)
-        shkdat = shakemap.getData()
-        for shaket in shakethresh:
-            threshmult = shkdat > shaket
-            threshmult = threshmult.astype(float)
-            exp_pop['exp_pop_%1.2fg' % (shaket/100.,)] = np.nansum(
-                popdat * prop * modresamp * threshmult)
-
-    else:
-        exp_pop['exp_pop_0.00g'] = np.nansum(popdat * prop * modresamp)
-
-    return exp_pop
+    return prop, modresamp
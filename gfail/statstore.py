@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Store of the summary statistics of the models of an event.
+
+hazdev, GFSummary and create_info compute summary statistics (Hagg, Parea,
+population exposure) of the same models for the same ShakeMap, and the
+population exposure is one of the slowest steps of making the product
+pages. A StatsStore computes the statistics of a model the first time they
+are requested, keeps them in memory along with the StatsEngine of the model
+so other thresholds are quick to add, and saves them to a JSON sidecar in
+the event directory so later runs for the same model and ShakeMap version
+read them back.
+
+Statistics are keyed by the event id and ShakeMap version, a digest of the
+model grid (so rerunning a model with a different configuration never reads
+stale values) and the settings that change the values (shaking type,
+statprobthresh, population file and projection).
+"""
+
+# stdlib imports
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# local imports
+from gfail.stats import StatsEngine, getStatNames, getDefaultPopFile
+from gfail.shakecache import getShakeHeader
+
+
+#: Name of the sidecar file in the event directory
+STATSFILE = 'stats.json'
+
+#: Number of StatsEngine objects kept in memory by each store
+MAXENGINES = 8
+
+#: Number of event stores kept in memory by getStatsStore
+MAXSTORES = 4
+
+
+class StatsStore(object):
+    def __init__(self, filename=None):
+        """
+        Store of summary statistics.
+
+        Args:
+            filename (str): Path to the JSON file where statistics are saved
+                so they can be reused by later runs, None to only keep them
+                in memory.
+        """
+        self.filename = filename
+        self.entries = {}
+        self.engines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if filename is not None:
+            self._load()
+
+    def getStats(self, grid2D, probthresh=None, shakefile=None,
+                 shakethreshtype='pga', shakethresh=0.0, statprobthresh=None,
+                 pop_file=None, proj='moll', model=None):
+        """
+        Stored version of gfail.stats.computeStats, see computeStats for
+        the arguments and the returned dictionary.
+
+        Args:
+            model (str): Name of the model, only saved for reference.
+        """
+        if pop_file is None:
+            pop_file = getDefaultPopFile()
+        key, info = getStatsKey(grid2D, shakefile, shakethreshtype,
+                                statprobthresh, pop_file, proj)
+        names = getStatNames(probthresh, shakethresh,
+                             shakefile=shakefile is not None,
+                             pop_file=pop_file is not None)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and \
+                    all(name in entry['stats'] for name in names):
+                self.hits += 1
+                return OrderedDict(
+                    (name, entry['stats'][name]) for name in names)
+        self.misses += 1
+        stats = self._getEngine(key, grid2D, shakefile, shakethreshtype,
+                                statprobthresh, pop_file, proj).getStats(
+            probthresh=probthresh, shakethresh=shakethresh)
+        with self.lock:
+            entry = self.entries.setdefault(key, {'stats': {}})
+            entry.update(info)
+            if model is not None:
+                entry['model'] = model
+            entry['stats'].update(stats)
+            self._save()
+        return stats
+
+    def clear(self):
+        """
+        Forget all statistics, the sidecar file is kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.engines.clear()
+
+    def _getEngine(self, key, grid2D, shakefile, shakethreshtype,
+                   statprobthresh, pop_file, proj):
+        """
+        StatsEngine of a model, kept for the last models asked for.
+        """
+        with self.lock:
+            engine = self.engines.get(key)
+            if engine is not None:
+                self.engines.move_to_end(key)
+                return engine
+            engine = StatsEngine(grid2D, shakefile=shakefile,
+                                 shakethreshtype=shakethreshtype,
+                                 statprobthresh=statprobthresh,
+                                 pop_file=pop_file, proj=proj)
+            self.engines[key] = engine
+            while len(self.engines) > MAXENGINES:
+                self.engines.popitem(last=False)
+        return engine
+
+    def _load(self):
+        """
+        Read the statistics saved in filename, if any.
+        """
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries.update(json.load(f))
+        except Exception:
+            pass
+
+    def _save(self):
+        """
+        Save the statistics in filename.
+        """
+        if self.filename is None:
+            return
+        temp = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            # Written under a temporary name first so that other runs never
+            # read a partial file
+            with open(temp, 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(temp, self.filename)
+        except Exception as e:
+            print('Could not save statistics: %s' % e)
+
+
+def getStatsKey(grid2D, shakefile=None, shakethreshtype='pga',
+                statprobthresh=None, pop_file=None, proj='moll'):
+    """
+    Return the key of the statistics of a model and a dictionary describing
+    what they were computed from.
+    """
+    gdict = grid2D.getGeoDict()
+    digest = hashlib.md5(grid2D.getData().tobytes())
+    # Rounded, since grids read back from the hdf5 outputs have geodicts
+    # that differ in the last digits
+    digest.update(json.dumps([round(value, 9) for value in [
+        gdict.xmin, gdict.xmax, gdict.ymin, gdict.ymax, gdict.dx,
+        gdict.dy]] + [gdict.nx, gdict.ny]).encode())
+    info = {'grid': digest.hexdigest()}
+    if shakefile is not None:
+        griddict = getShakeHeader(shakefile)[0]
+        info['event_id'] = griddict.get('event_id')
+        info['shakemap_version'] = griddict.get('shakemap_version')
+        info['shakethreshtype'] = shakethreshtype
+    if pop_file is not None:
+        stat = os.stat(pop_file)
+        info['pop_file'] = [os.path.abspath(pop_file), stat.st_mtime,
+                            stat.st_size]
+    info['statprobthresh'] = statprobthresh
+    info['proj'] = proj
+    key = hashlib.md5(json.dumps(info, sort_keys=True).encode()).hexdigest()
+    return key, info
+
+
+_STORES = OrderedDict()
+_LOCK = threading.Lock()
+
+
+def getStatsStore(event_dir=None):
+    """
+    Return the statistics store of an event directory, shared by all the
+    functions of this process that make products for the event. Only the
+    MAXSTORES most recently used stores are kept, older ones are read
+    back from their sidecar files when requested again.
+
+    Args:
+        event_dir (str): Directory of the event, where the sidecar file
+            (STATSFILE) is saved, None for a store kept in memory only.
+
+    Returns:
+        StatsStore: Store of the event.
+    """
+    filename = None
+    if event_dir is not None:
+        filename = os.path.abspath(os.path.join(event_dir, STATSFILE))
+    with _LOCK:
+        store = _STORES.get(filename)
+        if store is None:
+            store = StatsStore(filename)
+            _STORES[filename] = store
+        else:
+            _STORES.move_to_end(filename)
+        while len(_STORES) > MAXSTORES:
+            _STORES.popitem(last=False)
+        return store
+
+
+def getAlertStats(grid2D, shakefile, pop_file=None, proj='ellipsoid',
+                  model=None, event_dir=None):
+    """
+    Statistics the alert levels are made from (Hagg_0.10g and
+    exp_pop_0.10g), of all the cells of a model where the shaking is over
+    0.10 g PGA, from the statistics store of an event. hazdev stores them
+    so that create_info reads them back.
+
+    Args:
+        grid2D (Grid2D): Model grid.
+        shakefile (str): Path to the ShakeMap grid.xml file.
+        pop_file (str): Path to the population file.
+        proj (str): How cell areas are computed, see computeStats.
+        model (str): Name of the model, only saved for reference.
+        event_dir (str): Directory of the event, see getStatsStore.
+
+    Returns:
+        dict: Statistics, see computeStats.
+    """
+    return getStatsStore(event_dir).getStats(
+        grid2D, probthresh=None, shakefile=shakefile, shakethreshtype='pga',
+        shakethresh=10.0, statprobthresh=None, pop_file=pop_file, proj=proj,
+        model=model)
+
+
+def clearStatsStores():
+    """
+    Forget all statistics stores of this process.
+    """
+    with _LOCK:
+        _STORES.clear()
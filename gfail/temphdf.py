@@ -1,47 +1,43 @@
 #!/usr/bin/env python3
 
 import os
+import abc
 import tables
 import numpy as np
 
 from mapio.shake import ShakeGrid
 
 
-class TempHdf(object):
-    def __init__(self, grid2dfile, filename, name=None):
-        """
-        Convert grid2d file into a temporary hdf5 file for reducing memory
-        load.
+# Names of the available layer store backends
+BACKENDS = ['hdf5', 'memory', 'memmap']
 
-        Args:
-            grid2dfile: grid2d file object to save
-            filename (str): Path to where file should be saved (recommended
-                it be a temporary dir).
-            name (str): Name of layer, if None, will use filename minus the
-                extension, or if a multihazard grid2d object, each layer will
-                have its own name.
+# Fraction of the available memory that the 'memory' backend may use when
+# the backend is chosen automatically
+MEMORY_FRACTION = 0.5
+
+
+class TempStore(abc.ABC):
+    """
+    Base class of the temporary layer stores. A store holds one or more
+    layers on the same grid and returns slices of them through getSlice.
+    Subclasses define where the data are kept.
+    """
+    #: True if getSlice can be called from several threads at once
+    threadsafe = True
+
+    def _setGrid(self, grid2dfile):
         """
-        filename1, file_ext = os.path.splitext(filename)
-        if file_ext != '.hdf5':
-            filename = filename1 + '.hdf5'
-            print('Changed extension from %s to .hdf5' % (file_ext,))
-        filters = tables.Filters(complevel=5, complib='blosc')
-        with tables.open_file(filename, mode='w') as self.tempfile:
-            self.gdict = grid2dfile.getGeoDict()
-            if type(grid2dfile) == ShakeGrid:
-                for layer in grid2dfile.getLayerNames():
-                    filldat = grid2dfile.getLayer(layer).getData()
-                    self.tempfile.create_carray(self.tempfile.root, name=layer,
-                                                obj=filldat, filters=filters)
-                self.shakedict = grid2dfile.getShakeDict()
-                self.edict = grid2dfile.getEventDict()
-            else:
-                if name is None:
-                    name = os.path.basename(filename1)
-                filldat = grid2dfile.getData()
-                self.tempfile.create_carray(self.tempfile.root, name=name,
-                                            obj=filldat, filters=filters)
-            self.filename = os.path.abspath(filename)
+        Set the geodictionary (and the shake and event dictionaries of
+        ShakeGrid objects) and return a dictionary of the layers to store.
+        """
+        self.gdict = grid2dfile.getGeoDict()
+        layers = {}
+        if type(grid2dfile) == ShakeGrid:
+            for layer in grid2dfile.getLayerNames():
+                layers[layer] = grid2dfile.getLayer(layer).getData()
+            self.shakedict = grid2dfile.getShakeDict()
+            self.edict = grid2dfile.getEventDict()
+        return layers
 
     def getFilepath(self):
         """
@@ -85,12 +81,12 @@ class TempHdf(object):
         Args:
             rowstart (int): Starting row index (inclusive), if None, will
                 start at 0.
-            rowend (int): Ending row index (exclusive), if None, will end at
-                last row.
+            rowend (int): Ending row index (exclusive), if None or -1, will
+                end at last row.
             colstart (int): Starting column index (inclusive), if None, will
                 start at 0.
-            colend (int): Ending column index (exclusive), if None, will end
-                at last row.
+            colend (int): Ending column index (exclusive), if None or -1,
+                will end at last row.
             name (str): Name of layer/child name to return.
 
         Returns:
@@ -98,33 +94,14 @@ class TempHdf(object):
         """
         if name is None:
             name, ext = os.path.splitext(os.path.basename(self.getFilepath()))
-        if rowstart is None:
-            rowstart = ''
-        else:
-            rowstart = int(rowstart)
-        if rowend is None:
-            rowend = ''
-        else:
-            rowend = int(rowend)
-        if colstart is None:
-            colstart = ''
-        else:
-            colstart = int(colstart)
-        if colend is None:
-            colend = ''
-        else:
-            colend = int(colend)
+        return self._read(name, _getIndex(rowstart, rowend),
+                          _getIndex(colstart, colend))
 
-        indstr = '%s:%s, %s:%s' % (rowstart, rowend, colstart, colend)
-        # So end index will actually be captured:
-        indstr = indstr.replace('-1', '')
-        with tables.open_file(self.filename, mode='r') as file1:
-            try:
-                dataslice = eval('file1.root.%s[%s]' % (name, indstr))
-                return dataslice
-            except Exception as e:
-                raise Exception(e)
-        return
+    @abc.abstractmethod
+    def _read(self, name, rows, cols):
+        """
+        Read the rows and columns (slices) of the layer name.
+        """
 
     def getSliceDiv(self, rowmax=None, colmax=None):
         """
@@ -166,3 +143,185 @@ class TempHdf(object):
         rowends = np.tile(rowen, len(colen))
         colends = np.repeat(colen, len(rowen))
         return rowstarts, rowends, colstarts, colends
+
+
+class TempHdf(TempStore):
+    # pytables files must not be read by several threads at once
+    threadsafe = False
+
+    def __init__(self, grid2dfile, filename, name=None):
+        """
+        Convert grid2d file into a temporary hdf5 file for reducing memory
+        load.
+
+        Args:
+            grid2dfile: grid2d file object to save
+            filename (str): Path to where file should be saved (recommended
+                it be a temporary dir).
+            name (str): Name of layer, if None, will use filename minus the
+                extension, or if a multihazard grid2d object, each layer will
+                have its own name.
+        """
+        filename1, file_ext = os.path.splitext(filename)
+        if file_ext != '.hdf5':
+            filename = filename1 + '.hdf5'
+            print('Changed extension from %s to .hdf5' % (file_ext,))
+        filters = tables.Filters(complevel=5, complib='blosc')
+        layers = self._setGrid(grid2dfile)
+        if not layers:
+            if name is None:
+                name = os.path.basename(filename1)
+            layers[name] = grid2dfile.getData()
+        with tables.open_file(filename, mode='w') as tempfile:
+            for layer, filldat in layers.items():
+                tempfile.create_carray(tempfile.root, name=layer,
+                                       obj=filldat, filters=filters)
+        self.filename = os.path.abspath(filename)
+
+    def _read(self, name, rows, cols):
+        with tables.open_file(self.filename, mode='r') as file1:
+            return file1.get_node(file1.root, name)[rows, cols]
+
+
+class TempArray(TempStore):
+    def __init__(self, grid2dfile, filename, name=None):
+        """
+        Keep the layers of a grid2d file in memory, with the same interface
+        as TempHdf. Nothing is written to disk.
+
+        Args:
+            grid2dfile: grid2d file object to save
+            filename (str): Path the layer would have been saved to; only
+                used to name the layer.
+            name (str): Name of layer, if None, will use filename minus the
+                extension, or if a multihazard grid2d object, each layer will
+                have its own name.
+        """
+        filename1, file_ext = os.path.splitext(filename)
+        self.layers = self._setGrid(grid2dfile)
+        if not self.layers:
+            if name is None:
+                name = os.path.basename(filename1)
+            self.layers[name] = grid2dfile.getData().copy()
+        self.filename = os.path.abspath(filename)
+
+    def _read(self, name, rows, cols):
+        return self.layers[name][rows, cols].copy()
+
+
+class TempMemmap(TempStore):
+    def __init__(self, grid2dfile, filename, name=None):
+        """
+        Convert grid2d file into uncompressed temporary .npy files that are
+        read through memory maps, with the same interface as TempHdf.
+
+        Args:
+            grid2dfile: grid2d file object to save
+            filename (str): Path to where file should be saved (recommended
+                it be a temporary dir). Each layer is saved next to it as
+                <filename minus extension>_<layer>.npy.
+            name (str): Name of layer, if None, will use filename minus the
+                extension, or if a multihazard grid2d object, each layer will
+                have its own name.
+        """
+        filename1, file_ext = os.path.splitext(filename)
+        layers = self._setGrid(grid2dfile)
+        if not layers:
+            if name is None:
+                name = os.path.basename(filename1)
+            layers[name] = grid2dfile.getData()
+        self.files = {}
+        self.layers = {}
+        for layer, filldat in layers.items():
+            layerfile = os.path.abspath('%s_%s.npy' % (filename1, layer))
+            np.save(layerfile, filldat)
+            self.files[layer] = layerfile
+        self.filename = os.path.abspath(filename)
+
+    def _read(self, name, rows, cols):
+        if name not in self.layers:
+            self.layers[name] = np.load(self.files[name], mmap_mode='r')
+        return np.array(self.layers[name][rows, cols])
+
+    def __getstate__(self):
+        # Memory maps are reopened by each process
+        state = self.__dict__.copy()
+        state['layers'] = {}
+        return state
+
+
+def getTempStore(grid2dfile, filename, name=None, backend='hdf5'):
+    """
+    Create a temporary layer store using the requested backend.
+
+    Args:
+        grid2dfile: grid2d file object to save
+        filename (str): Path to where file should be saved (recommended
+            it be a temporary dir).
+        name (str): Name of layer, if None, will use filename minus the
+            extension, or if a multihazard grid2d object, each layer will
+            have its own name.
+        backend (str): One of BACKENDS, 'hdf5' (compressed file, TempHdf),
+            'memory' (TempArray) or 'memmap' (TempMemmap).
+
+    Returns:
+        TempStore: Layer store holding the grid.
+    """
+    if backend == 'hdf5':
+        return TempHdf(grid2dfile, filename, name=name)
+    elif backend == 'memory':
+        return TempArray(grid2dfile, filename, name=name)
+    elif backend == 'memmap':
+        return TempMemmap(grid2dfile, filename, name=name)
+    else:
+        raise Exception('Unknown layer store backend %s, must be one of %s'
+                        % (backend, BACKENDS))
+
+
+def chooseBackend(nbytes):
+    """
+    Choose a layer store backend from the memory available on this machine.
+
+    Args:
+        nbytes (int): Estimated number of bytes of all layers to store.
+
+    Returns:
+        str: 'memory' if the layers fit in MEMORY_FRACTION of the available
+        memory, otherwise 'hdf5'.
+    """
+    available = getAvailableMemory()
+    if available is not None and nbytes < MEMORY_FRACTION * available:
+        return 'memory'
+    return 'hdf5'
+
+
+def getAvailableMemory():
+    """
+    Return the memory available for new allocations in bytes, or None if it
+    cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+def _getIndex(start, end):
+    """
+    Return the slice between start and end, where an end of -1 means the end
+    of the axis.
+    """
+    if start is not None:
+        start = int(start)
+    if end is not None:
+        end = int(end)
+        if end == -1:
+            end = None
+    return slice(start, end)
@@ -0,0 +1,593 @@
+#!/usr/bin/env python
+"""
+This module compiles the equation strings built by the LogisticModel class
+into a single vectorized kernel. Each input layer is read once per tile,
+scalar parts of the terms are folded into constants, and subexpressions that
+appear in more than one term (or in more than one of the median, min and max
+equations) are computed only once. It also splits equations into their
+static and shaking dependent parts (see :mod:`gfail.bake`).
+"""
+
+# stdlib imports
+import ast
+import copy
+import collections
+import numbers
+
+# third party imports
+import numpy as np
+
+
+# Name of the generated function and prefixes of the variables it uses
+KERNEL_NAME = '_kernel'
+LEAF_PREFIX = '_l'
+TEMP_PREFIX = '_t'
+
+# Multiplicative operators that can be flattened into factor chains
+MULTOPS = (ast.Mult, ast.Div)
+
+# Source code of the operators supported by toSource
+BINOPS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+          ast.Pow: '**', ast.Mod: '%', ast.FloorDiv: '//'}
+UNARYOPS = {ast.USub: '-', ast.UAdd: '+'}
+
+
+class TermKernel(object):
+    def __init__(self, equations, scope=None):
+        """
+        Compile one or more equation strings into a fused kernel.
+
+        The equations are expected to be in the format produced by
+        :func:`gfail.logisticmodel.checkTerm`, where input layers are
+        referenced as, for example,
+        ``self.layerdict['slope'].getSlice(rowstart, rowend, colstart,
+        colend, name='slope')``.
+
+        Args:
+            equations (list): List of equation strings (e.g., the median,
+                min and max equations of a model). None entries are skipped
+                but keep their position in the output.
+            scope (dict): Names available when folding scalar parts of the
+                equations, e.g. ``{'self': model, 'np': np}``, so that
+                ``self.eventdict['magnitude']`` becomes a constant. If None,
+                only numpy is available.
+        """
+        if scope is None:
+            scope = {}
+        self.scope = dict(scope)
+        self.scope.setdefault('np', np)
+        self.equations = list(equations)
+
+        # key = (source, key, name), value = variable name
+        self.leaves = collections.OrderedDict()
+
+        trees = []
+        for eqn in self.equations:
+            if eqn is None:
+                trees.append(None)
+                continue
+            node = ast.parse(eqn.strip(), mode='eval').body
+            node = _LeafReplacer(self.leaves).visit(node)
+            node = self._fold(node)
+            node = _canonicalize(node)
+            trees.append(node)
+
+        self.trees = trees
+        self.module = self._build(trees)
+        self._func = None
+
+    @classmethod
+    def combine(cls, kernels, leafmaps=None):
+        """
+        Fuse several compiled kernels into one that evaluates all of their
+        equations in a single pass, reading each layer once and sharing
+        subexpressions between kernels.
+
+        Args:
+            kernels (list): List of TermKernel objects.
+            leafmaps (list): One dictionary per kernel mapping its leaves
+                (see getLeaves) to the leaves of the fused kernel, so that
+                layers held by different models can be identified as the same
+                layer. Leaves missing from a dictionary are kept as they are.
+                If None, leaves are kept as they are.
+
+        Returns:
+            TermKernel: Kernel returning the outputs of all kernels, in order.
+        """
+        if leafmaps is None:
+            leafmaps = [{}] * len(kernels)
+        new = cls.__new__(cls)
+        new.scope = {'np': np}
+        new.equations = []
+        new.leaves = collections.OrderedDict()
+        trees = []
+        for kernel, leafmap in zip(kernels, leafmaps):
+            names = {}
+            for leaf, var in kernel.leaves.items():
+                leaf = leafmap.get(leaf, leaf)
+                if leaf not in new.leaves:
+                    new.leaves[leaf] = '%s%d' % (LEAF_PREFIX, len(new.leaves))
+                names[var] = new.leaves[leaf]
+            new.equations.extend(kernel.equations)
+            for tree in kernel.trees:
+                if tree is not None:
+                    tree = _canonicalize(
+                        _Renamer(names).visit(copy.deepcopy(tree)))
+                trees.append(tree)
+        new.trees = trees
+        new.module = new._build(trees)
+        new._func = None
+        return new
+
+    def getLeaves(self):
+        """
+        Return the layers read by the kernel.
+
+        Returns:
+            list: List of (source, key, name) tuples in the order they are
+            read, where source is the model attribute holding the layer
+            (e.g., 'layerdict', 'shakemap' or 'uncert').
+        """
+        return list(self.leaves.keys())
+
+    def evaluate(self, fetch):
+        """
+        Evaluate all equations for one tile.
+
+        Args:
+            fetch (function): Function called once per layer as
+                ``fetch(source, key, name)`` that returns the numpy array of
+                the layer for the current tile.
+
+        Returns:
+            list: One array per equation (None where the equation was None).
+        """
+        if self._func is None:
+            namespace = {'np': np}
+            code = compile(self.module, '<logistic kernel>', 'exec')
+            exec(code, namespace)
+            self._func = namespace[KERNEL_NAME]
+        return self._func(fetch)
+
+    def __getstate__(self):
+        # Compiled functions cannot be pickled, rebuild them on demand
+        state = self.__dict__.copy()
+        state['_func'] = None
+        state['scope'] = {}
+        return state
+
+    def _fold(self, node):
+        """
+        Replace every subtree that does not depend on an input layer, and
+        that evaluates to a number, by a constant.
+        """
+        if not _hasLeaf(node):
+            if _isNumber(node):
+                return node
+            try:
+                expr = ast.fix_missing_locations(ast.Expression(body=node))
+                value = eval(compile(expr, '<term>', 'eval'), self.scope)
+            except Exception:
+                return node
+            if isinstance(value, np.ndarray) and value.ndim == 0:
+                value = value.item()
+            if isinstance(value, numbers.Real) and \
+                    not isinstance(value, bool):
+                return ast.copy_location(_number(float(value)), node)
+            return node
+        for field, old in ast.iter_fields(node):
+            if isinstance(node, ast.Call) and field == 'func':
+                continue
+            if isinstance(old, ast.AST):
+                setattr(node, field, self._fold(old))
+            elif isinstance(old, list):
+                setattr(node, field, [
+                    self._fold(item) if isinstance(item, ast.AST) else item
+                    for item in old])
+        return node
+
+    def _build(self, trees):
+        """
+        Assemble the kernel function, hoisting repeated subexpressions into
+        temporary variables.
+        """
+        counts = collections.Counter()
+        for tree in trees:
+            if tree is not None:
+                _countSubtrees(tree, counts)
+
+        body = []
+        for (source, key, name), var in self.leaves.items():
+            call = ast.Call(
+                func=ast.Name(id='fetch', ctx=ast.Load()),
+                args=[_string(source), _string(key), _string(name)],
+                keywords=[])
+            body.append(ast.Assign(
+                targets=[ast.Name(id=var, ctx=ast.Store())], value=call))
+
+        hoisted = {}
+        outputs = []
+        for tree in trees:
+            if tree is None:
+                outputs.append(_none())
+                continue
+            outputs.append(_hoist(copy.deepcopy(tree), counts, hoisted,
+                                  body))
+        body.append(ast.Return(value=ast.List(elts=outputs, ctx=ast.Load())))
+
+        module = ast.parse('def %s(fetch):\n    pass\n' % KERNEL_NAME)
+        module.body[0].body = body
+        return ast.fix_missing_locations(module)
+
+
+def splitTerms(nuggets, dynamic=('shakemap', 'uncert', 'eventdict')):
+    """
+    Split a sum of equation nuggets into a static part, which depends only on
+    the predictor layers, and a sum of shaking dependent factors, each
+    multiplied by a coefficient that depends only on the predictor layers.
+
+    For example, the nuggets ``(1.65 * np.log(pgv))`` and
+    ``(0.01 * np.log(pgv) * np.arctan(slope))`` give no static part and the
+    single factor ``np.log(pgv)`` with the coefficients ``1.65`` and
+    ``(0.01 * np.arctan(slope))``.
+
+    Args:
+        nuggets (list): List of equation strings in the format built by the
+            LogisticModel class (e.g., ``['-6.3', '(1.65 * %s)' % term]``),
+            which are added together.
+        dynamic (tuple): Model attributes whose layers (or, for 'eventdict',
+            values) change from event to event.
+
+    Returns:
+        tuple: (static, factors) where:
+            * static: list of equation strings that do not depend on
+              shaking,
+            * factors: OrderedDict where keys are the shaking dependent
+              factors and values are lists of the equation strings of their
+              coefficients.
+
+    Raises:
+        Exception: If a nugget has a factor that mixes shaking and predictor
+        layers (e.g., ``log(pgv * slope)``) and so cannot be split.
+    """
+    static = []
+    factors = collections.OrderedDict()
+    for nugget in nuggets:
+        addends = []
+        _flattenSum(ast.parse(nugget.strip(), mode='eval').body, 1., addends)
+        for sign, node in addends:
+            numer = []
+            denom = []
+            coeff = []
+            flat = []
+            _flatten(node, True, flat)
+            for mult, factor in flat:
+                sources = _getSources(factor)
+                isdynamic = len(sources.intersection(dynamic)) > 0
+                if isdynamic and len(sources.difference(dynamic)) > 0:
+                    raise Exception('Term %s mixes shaking and predictor '
+                                    'layers and cannot be split'
+                                    % toSource(factor))
+                if not isdynamic:
+                    coeff.append((mult, factor))
+                elif mult:
+                    numer.append(toSource(factor))
+                else:
+                    denom.append(toSource(factor))
+            coeffsrc = _productSource(coeff, sign)
+            if not numer and not denom:
+                static.append(coeffsrc)
+                continue
+            numer.sort()
+            denom.sort()
+            factor = ' * '.join(numer) if numer else '1.0'
+            if denom:
+                factor = '%s / (%s)' % (factor, ' * '.join(denom))
+            factors.setdefault(factor, []).append(coeffsrc)
+    return static, factors
+
+
+def toSource(node):
+    """
+    Return the source code of an expression node. Every operation is put in
+    parentheses, so the result may have more of them than the original
+    source.
+
+    Args:
+        node: ast expression node.
+
+    Returns:
+        str: Source code of the expression.
+    """
+    if _isNumber(node):
+        return repr(_numberValue(node))
+    if _stringValue(node) is not None:
+        return repr(_stringValue(node))
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return '%s.%s' % (toSource(node.value), node.attr)
+    if isinstance(node, ast.Subscript):
+        index = node.slice
+        if hasattr(ast, 'Index') and isinstance(index, ast.Index):
+            index = index.value
+        return '%s[%s]' % (toSource(node.value), toSource(index))
+    if isinstance(node, ast.Call):
+        args = [toSource(arg) for arg in node.args]
+        args += ['%s=%s' % (kw.arg, toSource(kw.value))
+                 for kw in node.keywords]
+        return '%s(%s)' % (toSource(node.func), ', '.join(args))
+    if isinstance(node, ast.BinOp) and type(node.op) in BINOPS:
+        return '(%s %s %s)' % (toSource(node.left), BINOPS[type(node.op)],
+                               toSource(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARYOPS:
+        return '(%s%s)' % (UNARYOPS[type(node.op)], toSource(node.operand))
+    raise Exception('Unsupported expression: %s' % ast.dump(node))
+
+
+def _flattenSum(node, sign, addends):
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add,
+                                                             ast.Sub)):
+        _flattenSum(node.left, sign, addends)
+        if isinstance(node.op, ast.Add):
+            _flattenSum(node.right, sign, addends)
+        else:
+            _flattenSum(node.right, -sign, addends)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) \
+            and not _isNumber(node.operand):
+        _flattenSum(node.operand, -sign, addends)
+    else:
+        addends.append((sign, node))
+
+
+def _productSource(factors, sign):
+    """
+    Return the source code of a product of (mult, node) factors, where mult
+    is False for factors in the denominator.
+    """
+    src = '-1.0' if sign < 0 else ''
+    for mult, factor in factors:
+        if not src:
+            src = toSource(factor) if mult else \
+                '(1.0 / %s)' % toSource(factor)
+        else:
+            src = '(%s %s %s)' % (src, '*' if mult else '/',
+                                  toSource(factor))
+    return src if src else '1.0'
+
+
+def _getSources(node):
+    """
+    Return the set of model attributes (e.g., 'layerdict', 'shakemap' or
+    'eventdict') used by an expression node.
+    """
+    sources = set()
+    for sub in ast.walk(node):
+        if isinstance(sub, ast.Call) and _parseSlice(sub) is not None:
+            sources.add(_parseSlice(sub)[0])
+        elif isinstance(sub, ast.Attribute) and \
+                isinstance(sub.value, ast.Name) and sub.value.id == 'self':
+            sources.add(sub.attr)
+    return sources
+
+
+class _LeafReplacer(ast.NodeTransformer):
+    """
+    Replace ``self.<source>['<key>'].getSlice(..., name='<name>')`` calls by
+    variables, registering each distinct layer once.
+    """
+    def __init__(self, leaves):
+        self.leaves = leaves
+
+    def visit_Call(self, node):
+        leaf = _parseSlice(node)
+        if leaf is None:
+            self.generic_visit(node)
+            return node
+        if leaf not in self.leaves:
+            self.leaves[leaf] = '%s%d' % (LEAF_PREFIX, len(self.leaves))
+        return ast.copy_location(
+            ast.Name(id=self.leaves[leaf], ctx=ast.Load()), node)
+
+
+class _Renamer(ast.NodeTransformer):
+    """
+    Rename the leaf variables of an expression.
+    """
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return ast.copy_location(
+                ast.Name(id=self.names[node.id], ctx=node.ctx), node)
+        return node
+
+
+def _parseSlice(node):
+    """
+    Return (source, key, name) if node is a getSlice call on a layer held
+    by the model, otherwise None.
+    """
+    func = node.func
+    if not (isinstance(func, ast.Attribute) and func.attr == 'getSlice'):
+        return None
+    sub = func.value
+    if not isinstance(sub, ast.Subscript):
+        return None
+    owner = sub.value
+    if not (isinstance(owner, ast.Attribute) and
+            isinstance(owner.value, ast.Name) and owner.value.id == 'self'):
+        return None
+    index = sub.slice
+    if hasattr(ast, 'Index') and isinstance(index, ast.Index):
+        index = index.value
+    key = _stringValue(index)
+    if key is None:
+        return None
+    name = key
+    for kw in node.keywords:
+        if kw.arg == 'name' and _stringValue(kw.value) is not None:
+            name = _stringValue(kw.value)
+    return (owner.attr, key, name)
+
+
+def _hasLeaf(node):
+    for sub in ast.walk(node):
+        if isinstance(sub, ast.Name) and sub.id.startswith(LEAF_PREFIX):
+            return True
+    return False
+
+
+def _canonicalize(node):
+    """
+    Flatten products and quotients into factor chains, combine all of the
+    constant factors of a chain into one, and sort the remaining factors so
+    that the same product is written the same way in every term.
+    """
+    for field, old in ast.iter_fields(node):
+        if isinstance(node, ast.Call) and field == 'func':
+            continue
+        if isinstance(old, ast.AST):
+            setattr(node, field, _canonicalize(old))
+        elif isinstance(old, list):
+            setattr(node, field, [
+                _canonicalize(item) if isinstance(item, ast.AST) else item
+                for item in old])
+
+    if not (isinstance(node, ast.BinOp) and isinstance(node.op, MULTOPS)):
+        return node
+
+    factors = []
+    _flatten(node, True, factors)
+    const = 1.
+    nconst = 0
+    numer = []
+    denom = []
+    for mult, factor in factors:
+        if _isNumber(factor):
+            value = _numberValue(factor)
+            if not mult and value == 0.:
+                return node  # Leave divisions by zero to numpy
+            const = const * value if mult else const / value
+            nconst += 1
+        elif mult:
+            numer.append(factor)
+        else:
+            denom.append(factor)
+    if not numer and not denom:
+        return ast.copy_location(_number(const), node)
+    if nconst == 0 and len(factors) == 2:
+        return node
+
+    numer.sort(key=ast.dump)
+    denom.sort(key=ast.dump)
+    if numer:
+        expr = numer[0]
+        if const != 1.:
+            expr = ast.BinOp(left=expr, op=ast.Mult(), right=_number(const))
+        for factor in numer[1:]:
+            expr = ast.BinOp(left=expr, op=ast.Mult(), right=factor)
+    else:
+        expr = _number(const)
+    for factor in denom:
+        expr = ast.BinOp(left=expr, op=ast.Div(), right=factor)
+    return ast.copy_location(expr, node)
+
+
+def _flatten(node, mult, factors):
+    if isinstance(node, ast.BinOp) and isinstance(node.op, MULTOPS):
+        _flatten(node.left, mult, factors)
+        if isinstance(node.op, ast.Mult):
+            _flatten(node.right, mult, factors)
+        else:
+            _flatten(node.right, not mult, factors)
+    else:
+        factors.append((mult, node))
+
+
+def _isCandidate(node):
+    return isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Call)) and \
+        _hasLeaf(node)
+
+
+def _countSubtrees(node, counts):
+    if _isCandidate(node):
+        counts[ast.dump(node)] += 1
+    for field, child in ast.iter_fields(node):
+        if isinstance(node, ast.Call) and field == 'func':
+            continue
+        if isinstance(child, ast.AST):
+            _countSubtrees(child, counts)
+        elif isinstance(child, list):
+            for item in child:
+                if isinstance(item, ast.AST):
+                    _countSubtrees(item, counts)
+
+
+def _hoist(node, counts, hoisted, body):
+    """
+    Rewrite node bottom up, assigning every repeated subexpression to a
+    temporary variable the first time it is computed.
+    """
+    key = ast.dump(node) if _isCandidate(node) else None
+    if key is not None and key in hoisted:
+        return ast.Name(id=hoisted[key], ctx=ast.Load())
+    for field, child in ast.iter_fields(node):
+        if isinstance(node, ast.Call) and field == 'func':
+            continue
+        if isinstance(child, ast.AST):
+            setattr(node, field, _hoist(child, counts, hoisted, body))
+        elif isinstance(child, list):
+            setattr(node, field, [
+                _hoist(item, counts, hoisted, body)
+                if isinstance(item, ast.AST) else item for item in child])
+    if key is not None and counts[key] > 1:
+        var = '%s%d' % (TEMP_PREFIX, len(hoisted))
+        hoisted[key] = var
+        body.append(ast.Assign(
+            targets=[ast.Name(id=var, ctx=ast.Store())], value=node))
+        return ast.Name(id=var, ctx=ast.Load())
+    return node
+
+
+# Helpers to build and inspect literal nodes on both older (Num, Str) and
+# newer (Constant) versions of the ast module
+
+def _number(value):
+    if hasattr(ast, 'Constant'):
+        return ast.Constant(value=value)
+    return ast.Num(n=value)
+
+
+def _string(value):
+    if hasattr(ast, 'Constant'):
+        return ast.Constant(value=value)
+    return ast.Str(s=value)
+
+
+def _none():
+    if hasattr(ast, 'Constant'):
+        return ast.Constant(value=None)
+    return ast.NameConstant(value=None)
+
+
+def _isNumber(node):
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return isinstance(node.value, numbers.Real) and \
+            not isinstance(node.value, bool)
+    return hasattr(ast, 'Num') and isinstance(node, ast.Num)
+
+
+def _numberValue(node):
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return node.value
+    return node.n
+
+
+def _stringValue(node):
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        return node.value if isinstance(node.value, str) else None
+    if hasattr(ast, 'Str') and isinstance(node, ast.Str):
+        return node.s
+    return None
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""
+Web map tiles of model results.
+
+create_png and interactiveMap color each model grid into one image the size
+of the grid, reproject it to web mercator and have the browser download it
+at once. writeTiles instead samples the colored grid into a pyramid of
+standard 256 x 256 pixel web mercator tiles, saved as
+<outdir>/<zoom>/<x>/<y>.png, from the zoom level of the resolution of the
+grid down ZOOMLEVELS levels. Tiles without any colored pixel are not
+saved. Tiles are rendered concurrently, and each pixel takes the color of
+the grid cell its center falls in, so the grid is never resampled as a
+whole. At zoom levels where pixels are larger than the cells, the colored
+grid is first coarsened to cells at least the size of a pixel, each taking
+the color of the cell of highest value of its block, so small areas of
+high values still show at overview zooms. A manifest (tiles.json)
+describes the pyramid.
+
+Grids are colored by colorize, a lookup table version of the
+ListedColormap and BoundaryNorm coloring of create_png.
+"""
+
+# stdlib imports
+import os
+import json
+import shutil
+from multiprocessing.pool import ThreadPool
+
+# third party imports
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.colors as colors
+from mapio.geodict import GeoDict
+
+#: Width and height of tiles, in pixels
+TILESIZE = 256
+
+#: Number of zoom levels rendered by default
+ZOOMLEVELS = 5
+
+#: Highest zoom level rendered
+MAXZOOM = 14
+
+#: Latitude limit of web mercator
+MAXLAT = 85.0511287798
+
+
+def colorize(data, levels, colorlist):
+    """
+    Color a grid by bins, as create_png does with a ListedColormap and a
+    BoundaryNorm, but as a lookup of a table of colors.
+
+    Args:
+        data (array): 2D array, values are clipped to the range of levels,
+            nan cells are transparent.
+        levels (list): Edges of the bins.
+        colorlist (list): Colors of the bins, as RGBA tuples or any other
+            matplotlib color.
+
+    Returns:
+        array: Array of shape data.shape + (4,) of RGBA bytes.
+    """
+    data = np.asarray(data, dtype=float)
+    nanmask = np.isnan(data)
+    ncolors = len(colorlist)
+    table = np.zeros((ncolors + 1, 4), dtype=np.uint8)
+    table[:ncolors] = (colors.to_rgba_array(colorlist) * 255).astype(
+        np.uint8)
+    norm = colors.BoundaryNorm(levels, ncolors)
+    index = np.asarray(norm(np.clip(np.where(nanmask, levels[0], data),
+                                    levels[0], levels[-1])))
+    # The upper edge gets the over color, the last color by default
+    index = np.clip(index, 0, ncolors - 1)
+    index[nanmask] = ncolors
+    return table[index]
+
+
+def getNativeZoom(gdict):
+    """
+    Zoom level at which the pixels of tiles are the size of the cells of a
+    grid at the equator, or smaller.
+
+    Args:
+        gdict (GeoDict): Geodictionary of the grid.
+
+    Returns:
+        int: Zoom level, at most MAXZOOM.
+    """
+    zoom = int(np.ceil(np.log2(360. / (TILESIZE * gdict.dx)) - 1e-6))
+    return min(max(zoom, 0), MAXZOOM)
+
+
+def getTileRange(gdict, zoom):
+    """
+    Tiles of a zoom level that overlap a grid.
+
+    Args:
+        gdict (GeoDict): Geodictionary of the grid.
+        zoom (int): Zoom level.
+
+    Returns:
+        tuple: (x0, x1, y0, y1), tiles x0 to x1 - 1 and y0 to y1 - 1.
+    """
+    ntiles = 2 ** zoom
+    x0 = _lonToX(gdict.xmin - gdict.dx / 2., zoom)
+    x1 = _lonToX(gdict.xmax + gdict.dx / 2., zoom)
+    y0 = _latToY(min(gdict.ymax + gdict.dy / 2., MAXLAT), zoom)
+    y1 = _latToY(max(gdict.ymin - gdict.dy / 2., -MAXLAT), zoom)
+    return (max(int(np.floor(x0)), 0), min(int(np.ceil(x1)), ntiles),
+            max(int(np.floor(y0)), 0), min(int(np.ceil(y1)), ntiles))
+
+
+def renderTile(rgba, gdict, zoom, x, y):
+    """
+    Render one tile of a colored grid.
+
+    Args:
+        rgba (array): Colored grid, array of RGBA bytes of shape
+            (ny, nx, 4).
+        gdict (GeoDict): Geodictionary of the grid.
+        zoom (int): Zoom level.
+        x (int): Column of the tile.
+        y (int): Row of the tile.
+
+    Returns:
+        array: TILESIZE x TILESIZE x 4 array of RGBA bytes, or None if no
+        pixel of the tile is colored.
+    """
+    pixels = (np.arange(TILESIZE) + 0.5) / TILESIZE
+    lons = _xToLon(x + pixels, zoom)
+    lats = _yToLat(y + pixels, zoom)
+    cols = np.floor((lons - (gdict.xmin - gdict.dx / 2.)) /
+                    gdict.dx).astype(int)
+    rows = np.floor(((gdict.ymax + gdict.dy / 2.) - lats) /
+                    gdict.dy).astype(int)
+    colok = (cols >= 0) & (cols < gdict.nx)
+    rowok = (rows >= 0) & (rows < gdict.ny)
+    if not colok.any() or not rowok.any():
+        return None
+    tile = np.zeros((TILESIZE, TILESIZE, 4), dtype=np.uint8)
+    tile[np.ix_(rowok, colok)] = rgba[np.ix_(rows[rowok], cols[colok])]
+    if not tile[:, :, 3].any():
+        return None
+    return tile
+
+
+def getCoarseFactors(gdict, zoom):
+    """
+    Number of cells of a grid along each side of the coarse cells a zoom
+    level is rendered from, so that every coarse cell contains the center of
+    at least one pixel.
+
+    Args:
+        gdict (GeoDict): Geodictionary of the grid.
+        zoom (int): Zoom level.
+
+    Returns:
+        tuple: (rowfactor, colfactor), 1 at zoom levels where pixels are no
+        larger than the cells.
+    """
+    pixsize = 360. / (TILESIZE * 2 ** zoom)
+    # Pixels are tallest in degrees at the latitude closest to the equator
+    ymin = gdict.ymin - gdict.dy / 2.
+    ymax = gdict.ymax + gdict.dy / 2.
+    if ymin <= 0. <= ymax:
+        lat = 0.
+    else:
+        lat = min(abs(ymin), abs(ymax))
+    colfactor = int(np.ceil(pixsize / gdict.dx - 1e-6))
+    rowfactor = int(np.ceil(pixsize * np.cos(np.radians(lat)) / gdict.dy -
+                            1e-6))
+    return max(rowfactor, 1), max(colfactor, 1)
+
+
+def coarsen(rgba, gdict, rowfactor, colfactor, data=None):
+    """
+    Coarsen a colored grid by blocks of cells, each block taking the color
+    of its cell of highest value.
+
+    Args:
+        rgba (array): Colored grid, array of shape (ny, nx, 4).
+        gdict (GeoDict): Geodictionary of the grid.
+        rowfactor (int): Number of rows of each block.
+        colfactor (int): Number of columns of each block.
+        data (array): Values the grid was colored from, nan cells are
+            lowest. Any coloring where higher values get other colors keeps
+            the highest values visible. If None, colored cells are kept over
+            transparent cells, by opacity.
+
+    Returns:
+        tuple: (rgba, gdict), the coarse colored grid and its
+        geodictionary, blocks at the edges may cover fewer cells.
+    """
+    ny, nx = rgba.shape[:2]
+    if data is None:
+        rank = rgba[:, :, 3].astype(float)
+    else:
+        rank = np.where(np.isnan(data), -np.inf, data)
+    nyc = int(np.ceil(ny / rowfactor))
+    nxc = int(np.ceil(nx / colfactor))
+    padded = np.full((nyc * rowfactor, nxc * colfactor), -np.inf)
+    padded[:ny, :nx] = rank
+    blocks = padded.reshape(nyc, rowfactor, nxc, colfactor).transpose(
+        0, 2, 1, 3).reshape(nyc, nxc, rowfactor * colfactor)
+    # First cell of the block, always inside the grid, if none is higher
+    index = np.argmax(blocks, axis=2)
+    rows = np.arange(nyc)[:, None] * rowfactor + index // colfactor
+    cols = np.arange(nxc)[None, :] * colfactor + index % colfactor
+    dx = gdict.dx * colfactor
+    dy = gdict.dy * rowfactor
+    xmin = gdict.xmin - gdict.dx / 2. + dx / 2.
+    ymax = gdict.ymax + gdict.dy / 2. - dy / 2.
+    cdict = GeoDict({'xmin': xmin, 'xmax': xmin + (nxc - 1) * dx,
+                     'ymin': ymax - (nyc - 1) * dy, 'ymax': ymax,
+                     'dx': dx, 'dy': dy, 'nx': nxc, 'ny': nyc})
+    return rgba[rows, cols], cdict
+
+
+def writeTiles(rgba, gdict, outdir, minzoom=None, maxzoom=None,
+               nworkers=None, data=None):
+    """
+    Save the tile pyramid of a colored grid, replacing any pyramid
+    previously saved in outdir.
+
+    Args:
+        rgba (array): Colored grid, array of shape (ny, nx, 4) of RGBA bytes
+            (see colorize) or of floats between 0 and 1 (as returned by
+            matplotlib colormaps).
+        gdict (GeoDict): Geodictionary of the grid.
+        outdir (str): Directory where the tiles and manifest are saved.
+        minzoom (int): Lowest zoom level, default ZOOMLEVELS - 1 levels
+            below maxzoom.
+        maxzoom (int): Highest zoom level, default getNativeZoom(gdict).
+        nworkers (int): Number of tiles to render concurrently.
+        data (array): Values the grid was colored from, to keep the colors
+            of the highest values at zoom levels where pixels are larger
+            than the cells (see coarsen).
+
+    Returns:
+        str: Path to the manifest file of the pyramid.
+    """
+    rgba = np.asarray(rgba)
+    if rgba.dtype != np.uint8:
+        # As plt.imsave converts floats
+        rgba = (rgba * 255).astype(np.uint8)
+    if maxzoom is None:
+        maxzoom = getNativeZoom(gdict)
+    if minzoom is None:
+        minzoom = max(maxzoom - ZOOMLEVELS + 1, 0)
+    if os.path.isfile(os.path.join(outdir, 'tiles.json')):
+        shutil.rmtree(outdir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    tiles = []
+    grids = {}
+    for zoom in range(minzoom, maxzoom + 1):
+        x0, x1, y0, y1 = getTileRange(gdict, zoom)
+        tiles.extend([(zoom, x, y) for x in range(x0, x1)
+                      for y in range(y0, y1)])
+        factors = getCoarseFactors(gdict, zoom)
+        if factors == (1, 1):
+            grids[zoom] = (rgba, gdict)
+        else:
+            grids[zoom] = coarsen(rgba, gdict, factors[0], factors[1],
+                                  data=data)
+
+    def save(tile):
+        zoom, x, y = tile
+        image = renderTile(grids[zoom][0], grids[zoom][1], zoom, x, y)
+        if image is None:
+            return None
+        tiledir = os.path.join(outdir, str(zoom), str(x))
+        if not os.path.exists(tiledir):
+            os.makedirs(tiledir, exist_ok=True)
+        plt.imsave(os.path.join(tiledir, '%d.png' % y), image)
+        return tile
+
+    if nworkers is None or nworkers < 2 or len(tiles) < 2:
+        saved = [save(tile) for tile in tiles]
+    else:
+        pool = ThreadPool(min(nworkers, len(tiles)))
+        try:
+            saved = pool.map(save, tiles)
+        finally:
+            pool.close()
+            pool.join()
+
+    manifest = {'url': '{z}/{x}/{y}.png', 'tilesize': TILESIZE,
+                'minzoom': minzoom, 'maxzoom': maxzoom,
+                'bounds': [gdict.xmin - gdict.dx / 2.,
+                           gdict.xmax + gdict.dx / 2.,
+                           gdict.ymin - gdict.dy / 2.,
+                           gdict.ymax + gdict.dy / 2.],
+                'ntiles': len([tile for tile in saved if tile is not None])}
+    # Written last, so an interrupted pyramid is never used
+    manifestfile = os.path.join(outdir, 'tiles.json')
+    with open(manifestfile, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifestfile
+
+
+def _lonToX(lon, zoom):
+    """
+    Fractional tile column of a longitude.
+    """
+    return (np.asarray(lon) + 180.) / 360. * 2 ** zoom
+
+
+def _latToY(lat, zoom):
+    """
+    Fractional tile row of a latitude.
+    """
+    lat = np.radians(lat)
+    return (1. - np.arcsinh(np.tan(lat)) / np.pi) / 2. * 2 ** zoom
+
+
+def _xToLon(x, zoom):
+    """
+    Longitude of a fractional tile column.
+    """
+    return np.asarray(x) / 2 ** zoom * 360. - 180.
+
+
+def _yToLat(y, zoom):
+    """
+    Latitude of a fractional tile row.
+    """
+    return np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * np.asarray(y) /
+                                                   2 ** zoom))))
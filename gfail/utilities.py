@@ -8,7 +8,7 @@ from datetime import timedelta
 import collections
 
 # local imports
-from mapio.shake import getHeaderData
+from gfail.shakecache import getShakeHeader
 from libcomcat.search import get_event_by_id, search
 from libcomcat.classes import VersionOption
 from mapio.basemapcity import BasemapCities
@@ -62,7 +62,7 @@ def get_event_comcat(shakefile, timewindow=60, degwindow=0.3, magwindow=0.2):
             * shakemap: shakemap of event found (from comcat)
 
     """
-    header_dicts = getHeaderData(shakefile)
+    header_dicts = getShakeHeader(shakefile)
     grid_dict = header_dicts[0]
     event_dict = header_dicts[1]
     version = grid_dict['shakemap_version']
@@ -9,9 +9,10 @@ import os
 from configobj import ConfigObj
 from gfail.makemaps import setupsync
 from gfail.utilities import parseConfigLayers
-from gfail.stats import computeStats
+from gfail.statstore import getStatsStore, getAlertStats
 from folium.utilities import mercator_transform
-from mapio.shake import ShakeGrid
+from gfail.shakecache import loadShakeGrid
+from gfail.tiles import colorize, writeTiles
 import matplotlib.cm as cm
 
 from impactutils.textformat.text import set_num_precision
@@ -55,7 +56,7 @@ def hazdev(maplayerlist, configs, shakemap, outfolder=None, alpha=0.7,
            prefLS='Nowicki Jessee and others (2017)',
            prefLQ='Zhu and others (2017)',
            pop_file=None, defaultcolors=True,
-           pager_alert=''):
+           pager_alert='', proj='ellipsoid'):
     """Create all files needed for product page creation
     Assumes gfail has been run already with -w flag
 
@@ -81,6 +82,8 @@ def hazdev(maplayerlist, configs, shakemap, outfolder=None, alpha=0.7,
             of determining new ones. This will crash if any of the layers have
             a different number of bins than the number of DFCOLORS
         pager_alert (str): PAGER alert level, e.g., 'green'. 'pending', ...
+        proj (str): How cell areas of the statistics are computed, see
+            gfail.stats.computeHagg.
 
     Returns:
         Files that need to be sent to comcat for hazdev to create the product
@@ -142,14 +145,21 @@ def hazdev(maplayerlist, configs, shakemap, outfolder=None, alpha=0.7,
                     id1 = 'nowicki_2014_global'
                     statprobthresh = 0.0
 
-            stats = computeStats(
+            stats = getStatsStore(outfolder).getStats(
                 maplayer['model']['grid'],
                 probthresh=probthresh,
                 shakefile=shakemap,
                 shakethresh=shakethresh,
                 statprobthresh=statprobthresh,
                 pop_file=pop_file,
-                shakethreshtype=shakethreshtype)
+                shakethreshtype=shakethreshtype,
+                model=id1,
+                proj=proj)
+            if id1 == 'jessee_2017':
+                # Stored for create_info, which keeps all the cells
+                getAlertStats(maplayer['model']['grid'], shakemap,
+                              pop_file=pop_file, proj=proj, model=id1,
+                              event_dir=outfolder)
 
             metadata = maplayer['model']['description']
             if len(maplayer) > 1:
@@ -230,14 +240,21 @@ def hazdev(maplayerlist, configs, shakemap, outfolder=None, alpha=0.7,
                 id1 = 'zhu_2017_general'
                 statprobthresh = 0.005
 
-            stats = computeStats(
+            stats = getStatsStore(outfolder).getStats(
                 maplayer['model']['grid'],
                 probthresh=probthresh,
                 shakefile=shakemap,
                 shakethresh=shakethresh,
                 pop_file=pop_file,
                 shakethreshtype=shakethreshtype,
-                statprobthresh=statprobthresh)
+                statprobthresh=statprobthresh,
+                model=id1,
+                proj=proj)
+            if id1 == 'zhu_2017_general':
+                # Stored for create_info, which keeps all the cells
+                getAlertStats(maplayer['model']['grid'], shakemap,
+                              pop_file=pop_file, proj=proj, model=id1,
+                              event_dir=outfolder)
 
             metadata = maplayer['model']['description']
             if len(maplayer) > 1:
@@ -367,7 +384,8 @@ def hazdev(maplayerlist, configs, shakemap, outfolder=None, alpha=0.7,
 
 
 def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
-               lsmask=0.002, lqmask=0.005, legends=False):
+               lsmask=0.002, lqmask=0.005, legends=False, tiles=False,
+               nworkers=None):
     """
     Creates transparent PNG file for website.
 
@@ -385,9 +403,13 @@ def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
             threshold
         legends (bool): if True, will produce png files of legends for each
             preferred model
+        tiles (bool): if True, will also save a web mercator tile pyramid of
+            each model in event_dir/tiles/<model id>, see gfail.tiles
+        nworkers (int): Number of tiles to render concurrently.
 
     Returns:
         .png map overlays and .json files specifying their mapped extents
+        (and the manifests of the tile pyramids)
     """
     filenames = []
     files = os.listdir(event_dir)
@@ -436,6 +458,11 @@ def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
                        vmax=lmax,
                        cmap=cmap
                        )
+            if tiles:
+                filenames.append(writeTiles(
+                    colorize(ls_data, levels, colors1), ls_geodict,
+                    os.path.join(event_dir, 'tiles', filesnippet),
+                    nworkers=nworkers, data=ls_data))
         else:
             raise OSError(
                 "Preferred landslide model result (%s) not found." % ls_mod_file)
@@ -491,6 +518,11 @@ def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
                        vmax=lmax,
                        cmap=cmap
                        )
+            if tiles:
+                filenames.append(writeTiles(
+                    colorize(ls_data, levels, colors1), ls_geodict,
+                    os.path.join(event_dir, 'tiles', filesnippet),
+                    nworkers=nworkers, data=ls_data))
 
     if lqmodels is None:
         # read in preferred model for liquefaction if none specified
@@ -534,6 +566,11 @@ def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
                        vmax=lmax,
                        cmap=cmap
                        )
+            if tiles:
+                filenames.append(writeTiles(
+                    colorize(lq_data, levels, colors1), lq_geodict,
+                    os.path.join(event_dir, 'tiles', filesnippet),
+                    nworkers=nworkers, data=lq_data))
             filenames.append(filen)
         else:
             raise OSError(
@@ -587,6 +624,11 @@ def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
                        vmax=lmax,
                        cmap=cmap
                        )
+            if tiles:
+                filenames.append(writeTiles(
+                    colorize(lq_data, levels, colors1), lq_geodict,
+                    os.path.join(event_dir, 'tiles', filesnippet),
+                    nworkers=nworkers, data=lq_data))
             filenames.append(filen)
 
     if legends:
@@ -597,7 +639,7 @@ def create_png(event_dir, lsmodels=None, lqmodels=None, mercator=True,
     return filenames
 
 
-def create_info(event_dir, lsmodels=None, lqmodels=None):
+def create_info(event_dir, lsmodels=None, lqmodels=None, proj='ellipsoid'):
     """Create info.json for ground failure product.
 
     Args:
@@ -607,6 +649,9 @@ def create_info(event_dir, lsmodels=None, lqmodels=None):
             the hdf5 files for the preferred model and will create this
             dictionary and will apply default colorbars and bins.
         lqmodels (list): Same as above for liquefaction.
+        proj (str): How cell areas of the statistics are computed, see
+            gfail.stats.computeHagg, must be the same as in hazdev for the
+            statistics hazdev stored to be reused.
 
     Returns:
         creates info.json for this event
@@ -661,25 +706,15 @@ def create_info(event_dir, lsmodels=None, lqmodels=None):
         defaults = ConfigObj(default_file)
         pop_file = defaults['popfile']
 
-        # Landslide alert statistics
-        ls_stats = computeStats(
-            ls_mod['model']['grid'],
-            probthresh=None,
-            shakefile=shakefile,
-            shakethresh=10.0,
-            shakethreshtype='pga',
-            statprobthresh=None,
-            pop_file=pop_file)
+        # Landslide alert statistics, stored by hazdev for the event
+        ls_stats = getAlertStats(ls_mod['model']['grid'], shakefile,
+                                 pop_file=pop_file, proj=proj,
+                                 model='jessee_2017', event_dir=event_dir)
 
         # Liquefaction alert statistics
-        lq_stats = computeStats(
-            lq_mod['model']['grid'],
-            probthresh=None,
-            shakefile=shakefile,
-            shakethresh=10.0,
-            shakethreshtype='pga',
-            statprobthresh=None,
-            pop_file=pop_file)
+        lq_stats = getAlertStats(lq_mod['model']['grid'], shakefile,
+                                 pop_file=pop_file, proj=proj,
+                                 model='zhu_2017_general', event_dir=event_dir)
 
         # Get alert levels
         ls_haz_level = ls_stats['Hagg_0.10g']
@@ -816,7 +851,7 @@ def create_info(event_dir, lsmodels=None, lqmodels=None):
                     lqm.pop(key)
 
     # Try to get event info
-    shake_grid = ShakeGrid.load(shakefile, adjust='res')
+    shake_grid = loadShakeGrid(shakefile, adjust='res')
     event_dict = shake_grid.getEventDict()
     sm_dict = shake_grid.getShakeDict()
     base_url = 'https://earthquake.usgs.gov/earthquakes/eventpage/'
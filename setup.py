@@ -16,6 +16,9 @@ setup(name='groundfailure',
       },
       scripts=[
           'bin/gfail',
+          'bin/gfail_bake',
+          'bin/gfail_landmask',
+          'bin/gfail_population',
           'bin/callgf',
           'bin/create_info',
           'bin/create_png',
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import copy
+import numpy as np
+import gfail.logisticmodel as LM
+from gfail.bake import bake
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+datadir = os.path.abspath(os.path.join(homedir, 'data'))
+
+shakefile = os.path.join(datadir, 'test_shakegrid.xml')
+slopefile = os.path.join(datadir, 'test_slope.bil')
+vs30file = os.path.join(datadir, 'test_vs30.bil')
+ctifile = os.path.join(datadir, 'test_cti1.bil')
+
+modelLQ = {
+    'TestModelLQ': {
+        'description': 'This is a test liquefaction model',
+        'gfetype': 'liquefaction',
+        'baselayer': 'vs30',
+        'layers': {
+            'vs30': {
+                'file': vs30file,
+                'units': 'm/s',
+                'longref': 'more words',
+                'shortref': 'words'
+            },
+            'cti1': {
+                'file': ctifile,
+                'units': 'unitless',
+                'longref': 'more words',
+                'shortref': 'words'
+            },
+            'slope': {
+                'file': slopefile,
+                'units': 'degrees',
+                'longref': 'more words',
+                'shortref': 'words'
+            }
+        },
+        'interpolations': {
+            'vs30': 'nearest',
+            'cti1': 'nearest',
+            'slope': 'nearest'
+        },
+        'terms': {
+            'b1': 'log((pga/100.0)*(power(MW,2.)))',
+            'b2': 'cti1',
+            'b3': 'log(vs30)',
+            'b4': 'log(pga)*slope'
+        },
+        'coefficients': {
+            'b0': 15.,
+            'b1': 2.,
+            'b2': 0.3,
+            'b3': -4.,
+            'b4': 0.01
+        }
+    }
+}
+
+
+def test_bake():
+    tempdir = tempfile.mkdtemp()
+    try:
+        config = copy.deepcopy(modelLQ)
+        bakefile = bake(config, tempdir, rowmax=1)
+        assert os.path.exists(bakefile)
+
+        lq = LM.LogisticModel(shakefile, copy.deepcopy(modelLQ))
+        LQ = lq.calculate()
+
+        config['TestModelLQ']['bakefile'] = bakefile
+        lqb = LM.LogisticModel(shakefile, config)
+        assert lqb.baked is not None
+        assert 'cti1' not in lqb.layerdict
+        LQB = lqb.calculate()
+        np.testing.assert_allclose(LQB['model']['grid'].getData(),
+                                   LQ['model']['grid'].getData(), rtol=1e-05)
+
+        # Changing the model makes the baked grids stale
+        config['TestModelLQ']['coefficients']['b2'] = 0.4
+        lqs = LM.LogisticModel(shakefile, config)
+        assert lqs.baked is None
+
+        # So does updating a layer file with the same size
+        config = copy.deepcopy(modelLQ)
+        newcti = os.path.join(tempdir, 'cti1.bil')
+        shutil.copy(ctifile, newcti)
+        shutil.copy(ctifile[:-4] + '.hdr', newcti[:-4] + '.hdr')
+        config['TestModelLQ']['layers']['cti1']['file'] = newcti
+        config['TestModelLQ']['bakefile'] = bake(
+            config, os.path.join(tempdir, 'updated'), rowmax=1)
+        assert LM.LogisticModel(shakefile, config).baked is not None
+        stat = os.stat(newcti)
+        os.utime(newcti, (stat.st_atime, stat.st_mtime + 10.))
+        assert LM.LogisticModel(shakefile, config).baked is None
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_bake()
+    print('bake.py tests passed')
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import os.path
+import copy
+import shutil
+import tempfile
+import numpy as np
+from mapio.multihaz import MultiHazardGrid
+import gfail.logisticmodel as LM
+from gfail.batch import LogisticBatch
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+datadir = os.path.abspath(os.path.join(homedir, 'data'))
+
+shakefile = os.path.join(datadir, 'test_shakegrid.xml')
+uncertfile = os.path.join(datadir, 'test_uncert.xml')
+slopefile = os.path.join(datadir, 'test_slope.bil')
+vs30file = os.path.join(datadir, 'test_vs30.bil')
+ctifile = os.path.join(datadir, 'test_cti1.bil')
+
+modelLQ = {
+    'TestModelLQ': {
+        'description': 'This is a test liquefaction model',
+        'gfetype': 'liquefaction',
+        'baselayer': 'vs30',
+        'vs30max': 1000.,
+        'layers': {
+            'vs30': {
+                'file': vs30file,
+                'units': 'm/s',
+                'longref': 'more words',
+                'shortref': 'words'
+            },
+            'cti1': {
+                'file': ctifile,
+                'units': 'unitless',
+                'longref': 'more words',
+                'shortref': 'words'
+            }
+        },
+        'interpolations': {
+            'vs30': 'nearest',
+            'cti1': 'linear'
+        },
+        'terms': {
+            'b1': 'log((pga/100.0)*(power(MW,2.)))',
+            'b2': 'cti1',
+            'b3': 'log(vs30)'
+        },
+        'coefficients': {
+            'b0': 15.,
+            'b1': 2.,
+            'b2': 0.3,
+            'b3': -4.
+        }
+    }
+}
+
+modelLS = {
+    'TestModelLS': {
+        'description': 'This is a test landslide model',
+        'gfetype': 'landslide',
+        'baselayer': 'slope',
+        'slopemin': 5.,
+        'slopemax': 90.,
+        'slopefile': slopefile,
+        'layers': {
+            'slope': {
+                'file': slopefile,
+                'units': 'degrees',
+                'longref': 'more words',
+                'shortref': 'words'
+            },
+            'cti1': {
+                'file': ctifile,
+                'units': 'unitless',
+                'longref': 'more words',
+                'shortref': 'words'
+            }
+        },
+        'interpolations': {
+            'slope': 'linear',
+            'cti1': 'linear'
+        },
+        'terms': {
+            'b1': 'log(pga)',
+            'b2': 'slope',
+            'b3': 'cti1',
+            'b4': 'log(pga)*slope*MW'
+        },
+        'coefficients': {
+            'b0': -7.,
+            'b1': 0.6,
+            'b2': 0.0008,
+            'b3': 0.02,
+            'b4': 1.e-04
+        }
+    }
+}
+
+# Same inputs as TestModelLS with other coefficients
+modelLS2 = {'TestModelLS2': copy.deepcopy(modelLS['TestModelLS'])}
+modelLS2['TestModelLS2']['coefficients']['b1'] = 0.3
+modelLS2['TestModelLS2']['coefficients']['b3'] = 0.1
+
+
+def test_batch():
+    configs = [modelLS, modelLQ, modelLS2]
+    for uncert in [None, uncertfile]:
+        saveinputs = uncert is None
+        batch = LogisticBatch(shakefile, configs, uncertfile=uncert,
+                              saveinputs=saveinputs)
+        # Identical layers are stored once
+        ls = batch.models['TestModelLS']
+        ls2 = batch.models['TestModelLS2']
+        assert ls.layerdict['slope'] is ls2.layerdict['slope']
+        assert ls.shakemap['pga'] is ls2.shakemap['pga']
+        assert ls.layerdict['cti1'] is \
+            batch.models['TestModelLQ'].layerdict['cti1']
+        results = batch.calculate(rowmax=1)
+        assert list(results.keys()) == ['TestModelLS', 'TestModelLQ',
+                                        'TestModelLS2']
+        for config in configs:
+            lm = LM.LogisticModel(shakefile, config, uncertfile=uncert,
+                                  saveinputs=saveinputs)
+            target = lm.calculate()
+            result = results[lm.model]
+            assert list(result.keys()) == list(target.keys())
+            for key in target:
+                assert result[key]['label'] == target[key]['label']
+                assert result[key]['description'] == \
+                    target[key]['description']
+                np.testing.assert_allclose(
+                    result[key]['grid'].getData(),
+                    target[key]['grid'].getData(), rtol=1e-10)
+
+
+def test_batch_sparse():
+    configs = [modelLS, modelLQ]
+    batch = LogisticBatch(shakefile, configs, uncertfile=uncertfile)
+    full = batch.calculate(cleanup=False)
+    sparse = batch.calculate(rowmax=1, colmax=1, sparse=True)
+    for name in full:
+        for key in full[name]:
+            np.testing.assert_allclose(sparse[name][key]['grid'].getData(),
+                                       full[name][key]['grid'].getData(),
+                                       rtol=1e-10)
+
+
+def test_batch_stream():
+    configs = [modelLS, modelLQ]
+    tempdir = tempfile.mkdtemp()
+    try:
+        outfiles = {'TestModelLQ': os.path.join(tempdir, 'lq.hdf5')}
+        batch = LogisticBatch(shakefile, configs, uncertfile=uncertfile)
+        full = batch.calculate(cleanup=False)
+        results = batch.calculate(rowmax=1, sparse=True, outfiles=outfiles)
+        np.testing.assert_allclose(
+            results['TestModelLS']['model']['grid'].getData(),
+            full['TestModelLS']['model']['grid'].getData(), rtol=1e-10)
+        assert results['TestModelLQ'] == outfiles['TestModelLQ']
+        mgrid = MultiHazardGrid.load(outfiles['TestModelLQ'])
+        for key in full['TestModelLQ']:
+            np.testing.assert_allclose(
+                mgrid.getData()[key].getData(),
+                full['TestModelLQ'][key]['grid'].getData(), rtol=1e-10)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_batch()
+    test_batch_sparse()
+    test_batch_stream()
+    print('batch.py tests passed')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import numpy as np
+from mapio.gdal import GDALGrid
+from mapio.geodict import GeoDict
+from gfail.catalog import LayerCatalog
+from gfail.logisticmodel import MONTHS
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+datadir = os.path.abspath(os.path.join(homedir, 'data'))
+
+
+def test_catalog():
+    tempdir = tempfile.mkdtemp()
+    try:
+        slopefile = os.path.join(datadir, 'test_slope.bil')
+        cachedir = os.path.join(tempdir, 'catalog')
+        catalog = LayerCatalog(cachedir=cachedir)
+
+        # Same geodictionary and file type as probing the file
+        gdict, firstcol = catalog.getGeoDict(slopefile)
+        target, targetcol = GDALGrid.getFileGeoDict(slopefile)
+        assert gdict == target and firstcol == targetcol
+        assert catalog.getFileType(slopefile) == 'esri'
+        assert catalog.getFileType(slopefile[:-4] + '.hdr') == 'unknown'
+        entry = catalog.getEntry(slopefile)
+        assert entry['dtype'] == 'float32'
+        assert len(entry['blocksize']) == 2
+        assert catalog.misses == 2
+
+        # Directories of monthly files
+        monthdir = os.path.join(tempdir, 'precip')
+        os.makedirs(monthdir)
+        gdict = GeoDict({'xmin': 0.5, 'xmax': 3.5, 'ymin': 0.5, 'ymax': 2.5,
+                         'dx': 1., 'dy': 1., 'nx': 4, 'ny': 3})
+        for i, month in enumerate(MONTHS[:3]):
+            GDALGrid(np.full((3, 4), float(i)), gdict).save(
+                os.path.join(monthdir, 'prec_%s.bil' % month))
+        assert catalog.getFileType(monthdir) == 'dir'
+        files = catalog.getGridFiles(monthdir)
+        assert sorted(files) == [os.path.join(monthdir, 'prec_%s.bil' % m)
+                                 for m in ['Feb', 'Jan', 'Mar']]
+        timefiles = catalog.getTimeFiles(files, MONTHS)
+        assert list(timefiles.keys()) == MONTHS[:3]
+        assert timefiles['Feb'] == os.path.join(monthdir, 'prec_Feb.bil')
+        assert timefiles.get('Apr') is None
+        assert catalog.getGeoDict(timefiles['Mar'])[0] == gdict
+
+        # Entries saved on disk are reused by another catalog
+        catalog2 = LayerCatalog(cachedir=cachedir)
+        assert catalog2.getGeoDict(slopefile)[0] == target
+        assert sorted(catalog2.getGridFiles(monthdir)) == sorted(files)
+        assert catalog2.misses == 0
+
+        # Changed files are probed again
+        gdict2 = GeoDict({'xmin': 0.5, 'xmax': 4.5, 'ymin': 0.5,
+                          'ymax': 2.5, 'dx': 1., 'dy': 1., 'nx': 5, 'ny': 3})
+        GDALGrid(np.zeros((3, 5)), gdict2).save(timefiles['Jan'])
+        assert catalog2.getGeoDict(timefiles['Jan'])[0] == gdict2
+        assert catalog2.misses == 1
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_catalog()
+    print('catalog.py tests passed')
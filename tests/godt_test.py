@@ -2,11 +2,16 @@
 
 import os.path
 import os
+import shutil
+import tempfile
 from configobj import ConfigObj
 import numpy as np
-from gfail.godt import godt2008
+from gfail.godt import (godt2008, NMdisp, NMdispEnsemble, NMcritical,
+                        _inRange, getGodtBakeHash, readGodtBake,
+                        BAKE_PARAMS)
 from mapio.geodict import GeoDict
 from gfail.conf import correct_config_filepaths
+from gfail.bake import bakeGodt
 
 homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
 datadir = os.path.abspath(os.path.join(homedir, 'data'))
@@ -89,6 +94,154 @@ def test_godt2008():
                                np.array([[0., 0.01], [0.9, 0.]]), atol=0.01)
 
 
+def test_godt2008_blocks():
+    configfile = os.path.join(datadir, 'testconfig_godt.ini')
+    config = ConfigObj(configfile)
+    config['godt_2008']['divfactor'] = 1
+    config = correct_config_filepaths(datadir, config)
+    target = godt2008(shakefile, config, displmodel='RS_PGA_PGV',
+                      uncertfile=uncertfile, saveinputs=True)
+    # Blocks of rows give the same results, computed in any order
+    for nworkers, executor in [(1, 'thread'), (2, 'thread'),
+                               (2, 'process')]:
+        maplayers = godt2008(shakefile, config, displmodel='RS_PGA_PGV',
+                             uncertfile=uncertfile, saveinputs=True,
+                             rowmax=1, nworkers=nworkers, executor=executor)
+        assert list(maplayers.keys()) == list(target.keys())
+        for key in target:
+            np.testing.assert_array_equal(maplayers[key]['grid'].getData(),
+                                          target[key]['grid'].getData())
+
+
+def test_NMcritical():
+    np.random.seed(1)
+    n = 10000
+    Ac = np.exp(np.random.uniform(np.log(0.01), np.log(2.), n))
+    PGA = np.exp(np.random.uniform(np.log(0.005), np.log(2.), n))
+    PGV = np.exp(np.random.uniform(np.log(0.5), np.log(300.), n))
+    PGA[:10] = 0.
+    for model in ['J_PGA', 'J_PGA_M', 'RS_PGA_M', 'RS_PGA_PGV', 'BT_PGA_M']:
+        for dnthresh in [1., 5., 20.]:
+            Dn = NMdisp(Ac, PGA, model=model, M=7.1, PGV=PGV)[0]
+            Acmin, Acmax = NMcritical(PGA, model=model, M=7.1, PGV=PGV,
+                                      dnthresh=dnthresh)
+            # Same exceedances as the displacements, except within
+            # rounding of the threshold
+            same = (Dn >= dnthresh) == _inRange(Ac, Acmin, Acmax)
+            near = np.abs(np.log(Dn / dnthresh)) < 1e-6
+            assert (same | near).all()
+
+
+def test_NMdispEnsemble():
+    np.random.seed(2)
+    Ac = np.random.uniform(0.05, 0.5, (20, 30))
+    PGA = np.random.uniform(0.01, 1., (20, 30))
+    PGV = np.random.uniform(1., 100., (20, 30))
+    Dn, logDnstd, logtype, results = NMdispEnsemble(Ac, PGA, M=6.5, PGV=PGV)
+    assert logtype == 'ln'
+    assert list(results.keys()) == ['J_PGA', 'J_PGA_M', 'RS_PGA_M',
+                                    'RS_PGA_PGV', 'BT_PGA_M']
+    # Same as evaluating the models one at a time
+    for model, result in results.items():
+        target = NMdisp(Ac, PGA, model=model, M=6.5, PGV=PGV)
+        np.testing.assert_array_equal(result[0], target[0])
+        np.testing.assert_array_equal(result[1], target[1])
+        assert result[2] == target[2]
+    np.testing.assert_allclose(
+        Dn, np.mean([result[0] for result in results.values()], axis=0))
+    Dnall = NMdisp(Ac, PGA, model='all', M=6.5, PGV=PGV)
+    np.testing.assert_array_equal(Dnall[0], Dn)
+    np.testing.assert_array_equal(Dnall[1], logDnstd)
+
+    # Scalar inputs
+    Dn, logDnstd, logtype, results = NMdispEnsemble(
+        0.1, 0.5, models=['J_PGA', 'BT_PGA_M'], M=6.5)
+    assert isinstance(results['J_PGA'][0], float)
+    np.testing.assert_allclose(
+        Dn, (NMdisp(0.1, 0.5)[0] + NMdisp(0.1, 0.5, 'BT_PGA_M', M=6.5)[0])/2.)
+
+    # Average of all models in godt2008
+    configfile = os.path.join(datadir, 'testconfig_godt.ini')
+    config = correct_config_filepaths(datadir, ConfigObj(configfile))
+    maplayers = godt2008(shakefile, config, displmodel='all',
+                         uncertfile=uncertfile, saveinputs=True)
+    assert 'pgvmax' in maplayers
+    np.testing.assert_allclose(maplayers['model']['grid'].getData(),
+                               np.array([[0., 0.5], [0.99, 0.]]), atol=0.01)
+
+
+def test_godt2008_fastcount():
+    configfile = os.path.join(datadir, 'testconfig_godt.ini')
+    config = ConfigObj(configfile)
+    config = correct_config_filepaths(datadir, config)
+    for displmodel in ['J_PGA', 'J_PGA_M', 'RS_PGA_M', 'RS_PGA_PGV',
+                       'BT_PGA_M']:
+        target = godt2008(shakefile, config, displmodel=displmodel,
+                          uncertfile=uncertfile, saveinputs=True)
+        maplayers = godt2008(shakefile, config, displmodel=displmodel,
+                             uncertfile=uncertfile, saveinputs=True,
+                             fastcount=True)
+        assert list(maplayers.keys()) == list(target.keys())
+        for key in target:
+            np.testing.assert_array_equal(maplayers[key]['grid'].getData(),
+                                          target[key]['grid'].getData())
+
+
+def test_godt2008_bake():
+    tempdir = tempfile.mkdtemp()
+    try:
+        configfile = os.path.join(datadir, 'testconfig_godt.ini')
+        config = ConfigObj(configfile)
+        config = correct_config_filepaths(datadir, config)
+        bakefile = bakeGodt(config, tempdir, rowmax=1)
+        assert os.path.exists(bakefile)
+        target = godt2008(shakefile, config, displmodel='RS_PGA_PGV',
+                          uncertfile=uncertfile)
+
+        config['godt_2008']['bakefile'] = bakefile
+        maplayers = godt2008(shakefile, config, displmodel='RS_PGA_PGV',
+                             uncertfile=uncertfile)
+        assert list(maplayers.keys()) == list(target.keys())
+        for key in target:
+            np.testing.assert_array_equal(maplayers[key]['grid'].getData(),
+                                          target[key]['grid'].getData())
+
+        # Changing the parameters makes the baked grids stale
+        config['godt_2008']['parameters']['thick'] = 3.
+        stale = godt2008(shakefile, config, displmodel='RS_PGA_PGV')
+        config['godt_2008'].pop('bakefile')
+        unbaked = godt2008(shakefile, config, displmodel='RS_PGA_PGV')
+        np.testing.assert_array_equal(stale['model']['grid'].getData(),
+                                      unbaked['model']['grid'].getData())
+
+        # So does updating a layer file with the same size
+        cmodel = config['godt_2008']
+        cohesionfile = os.path.join(tempdir, 'cohesion.bil')
+        shutil.copy(cmodel['layers']['cohesion']['file'], cohesionfile)
+        shutil.copy(cmodel['layers']['cohesion']['file'][:-4] + '.hdr',
+                    cohesionfile[:-4] + '.hdr')
+        cmodel['layers']['cohesion']['file'] = cohesionfile
+        bakefile = bakeGodt(config, os.path.join(tempdir, 'updated'),
+                            rowmax=1)
+        params = dict([(key, float(cmodel['parameters'][key]))
+                       for key in BAKE_PARAMS
+                       if key not in ['slopediv', 'codiv']])
+        params.update(slopediv=100., codiv=10.)
+        args = (cmodel['layers']['slope']['filepath'], cohesionfile,
+                cmodel['layers']['friction']['file'], params)
+        assert readGodtBake(bakefile, getGodtBakeHash(*args)) is not None
+        stat = os.stat(cohesionfile)
+        os.utime(cohesionfile, (stat.st_atime, stat.st_mtime + 10.))
+        assert readGodtBake(bakefile, getGodtBakeHash(*args)) is None
+    finally:
+        shutil.rmtree(tempdir)
+
+
 if __name__ == "__main__":
     test_godt2008()
+    test_godt2008_blocks()
+    test_NMcritical()
+    test_NMdispEnsemble()
+    test_godt2008_fastcount()
+    test_godt2008_bake()
     print('godt2008 tests passed')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import fiona
+import numpy as np
+import rasterio
+import rasterio.mask
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
+from gfail.landmask import (LandMask, LandPyramid, buildLandPyramid,
+                            rasterizeMask, getFeatures)
+from gfail.spatial import trim_ocean
+
+geodict = GeoDict({'xmin': 0.05, 'xmax': 1.95, 'ymin': 0.05, 'ymax': 1.45,
+                   'dx': 0.1, 'dy': 0.1, 'nx': 20, 'ny': 15})
+land = {'type': 'Polygon',
+        'coordinates': [[(0.33, 0.27), (1.52, 0.41), (1.21, 1.18),
+                         (0.47, 0.93), (0.33, 0.27)]]}
+
+
+def writeShapefile(filename):
+    schema = {'geometry': 'Polygon', 'properties': {'id': 'int'}}
+    with fiona.open(filename, 'w', driver='ESRI Shapefile',
+                    schema=schema, crs='EPSG:4326') as dst:
+        dst.write({'geometry': land, 'properties': {'id': 1}})
+
+
+def rasterioMask(data, all_touched, invert, nodata):
+    """
+    Mask data with rasterio.mask.mask, as trim_ocean used to.
+    """
+    profile = {'driver': 'GTiff', 'height': geodict.ny, 'width': geodict.nx,
+               'count': 1, 'dtype': 'float64', 'crs': 'EPSG:4326',
+               'transform': from_origin(0., 1.5, 0.1, 0.1)}
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as src:
+            src.write(data, 1)
+        with memfile.open() as src:
+            out_image, out_transform = rasterio.mask.mask(
+                src, [land], all_touched=all_touched, invert=invert,
+                nodata=nodata)
+    return out_image[0]
+
+
+def test_landmask():
+    tempdir = tempfile.mkdtemp()
+    try:
+        shpfile = os.path.join(tempdir, 'land.shp')
+        writeShapefile(shpfile)
+        data = np.arange(geodict.ny * geodict.nx, dtype=float).reshape(
+            (geodict.ny, geodict.nx)) + 1.
+
+        # Same cells as rasterio.mask.mask
+        cache = LandMask(cachedir=os.path.join(tempdir, 'cache'))
+        for all_touched in [True, False]:
+            for invert in [True, False]:
+                outside = cache.getMask(shpfile, geodict,
+                                        all_touched=all_touched,
+                                        invert=invert)
+                target = rasterioMask(data, all_touched, invert, 0.)
+                np.testing.assert_array_equal(outside, target == 0.)
+                assert outside.any() and not outside.all()
+        assert cache.misses == 4 and cache.hits == 0
+        cache.getMask(shpfile, geodict)
+        assert cache.hits == 1
+
+        # Masks saved on disk are reused by another cache
+        cache2 = LandMask(cachedir=os.path.join(tempdir, 'cache'))
+        outside = cache2.getMask(shpfile, geodict, all_touched=False)
+        assert cache2.hits == 1 and cache2.misses == 0
+        np.testing.assert_array_equal(
+            outside, rasterioMask(data, False, False, 0.) == 0.)
+
+        # Lists of shapes are rasterized without caching
+        outside = cache2.getMask([land], geodict)
+        np.testing.assert_array_equal(
+            outside, rasterioMask(data, True, False, 0.) == 0.)
+        assert cache2.misses == 0
+
+        # trim_ocean, with nan
+        grid = Grid2D(data, geodict)
+        trimmed = trim_ocean(grid, shpfile, nodata=float('nan'))
+        target = rasterioMask(data, True, False, np.nan)
+        np.testing.assert_array_equal(trimmed.getData(), target)
+        np.testing.assert_array_equal(grid.getData(), data)
+        trimmed = trim_ocean(grid, shpfile, nodata=float('nan'),
+                             inplace=True)
+        assert trimmed is grid
+        np.testing.assert_array_equal(grid.getData(), target)
+
+        # Integer grids become floats for nan
+        grid = Grid2D(data.astype(int), geodict)
+        trimmed = trim_ocean(grid, shpfile, nodata=float('nan'),
+                             inplace=True)
+        np.testing.assert_array_equal(trimmed.getData(), target)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_landpyramid():
+    tempdir = tempfile.mkdtemp()
+    try:
+        shpfile = os.path.join(tempdir, 'land.shp')
+        writeShapefile(shpfile)
+        bounds = {'xmin': -1., 'xmax': 3., 'ymin': -1., 'ymax': 2.}
+        manifest = buildLandPyramid(shpfile, os.path.join(tempdir, 'pyr'),
+                                    resolutions=[0.1, 0.05], bounds=bounds,
+                                    rowmax=7)
+        pyramid = LandPyramid(manifest)
+        assert [level['dx'] for level in pyramid.levels] == [0.05, 0.1]
+        assert pyramid.matches(shpfile)
+        assert not pyramid.matches([land])
+        stat = os.stat(shpfile)
+        os.utime(shpfile, (stat.st_atime, stat.st_mtime + 10.))
+        assert not pyramid.matches(shpfile)
+        os.utime(shpfile, (stat.st_atime, stat.st_mtime))
+        assert pyramid.matches(shpfile)
+
+        # Aligned grids read the same cells as rasterizing the shapefile
+        fine = GeoDict({'xmin': 0.125, 'xmax': 1.775, 'ymin': 0.025,
+                        'ymax': 1.375, 'dx': 0.05, 'dy': 0.05, 'nx': 34,
+                        'ny': 28})
+        for gdict in [geodict, fine]:
+            for invert in [True, False]:
+                target = rasterizeMask(getFeatures(shpfile, gdict), gdict,
+                                       invert=invert)
+                np.testing.assert_array_equal(
+                    pyramid.getMask(gdict, invert=invert), target)
+
+        # Other grids are not read from the pyramid
+        shifted = GeoDict({'xmin': 0.1, 'xmax': 1.9, 'ymin': 0.1,
+                           'ymax': 1.4, 'dx': 0.1, 'dy': 0.1, 'nx': 19,
+                           'ny': 14})
+        assert pyramid.getMask(shifted) is None
+        outside = GeoDict({'xmin': 2.55, 'xmax': 3.45, 'ymin': 0.05,
+                           'ymax': 0.95, 'dx': 0.1, 'dy': 0.1, 'nx': 10,
+                           'ny': 10})
+        assert pyramid.getMask(outside) is None
+
+        cache = LandMask(pyramid=manifest)
+        np.testing.assert_array_equal(
+            cache.getMask(shpfile, geodict),
+            rasterizeMask(getFeatures(shpfile, geodict), geodict))
+        np.testing.assert_array_equal(
+            cache.getMask(shpfile, shifted),
+            rasterizeMask(getFeatures(shpfile, shifted), shifted))
+
+        # Boxes over land or water
+        assert pyramid.overLand(0.8, 1.0, 0.5, 0.7)
+        assert not pyramid.overLand(1.7, 2.5, 1.3, 1.9)
+        assert not pyramid.overLand(-0.9, 0.1, -0.9, 0.1)
+        assert pyramid.overLand(2.5, 3.5, 0., 1.) is None
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_landmask()
+    test_landpyramid()
+    print('landmask.py tests passed')
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import os.path
+import glob
+import shutil
+import tempfile
+import numpy as np
+from mapio.geodict import GeoDict
+from gfail.spatial import quickcut
+import gfail.layercache
+from gfail.layercache import LayerCache
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+datadir = os.path.abspath(os.path.join(homedir, 'data'))
+slopefile = os.path.join(datadir, 'test_slope.bil')
+vs30file = os.path.join(datadir, 'test_vs30.bil')
+geodict = GeoDict.createDictFromBox(0.6, 1.4, 0.6, 1.4, 0.1, 0.1,
+                                    inside=True)
+
+
+def test_layercache():
+    tempdir = tempfile.mkdtemp()
+    try:
+        cache = LayerCache(cachedir=tempdir)
+        target = quickcut(slopefile, geodict, method='bilinear')
+        for i in range(2):
+            grid = cache.quickcut(slopefile, geodict, method='bilinear')
+            assert grid.getGeoDict() == target.getGeoDict()
+            np.testing.assert_allclose(grid.getData(), target.getData())
+            # Callers get copies
+            grid.getData()[:] = -1.
+        assert cache.misses == 1 and cache.hits == 1
+
+        # Method is part of the key
+        grid = cache.quickcut(slopefile, geodict, method='nearest')
+        np.testing.assert_allclose(
+            grid.getData(),
+            quickcut(slopefile, geodict, method='nearest').getData())
+        assert cache.misses == 2
+
+        # Layers saved on disk are reused by another cache
+        cache2 = LayerCache(cachedir=tempdir)
+        grid = cache2.quickcut(slopefile, geodict, method='bilinear')
+        np.testing.assert_allclose(grid.getData(), target.getData())
+        assert cache2.hits == 1 and cache2.misses == 0
+
+        # Size caps evict the least recently used layers
+        nbytes = target.getData().nbytes
+        filesize = os.path.getsize(glob.glob(os.path.join(tempdir,
+                                                          '*.npy'))[0])
+        cache3 = LayerCache(maxbytes=nbytes, cachedir=tempdir,
+                            maxdiskbytes=2.5 * filesize)
+        cache3.quickcut(vs30file, geodict)
+        cache3.quickcut(slopefile, geodict)
+        assert len(cache3.layers) == 1
+        assert len(glob.glob(os.path.join(tempdir, '*.npy'))) == 2
+        assert cache3.quickcut(slopefile, geodict) is not None
+        assert cache3.hits == 2 and cache3.misses == 1
+
+        # Layers kept in memory are copied for callers
+        grid = cache3.quickcut(slopefile, geodict)
+        assert grid.getData() is not cache3.layers[
+            list(cache3.layers)[0]].getData()
+
+        # No layers are kept in memory by default, and cut layers are
+        # returned without copies
+        cuts = []
+
+        def recordcut(*args, **kwargs):
+            cuts.append(quickcut(*args, **kwargs))
+            return cuts[-1]
+
+        gfail.layercache.quickcut = recordcut
+        try:
+            cache4 = LayerCache()
+            grid = cache4.quickcut(slopefile, geodict)
+            assert grid is cuts[0]
+            cache4.quickcut(slopefile, geodict)
+            assert len(cache4.layers) == 0 and cache4.misses == 2
+        finally:
+            gfail.layercache.quickcut = quickcut
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_layercache()
+    print('layercache.py tests passed')
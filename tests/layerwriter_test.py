@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import collections
+import numpy as np
+from mapio.geodict import GeoDict
+from mapio.multihaz import MultiHazardGrid
+from gfail.layerwriter import LayerWriter
+
+geodict = GeoDict({'xmin': 0.5, 'xmax': 4.5,
+                   'ymin': 0.5, 'ymax': 3.5,
+                   'dx': 1.0, 'dy': 1.0,
+                   'ny': 4, 'nx': 5})
+data = np.arange(20, dtype=float).reshape(4, 5)
+
+
+def test_layerwriter():
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'layers.hdf5')
+        layers = collections.OrderedDict()
+        layers['model'] = {
+            'label': 'Model',
+            'type': 'output',
+            'description': {'name': 'test', 'units': 'Probability',
+                            'parameters': {'slopemin': 5.}}}
+        layers['slope'] = {
+            'label': 'slope (degrees)',
+            'type': 'input',
+            'description': {'units': 'degrees'}}
+        with LayerWriter(filename, geodict, layers, chunks=(2, 2)) as writer:
+            for rowstart, rowend in [(0, 3), (3, None)]:
+                for colstart, colend in [(0, 2), (2, None)]:
+                    tile = data[rowstart:rowend, colstart:colend]
+                    writer.write('model', tile / 20., rowstart, rowend,
+                                 colstart, colend)
+            # Tiles that are never written are nan
+            writer.write('slope', data[1:, :], 1, None, 0, None)
+
+        # Same format as savelayers, so loadlayers can read it
+        mgrid = MultiHazardGrid.load(filename)
+        assert mgrid.getGeoDict() == geodict
+        assert sorted(mgrid.getLayerNames()) == ['model', 'slope']
+        np.testing.assert_allclose(mgrid.getData()['model'].getData(),
+                                   data / 20.)
+        slope = mgrid.getData()['slope'].getData()
+        assert np.isnan(slope[0]).all()
+        np.testing.assert_allclose(slope[1:], data[1:])
+        metadata = mgrid.getMetadata()
+        assert metadata['model']['label'] == 'Model'
+        assert metadata['model']['type'] == 'output'
+        assert metadata['model']['description']['parameters']['slopemin'] \
+            == 5.
+        assert metadata['slope']['description']['units'] == 'degrees'
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_layerwriter()
+    print('layerwriter.py tests passed')
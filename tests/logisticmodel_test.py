@@ -2,10 +2,13 @@
 
 import os.path
 import os
+import shutil
+import tempfile
 from configobj import ConfigObj
 import numpy as np
 import gfail.logisticmodel as LM
 from mapio.geodict import GeoDict
+from mapio.multihaz import MultiHazardGrid
 from gfail.conf import correct_config_filepaths
 
 homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
@@ -156,6 +159,170 @@ def test_logisticmodel():
     np.testing.assert_allclose(LQ['model']['grid'].getData(),
                                targetLQ, rtol=1e-05)
 
+    # Tiles computed concurrently should give the same results
+    for executor in LM.EXECUTORS:
+        lsp = LM.LogisticModel(shakefile, modelLS,
+                               uncertfile=uncertfile,
+                               slopefile=slopefile)
+        LSP = lsp.calculate(rowmax=1, colmax=1, nworkers=2,
+                            executor=executor)
+        np.testing.assert_allclose(LSP['modelmin']['grid'].getData(),
+                                   targetLSU, rtol=1e-05)
+
+
+def test_sparse():
+    modelLQ = {
+        'TestModelLQ': {
+            'description': 'This is a test liquefaction model',
+            'gfetype': 'liquefaction',
+            'baselayer': 'vs30',
+            'vs30max': 450.,
+            'minpga': 30.,
+            'layers': {
+                'vs30': {
+                    'file': vs30file,
+                    'units': 'm/s',
+                    'longref': 'more words',
+                    'shortref': 'words'
+                },
+                'cti1': {
+                    'file': ctifile,
+                    'units': 'unitless',
+                    'longref': 'more words',
+                    'shortref': 'words'
+                }
+            },
+            'interpolations': {
+                'vs30': 'nearest',
+                'cti1': 'linear'
+            },
+            'terms': {
+                'b1': 'log((pga/100.0)*(power(MW,2.)))',
+                'b2': 'cti1',
+                'b3': 'log(vs30)'
+            },
+            'coefficients': {
+                'b0': 15.,
+                'b1': 2.,
+                'b2': 0.3,
+                'b3': -4.
+            },
+            'coverage': {
+                'eqn': '0.1 + 0.81*P'
+            }
+        }
+    }
+
+    modelLS = {
+        'TestModelLS': {
+            'description': 'This is a test landslide model',
+            'gfetype': 'landslide',
+            'baselayer': 'slope',
+            'slopemin': 12.,
+            'slopemax': 90.,
+            'layers': {
+                'slope': {
+                    'file': slopefile,
+                    'units': 'degrees',
+                    'longref': 'more words',
+                    'shortref': 'words'
+                }
+            },
+            'interpolations': {
+                'slope': 'linear'
+            },
+            'terms': {
+                'b1': 'log(pga)',
+                'b2': 'slope'
+            },
+            'coefficients': {
+                'b0': -7.,
+                'b1': 0.6,
+                'b2': 0.0008
+            }
+        }
+    }
+
+    # Only the cell with vs30 = 400 and pga = 72 is evaluated
+    lq = LM.LogisticModel(shakefile, modelLQ, uncertfile=uncertfile)
+    np.testing.assert_array_equal(lq.getEvaluationMask(),
+                                  [[False, True], [False, False]])
+    ls = LM.LogisticModel(shakefile, modelLS, slopefile=slopefile)
+    np.testing.assert_array_equal(ls.getEvaluationMask(),
+                                  [[False, True], [True, True]])
+
+    # Mask-first evaluation gives the same results
+    for model in [modelLQ, modelLS]:
+        for nworkers in [1, 2]:
+            full = LM.LogisticModel(shakefile, model, uncertfile=uncertfile,
+                                    slopefile=slopefile).calculate()
+            sparse = LM.LogisticModel(shakefile, model,
+                                      uncertfile=uncertfile,
+                                      slopefile=slopefile).calculate(
+                rowmax=1, colmax=1, nworkers=nworkers, sparse=True)
+            assert list(sparse.keys()) == list(full.keys())
+            for key in full:
+                np.testing.assert_allclose(sparse[key]['grid'].getData(),
+                                           full[key]['grid'].getData(),
+                                           rtol=1e-10)
+
+
+def test_stream():
+    modelLS = {
+        'TestModelLS': {
+            'description': 'This is a test landslide model',
+            'gfetype': 'landslide',
+            'baselayer': 'slope',
+            'slopemin': 12.,
+            'slopemax': 90.,
+            'minpga': 30.,
+            'layers': {
+                'slope': {
+                    'file': slopefile,
+                    'units': 'degrees',
+                    'longref': 'more words',
+                    'shortref': 'words'
+                }
+            },
+            'interpolations': {
+                'slope': 'linear'
+            },
+            'terms': {
+                'b1': 'log(pga)',
+                'b2': 'slope'
+            },
+            'coefficients': {
+                'b0': -7.,
+                'b1': 0.6,
+                'b2': 0.0008
+            }
+        }
+    }
+    tempdir = tempfile.mkdtemp()
+    try:
+        outfile = os.path.join(tempdir, 'model.hdf5')
+        for uncert, saveinputs in [(uncertfile, False), (None, True)]:
+            for sparse in [False, True]:
+                kwargs = dict(uncertfile=uncert, slopefile=slopefile,
+                              saveinputs=saveinputs)
+                target = LM.LogisticModel(
+                    shakefile, modelLS, **kwargs).calculate(sparse=sparse)
+                lm = LM.LogisticModel(shakefile, modelLS, **kwargs)
+                result = lm.calculate(rowmax=1, colmax=1, nworkers=2,
+                                      sparse=sparse, outfile=outfile)
+                assert result == outfile
+                assert not os.path.exists(lm.tempdir)
+                mgrid = MultiHazardGrid.load(outfile)
+                assert sorted(mgrid.getLayerNames()) == sorted(target.keys())
+                for key in target:
+                    np.testing.assert_allclose(
+                        mgrid.getData()[key].getData(),
+                        target[key]['grid'].getData(), rtol=1e-6)
+                    assert mgrid.getMetadata()[key]['label'] == \
+                        target[key]['label']
+    finally:
+        shutil.rmtree(tempdir)
+
 
 def test_getLogisticModelNames():
     names = LM.getLogisticModelNames(config)
@@ -258,6 +425,8 @@ def test_checkTerm():
 
 if __name__ == "__main__":
     test_logisticmodel()
+    test_sparse()
+    test_stream()
     test_getLogisticModelNames()
     test_validateCoefficients()
     test_validateLayers()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os.path
+import time
+import shutil
+import tempfile
+import fiona
+from shapely.geometry import box, shape
+from gfail.polygonstore import getPolygonStore, clearPolygonStores
+
+polygons = [
+    {'type': 'Polygon',
+     'coordinates': [[(0., 0.), (1., 0.), (1., 1.), (0., 1.), (0., 0.)]]},
+    {'type': 'Polygon',
+     'coordinates': [[(2., 2.), (3., 2.), (2., 3.), (2., 2.)]]},
+    {'type': 'Polygon',
+     'coordinates': [[(5., 0.), (6., 0.), (6., 4.), (5., 4.), (5., 0.)]]}
+]
+
+
+def writeShapefile(filename, geoms):
+    schema = {'geometry': 'Polygon', 'properties': {'id': 'int'}}
+    with fiona.open(filename, 'w', driver='ESRI Shapefile',
+                    schema=schema, crs='EPSG:4326') as dst:
+        for i, geom in enumerate(geoms):
+            dst.write({'geometry': geom, 'properties': {'id': i}})
+
+
+def test_polygonstore():
+    tempdir = tempfile.mkdtemp()
+    try:
+        shpfile = os.path.join(tempdir, 'land.shp')
+        writeShapefile(shpfile, polygons)
+        store = getPolygonStore(shpfile)
+        assert getPolygonStore(shpfile) is store
+
+        # Same features as a bounding box query of the shapefile
+        for bbox in [(0.5, 0.5, 2.5, 2.5), (2.8, 2.8, 4., 4.),
+                     (-1., -1., 10., 10.), (7., 7., 8., 8.)]:
+            with fiona.open(shpfile) as shapefile:
+                target = [shape(feature[1]['geometry'])
+                          for feature in shapefile.items(bbox=bbox)]
+            geoms = store.query(bbox)
+            assert len(geoms) == len(target)
+            for geom, tgeom in zip(geoms, target):
+                assert geom.equals(tgeom)
+
+        # The corner of the triangle is in its bounding box only
+        assert store.intersects(box(0.5, 0.5, 1.5, 1.5))
+        assert not store.intersects(box(2.8, 2.8, 4., 4.))
+        assert store.intersects(box(4., 3.5, 5.5, 5.))
+
+        clipped = store.clip((0.5, -1., 5.5, 0.5))
+        assert len(clipped) == 2
+        assert abs(clipped[0].area - 0.25) < 1e-12
+        assert abs(clipped[1].area - 0.25) < 1e-12
+        assert store.clip((2.8, 2.8, 4., 4.)) == []
+
+        # Modified files are read again
+        time.sleep(0.01)
+        writeShapefile(shpfile, polygons[:1])
+        store2 = getPolygonStore(shpfile)
+        assert store2 is not store
+        assert not store2.intersects(box(4., 3.5, 5.5, 5.))
+        clearPolygonStores()
+        assert getPolygonStore(shpfile) is not store2
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_polygonstore()
+    print('polygonstore.py tests passed')
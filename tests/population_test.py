@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import numpy as np
+from mapio.gdal import GDALGrid
+from mapio.geodict import GeoDict
+from gfail.spatial import quickcut
+from gfail.population import (convertPopulation, getPopulationGrid,
+                              clearPopulationGrids)
+
+
+def test_population():
+    tempdir = tempfile.mkdtemp()
+    try:
+        popfile = os.path.join(tempdir, 'pop.bil')
+        pdict = GeoDict.createDictFromBox(-123., -121., 36., 38., 1/30.,
+                                          1/30.)
+        rs = np.random.RandomState(0)
+        data = rs.randint(0, 1000, (pdict.ny, pdict.nx)).astype(float)
+        data[:3, :3] = -9999.
+        GDALGrid(data, pdict).save(popfile)
+        manifest = convertPopulation(popfile, os.path.join(tempdir, 'pop'),
+                                     rowmax=7)
+
+        gdicts = [
+            GeoDict.createDictFromBox(-122.3, -121.5, 36.6, 37.1, 1/120.,
+                                      1/120.),
+            GeoDict.createDictFromBox(-122.2, -121.6, 36.7, 37.0, 1/120.,
+                                      1/120.),
+            GeoDict.createDictFromBox(-123.5, -122.5, 37.5, 38.5, 1/120.,
+                                      1/120.),
+            pdict]
+        for filename in [manifest, popfile]:
+            grid = getPopulationGrid(filename)
+            assert getPopulationGrid(filename) is grid
+            for gdict in gdicts:
+                # Same window as quickcut of the population file
+                window = grid.getWindow(gdict, extrasamp=2.)
+                target = quickcut(popfile, gdict, precise=False,
+                                  extrasamp=2., method='nearest')
+                assert window.getGeoDict() == target.getGeoDict()
+                np.testing.assert_array_equal(window.getData(),
+                                              target.getData())
+                # Windows are copies
+                window.getData()[:] = 0.
+            assert grid.window[4] is not window.getData()
+
+        # Second window was cut from the first one
+        grid = getPopulationGrid(manifest)
+        grid.getWindow(gdicts[0])
+        first = grid.window
+        grid.getWindow(gdicts[1])
+        assert grid.window is first
+        clearPopulationGrids()
+        assert getPopulationGrid(manifest) is not grid
+
+        # The population file is read instead of an out of date array
+        grid = getPopulationGrid(manifest)
+        assert grid.data is not None
+        stat = os.stat(popfile)
+        os.utime(popfile, (stat.st_atime, stat.st_mtime + 10.))
+        grid2 = getPopulationGrid(manifest)
+        assert grid2 is not grid and grid2.data is None
+        target = quickcut(popfile, gdicts[0], precise=False, extrasamp=2.,
+                          method='nearest')
+        np.testing.assert_array_equal(grid2.getWindow(gdicts[0]).getData(),
+                                      target.getData())
+        assert getPopulationGrid(manifest) is grid2
+    finally:
+        clearPopulationGrids()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_population()
+    print('population.py tests passed')
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import numpy as np
+from mapio.shake import ShakeGrid, getHeaderData
+from mapio.geodict import GeoDict
+from gfail.spatial import quickcut
+import gfail.shakecache as SC
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+datadir = os.path.abspath(os.path.join(homedir, 'data'))
+shakefile = os.path.join(datadir, 'test_shakegrid.xml')
+
+
+def test_shakecache():
+    SC.clearShakeCache()
+    for adjust in ['bounds', 'res']:
+        target = ShakeGrid.load(shakefile, adjust=adjust)
+        grid = SC.loadShakeGrid(shakefile, adjust=adjust)
+        assert grid.getGeoDict() == target.getGeoDict()
+        assert SC.getShakeGeoDict(shakefile, adjust=adjust) == \
+            ShakeGrid.getFileGeoDict(shakefile, adjust=adjust)
+        assert grid.getEventDict() == target.getEventDict()
+        assert grid.getShakeDict() == target.getShakeDict()
+        for layer in target.getLayerNames():
+            np.testing.assert_array_equal(grid.getLayer(layer).getData(),
+                                          target.getLayer(layer).getData())
+        # Parsed once and shared
+        assert SC.loadShakeGrid(shakefile, adjust=adjust) is grid
+        assert not grid.getLayer('pga').getData().flags.writeable
+    header = SC.getShakeHeader(shakefile)
+    assert header[0] == getHeaderData(shakefile)[0]
+    # Headers are copies, changing them does not change the cache
+    header[1]['eventid'] = 'changed'
+    assert 'eventid' not in SC.getShakeHeader(shakefile)[1]
+
+    # Resampled layers are cached copies that callers may modify
+    gdict = GeoDict.createDictFromBox(0.6, 1.4, 0.6, 1.4, 0.1, 0.1,
+                                      inside=True)
+    pga = SC.getShakeLayer(shakefile, 'pga', gdict)
+    target = quickcut(ShakeGrid.load(shakefile).getLayer('pga'), gdict)
+    np.testing.assert_allclose(pga.getData(), target.getData())
+    pga.getData()[:] = -1.
+    pga = SC.getShakeLayer(shakefile, 'pga', gdict)
+    np.testing.assert_allclose(pga.getData(), target.getData())
+
+    # A modified file is read again
+    tempdir = tempfile.mkdtemp()
+    try:
+        tempfile1 = os.path.join(tempdir, 'grid.xml')
+        shutil.copy(shakefile, tempfile1)
+        grid = SC.loadShakeGrid(tempfile1)
+        with open(tempfile1, 'a') as f:
+            f.write('\n')
+        assert SC.loadShakeGrid(tempfile1) is not grid
+    finally:
+        shutil.rmtree(tempdir)
+        SC.clearShakeCache()
+
+
+if __name__ == "__main__":
+    test_shakecache()
+    print('shakecache.py tests passed')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import numpy as np
+import rasterio
+from affine import Affine
+from mapio.gdal import GDALGrid
+from mapio.geodict import GeoDict
+from gfail.spatial import quickcut, getTileGeoDict
+
+
+def test_quickcut():
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'test.tif')
+        data = np.arange(100 * 120, dtype='float32').reshape(100, 120)
+        data[50, 49] = -9999.
+        with rasterio.open(filename, 'w', driver='GTiff', height=100,
+                           width=120, count=1, dtype='float32',
+                           crs='EPSG:4326', nodata=-9999.,
+                           transform=Affine(0.1, 0., 0., 0., -0.1, 10.)) \
+                as dst:
+            dst.write(data, 1)
+        full = GDALGrid.load(filename)
+        gdict = GeoDict.createDictFromBox(3.02, 5.51, 2.03, 4.47, 0.05, 0.05,
+                                          inside=True)
+
+        # Windowed read resampled to the exact geodict
+        for method in ['bilinear', 'nearest']:
+            cut = quickcut(filename, gdict, method=method)
+            target = full.interpolate2(
+                gdict, method=method.replace('bilinear', 'linear'))
+            assert cut.getGeoDict() == gdict
+            np.testing.assert_allclose(cut.getData(), target.getData())
+
+        # Rough cut keeps the resolution of the file, with extra cells
+        cut = quickcut(filename, gdict, precise=False)
+        cgdict = cut.getGeoDict()
+        assert cgdict.dx == full.getGeoDict().dx
+        assert cgdict.xmin < gdict.xmin and cgdict.xmax > gdict.xmax
+        assert cgdict.ymin < gdict.ymin and cgdict.ymax > gdict.ymax
+        assert np.isnan(cut.getValue(4.95, 4.95))
+
+        # Grids already in memory give the same result as files
+        cut2 = quickcut(full, gdict, precise=False)
+        assert cut2.getGeoDict() == cgdict
+        np.testing.assert_array_equal(cut2.getData(), cut.getData())
+        cut2 = quickcut(full, gdict, method='bilinear')
+        np.testing.assert_allclose(
+            cut2.getData(), quickcut(filename, gdict).getData())
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_getTileGeoDict():
+    gdict = GeoDict.createDictFromBox(3.02, 5.51, 2.03, 4.47, 0.05, 0.05,
+                                      inside=True)
+    grid = GDALGrid(np.arange(gdict.ny * gdict.nx, dtype=float).reshape(
+        gdict.ny, gdict.nx), gdict)
+    for tile in [(0, 10, 5, 20), (10, None, None, 7), (None, None, None,
+                                                        None)]:
+        tdict = getTileGeoDict(tile, gdict)
+        data = grid.getData()[slice(tile[0], tile[1]),
+                              slice(tile[2], tile[3])]
+        assert (tdict.ny, tdict.nx) == data.shape
+        # Corner cells are at the same place as in the grid
+        np.testing.assert_allclose(
+            grid.getValue(tdict.ymax, tdict.xmin), data[0, 0])
+        np.testing.assert_allclose(
+            grid.getValue(tdict.ymin, tdict.xmax), data[-1, -1])
+
+
+if __name__ == "__main__":
+    test_quickcut()
+    test_getTileGeoDict()
+    print('spatial.py tests passed')
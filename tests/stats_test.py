@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
+import tempfile
 import numpy as np
 from configobj import ConfigObj
+from mapio.gdal import GDALGrid
+from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
 
 # third party
 from gfail.conf import correct_config_filepaths
@@ -73,5 +78,130 @@ def test_stats_models():
     #np.testing.assert_allclose(stats2['Parea_0.20'], 89.25805325934424)
 
 
+def test_exposures():
+    tempdir = tempfile.mkdtemp()
+    try:
+        popfile = os.path.join(tempdir, 'pop.bil')
+        pdict = GeoDict({'xmin': 0.05, 'xmax': 2.95, 'ymin': 0.05,
+                         'ymax': 1.95, 'dx': 0.1, 'dy': 0.1, 'nx': 30,
+                         'ny': 20})
+        rs = np.random.RandomState(0)
+        pop = rs.randint(0, 1000, (20, 30)).astype(float)
+        GDALGrid(pop, pdict).save(popfile)
+        # Model cells not aligned with population cells
+        mdict = GeoDict({'xmin': 1.015, 'xmax': 1.885, 'ymin': 0.015,
+                         'ymax': 0.585, 'dx': 0.03, 'dy': 0.03, 'nx': 30,
+                         'ny': 20})
+        model = rs.rand(20, 30)
+        model[3, 4] = np.nan
+        exp_pop = stats.get_exposures(Grid2D(model, mdict), popfile)
+
+        # Split both grids into 0.01 degree cells
+        rows = np.arange(60)[:, None]
+        cols = np.arange(90)[None, :]
+        target = np.sum(np.nan_to_num(model)[rows // 3, cols // 3] *
+                        pop[(140 + rows) // 10, (100 + cols) // 10]) / 100.
+        np.testing.assert_allclose(exp_pop['exp_pop_0.00g'], target)
+
+        exp_pop = stats.get_exposures(Grid2D(model, mdict), popfile,
+                                      probthresh=0.5)
+        target = np.sum(np.where(model > 0.5, model, 0.)[rows // 3,
+                                                         cols // 3] *
+                        pop[(140 + rows) // 10, (100 + cols) // 10]) / 100.
+        np.testing.assert_allclose(exp_pop['exp_pop_0.00g'], target)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_overlap_matrix():
+    # Cells of 0.3 covering cells of 1 starting at 0.5
+    weights = stats.getOverlapMatrix(0., 0.3, 10, 0.5, 1., 3).toarray()
+    np.testing.assert_allclose(weights.sum(axis=1), [1., 1., 0.5])
+    np.testing.assert_allclose(weights[0, :3], [0., 0.1, 0.3])
+    np.testing.assert_allclose(weights[2, 8:], [0.2, 0.3])
+
+
+def test_cell_areas():
+    # Whole earth
+    gdict = GeoDict({'xmin': -179.5, 'xmax': 179.5, 'ymin': -89.5,
+                     'ymax': 89.5, 'dx': 1., 'dy': 1., 'nx': 360,
+                     'ny': 180})
+    areas = stats.getCellAreas(gdict)
+    np.testing.assert_allclose(areas.sum() * 360., 510065621.724, rtol=1e-9)
+    np.testing.assert_allclose(areas, areas[::-1])
+    assert stats.getCellAreas(gdict) is areas
+
+    # Same Hagg and Parea as reprojecting, within 2%
+    gdict = GeoDict.createDictFromBox(-122., -121., 37., 38., 1/120.,
+                                      1/120.)
+    yy, xx = np.mgrid[0:gdict.ny, 0:gdict.nx]
+    data = np.sin(yy / 20.)**2 * np.cos(xx / 30.)**2
+    data[:5, :7] = np.nan
+    grid = Grid2D(data, gdict)
+    np.testing.assert_allclose(stats.computeHagg(grid, proj='ellipsoid'),
+                               stats.computeHagg(grid), rtol=0.02)
+    np.testing.assert_allclose(
+        stats.computeParea(grid, proj='ellipsoid', probthresh=0.3),
+        stats.computeParea(grid, probthresh=0.3), rtol=0.02)
+    np.testing.assert_array_equal(np.isnan(grid.getData()), np.isnan(data))
+
+
+def test_stats_engine():
+    tempdir = tempfile.mkdtemp()
+    try:
+        shakefile = os.path.join(datadir, 'loma_prieta', 'grid.xml')
+        popfile = os.path.join(tempdir, 'pop.bil')
+        pdict = GeoDict.createDictFromBox(-123., -121., 36., 38., 1/30.,
+                                          1/30.)
+        rs = np.random.RandomState(0)
+        GDALGrid(rs.randint(0, 1000, (pdict.ny, pdict.nx)).astype(float),
+                 pdict).save(popfile)
+        gdict = GeoDict.createDictFromBox(-122.3, -121.5, 36.6, 37.1,
+                                          1/120., 1/120.)
+        yy, xx = np.mgrid[0:gdict.ny, 0:gdict.nx]
+        data = np.sin(yy / 20.)**2 * np.cos(xx / 30.)**2
+        data[:5, :7] = np.nan
+        grid = Grid2D(data, gdict)
+
+        # Same values as the individual functions
+        shakethresh = [0., 5., 10., 20.]
+        probthresh = [0., 0.1, 0.3]
+        engine = stats.StatsEngine(grid, shakefile=shakefile,
+                                   statprobthresh=0.05, pop_file=popfile)
+        np.testing.assert_allclose(
+            engine.getHagg(shakethresh),
+            stats.computeHagg(grid, probthresh=0.05, shakefile=shakefile,
+                              shakethresh=shakethresh), rtol=1e-10)
+        np.testing.assert_allclose(
+            engine.getParea(probthresh),
+            stats.computeParea(grid, probthresh=probthresh), rtol=1e-10)
+        exp_pop = engine.getExposures(shakethresh)
+        target = stats.get_exposures(grid, popfile, shakefile=shakefile,
+                                     shakethreshtype='pga',
+                                     shakethresh=shakethresh,
+                                     probthresh=0.05)
+        assert list(exp_pop.keys()) == sorted(target.keys())
+        for key, value in target.items():
+            np.testing.assert_allclose(exp_pop[key], value, rtol=1e-10)
+
+        result = stats.computeStats(grid, probthresh=probthresh,
+                                    shakefile=shakefile,
+                                    shakethresh=shakethresh,
+                                    statprobthresh=0.05, pop_file=popfile)
+        assert list(result.keys()) == [
+            'Max', 'Median', 'Std', 'Hagg', 'Hagg_0.05g', 'Hagg_0.10g',
+            'Hagg_0.20g', 'Parea', 'Parea_0.10', 'Parea_0.30',
+            'exp_pop_0.00g', 'exp_pop_0.05g', 'exp_pop_0.10g',
+            'exp_pop_0.20g']
+        np.testing.assert_allclose(result['Max'],
+                                   np.nanmax(data[data > 0.05]))
+    finally:
+        shutil.rmtree(tempdir)
+
+
 if __name__ == "__main__":
     test_stats_models()
+    test_exposures()
+    test_overlap_matrix()
+    test_cell_areas()
+    test_stats_engine()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import os.path
+import shutil
+import tempfile
+import numpy as np
+from mapio.gdal import GDALGrid
+from mapio.geodict import GeoDict
+from mapio.grid2d import Grid2D
+from gfail.stats import computeStats
+from gfail.statstore import (StatsStore, getStatsStore, clearStatsStores,
+                             getAlertStats, MAXSTORES)
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+datadir = os.path.abspath(os.path.join(homedir, 'data'))
+
+
+def test_statstore():
+    tempdir = tempfile.mkdtemp()
+    try:
+        shakefile = os.path.join(datadir, 'loma_prieta', 'grid.xml')
+        popfile = os.path.join(tempdir, 'pop.bil')
+        pdict = GeoDict.createDictFromBox(-123., -121., 36., 38., 1/30.,
+                                          1/30.)
+        rs = np.random.RandomState(0)
+        GDALGrid(rs.randint(0, 1000, (pdict.ny, pdict.nx)).astype(float),
+                 pdict).save(popfile)
+        gdict = GeoDict.createDictFromBox(-122.3, -121.5, 36.6, 37.1,
+                                          1/120., 1/120.)
+        yy, xx = np.mgrid[0:gdict.ny, 0:gdict.nx]
+        data = np.sin(yy / 20.)**2 * np.cos(xx / 30.)**2
+        grid = Grid2D(data, gdict)
+        kwargs = {'shakefile': shakefile, 'statprobthresh': 0.0,
+                  'pop_file': popfile}
+
+        # Same stats as computeStats
+        store = getStatsStore(tempdir)
+        stats = store.getStats(grid, probthresh=[0.1], shakethresh=[5., 10.],
+                               model='test', **kwargs)
+        target = computeStats(grid, probthresh=[0.1], shakethresh=[5., 10.],
+                              **kwargs)
+        assert list(stats.keys()) == list(target.keys())
+        for key, value in target.items():
+            np.testing.assert_allclose(stats[key], value, rtol=1e-10)
+        assert store.misses == 1 and store.hits == 0
+
+        # Thresholds already computed are read from the store, new ones
+        # are added with the same engine
+        stats2 = store.getStats(grid, shakethresh=10., **kwargs)
+        assert list(stats2.keys()) == ['Max', 'Median', 'Std', 'Hagg_0.10g',
+                                       'exp_pop_0.10g']
+        assert stats2['Hagg_0.10g'] == stats['Hagg_0.10g']
+        assert store.hits == 1
+        store.getStats(grid, shakethresh=20., **kwargs)
+        assert store.misses == 2 and len(store.engines) == 1
+
+        # Saved in the event directory for later runs
+        clearStatsStores()
+        store = getStatsStore(tempdir)
+        assert os.path.exists(os.path.join(tempdir, 'stats.json'))
+        stats3 = store.getStats(grid, probthresh=0.1, shakethresh=[5., 10.],
+                                **kwargs)
+        assert store.hits == 1 and store.misses == 0
+        assert stats3['exp_pop_0.05g'] == stats['exp_pop_0.05g']
+
+        # Grids read back from the hdf5 outputs have slightly different
+        # geodicts and are still found
+        gdict2 = GeoDict({'xmin': gdict.xmin, 'xmax': gdict.xmax + 1e-13,
+                          'ymin': gdict.ymin - 1e-13, 'ymax': gdict.ymax,
+                          'dx': gdict.dx + 1e-14, 'dy': gdict.dy,
+                          'nx': gdict.nx, 'ny': gdict.ny})
+        store.getStats(Grid2D(data, gdict2), shakethresh=10., **kwargs)
+        assert store.hits == 2 and store.misses == 0
+
+        # Other model grids or settings are computed again
+        grid2 = Grid2D(data * 0.5, gdict)
+        stats4 = store.getStats(grid2, shakethresh=10., **kwargs)
+        np.testing.assert_allclose(stats4['Hagg_0.10g'],
+                                   0.5 * stats['Hagg_0.10g'])
+        store.getStats(grid, shakefile=shakefile, shakethresh=10.,
+                       statprobthresh=0.1, pop_file=popfile)
+        assert store.misses == 2
+
+        # Least recently used stores are dropped, and read back from their
+        # sidecar files
+        store = getStatsStore(tempdir)
+        for i in range(MAXSTORES):
+            getStatsStore(os.path.join(tempdir, 'event%d' % i))
+        assert getStatsStore(tempdir) is not store
+        assert len(getStatsStore(tempdir).entries) == len(store.entries)
+
+        # Memory only store
+        store = StatsStore()
+        store.getStats(grid, shakethresh=10., **kwargs)
+        assert store.misses == 1
+    finally:
+        clearStatsStores()
+        shutil.rmtree(tempdir)
+
+
+def test_alertstats():
+    tempdir = tempfile.mkdtemp()
+    try:
+        shakefile = os.path.join(datadir, 'loma_prieta', 'grid.xml')
+        popfile = os.path.join(tempdir, 'pop.bil')
+        pdict = GeoDict.createDictFromBox(-123., -121., 36., 38., 1/30.,
+                                          1/30.)
+        GDALGrid(np.full((pdict.ny, pdict.nx), 5000.), pdict).save(popfile)
+        gdict = GeoDict.createDictFromBox(-122.3, -121.5, 36.6, 37.1,
+                                          1/120., 1/120.)
+        # Low probabilities over a large population
+        yy, xx = np.mgrid[0:gdict.ny, 0:gdict.nx]
+        data = 0.001 + 0.001 * np.sin(yy / 20.)**2 * np.cos(xx / 30.)**2
+        grid = Grid2D(data, gdict)
+
+        # Same alert statistics as computeStats of all the cells
+        stats = getAlertStats(grid, shakefile, pop_file=popfile,
+                              model='jessee_2017', event_dir=tempdir)
+        target = computeStats(grid, probthresh=None, shakefile=shakefile,
+                              shakethreshtype='pga', shakethresh=10.,
+                              statprobthresh=None, pop_file=popfile,
+                              proj='ellipsoid')
+        for key in ['Hagg_0.10g', 'exp_pop_0.10g']:
+            np.testing.assert_allclose(stats[key], target[key], rtol=1e-10)
+        assert stats['exp_pop_0.10g'] > 0.
+        thresholded = computeStats(grid, shakefile=shakefile,
+                                   shakethresh=10., statprobthresh=0.002,
+                                   pop_file=popfile, proj='ellipsoid')
+        assert thresholded['exp_pop_0.10g'] < stats['exp_pop_0.10g']
+
+        # Read back by later runs for the event
+        clearStatsStores()
+        getAlertStats(grid, shakefile, pop_file=popfile, event_dir=tempdir)
+        assert getStatsStore(tempdir).hits == 1
+        assert getStatsStore(tempdir).misses == 0
+    finally:
+        clearStatsStores()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_statstore()
+    test_alertstats()
+    print('statstore.py tests passed')
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import os.path
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from mapio.grid2d import Grid2D
+from mapio.geodict import GeoDict
+from gfail.temphdf import getTempStore, BACKENDS, chooseBackend
+
+geodict = GeoDict({'xmin': 0.5, 'xmax': 4.5,
+                   'ymin': 0.5, 'ymax': 3.5,
+                   'dx': 1.0, 'dy': 1.0,
+                   'ny': 4, 'nx': 5})
+data = np.arange(20, dtype=float).reshape(4, 5)
+
+
+def test_backends():
+    tempdir = tempfile.mkdtemp()
+    try:
+        for backend in BACKENDS:
+            store = getTempStore(Grid2D(data, geodict),
+                                 os.path.join(tempdir, 'slope.hdf5'),
+                                 backend=backend)
+            assert store.getGeoDict() == geodict
+            np.testing.assert_array_equal(store.getSlice(), data)
+            np.testing.assert_array_equal(
+                store.getSlice(1, 3, 2, None, name='slope'), data[1:3, 2:])
+            # An end of -1 means the end of the axis
+            np.testing.assert_array_equal(
+                store.getSlice(2, -1, 0, -1, name='slope'), data[2:, 0:])
+            # Slices are copies
+            store.getSlice(name='slope')[:] = 0.
+            np.testing.assert_array_equal(store.getSlice(), data)
+            # Stores can be sent to other processes
+            store2 = pickle.loads(pickle.dumps(store))
+            np.testing.assert_array_equal(store2.getSlice(0, 1), data[0:1])
+            rowstarts, rowends, colstarts, colends = store.getSliceDiv(3, 2)
+            np.testing.assert_array_equal(rowstarts, [0, 3, 0, 3, 0, 3])
+            np.testing.assert_array_equal(colstarts, [0, 0, 2, 2, 4, 4])
+    finally:
+        shutil.rmtree(tempdir)
+    assert chooseBackend(1) in ['memory', 'hdf5']
+    assert chooseBackend(1e30) == 'hdf5'
+
+
+if __name__ == "__main__":
+    test_backends()
+    print('temphdf.py tests passed')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import pickle
+import numpy as np
+from gfail.termcompiler import TermKernel, splitTerms
+
+
+class FakeLayer(object):
+    def __init__(self, data):
+        self.data = data
+
+    def getSlice(self, rowstart=None, rowend=None, colstart=None,
+                 colend=None, name=None):
+        return self.data[rowstart:rowend, colstart:colend]
+
+
+class FakeModel(object):
+    def __init__(self):
+        np.random.seed(1)
+        self.layerdict = {'slope': FakeLayer(np.random.rand(4, 5) * 40.),
+                          'cti': FakeLayer(np.random.rand(4, 5) * 10.)}
+        self.shakemap = {'pgv': FakeLayer(np.random.rand(4, 5) * 50. + 1.)}
+        self.uncert = {'stdpgv': FakeLayer(np.random.rand(4, 5) * 0.5)}
+        self.eventdict = {'magnitude': 7.2}
+        self.numstd = 1
+
+
+PGV = ("self.shakemap['pgv'].getSlice(rowstart, rowend, colstart, colend, "
+       "name='pgv')")
+SLOPE = ("self.layerdict['slope'].getSlice(rowstart, rowend, colstart, "
+         "colend, name='slope')")
+CTI = ("self.layerdict['cti'].getSlice(rowstart, rowend, colstart, colend, "
+       "name='cti')")
+PGVMIN = ("np.exp(np.log(%s) - self.numstd * self.uncert['stdpgv'].getSlice("
+          "rowstart, rowend, colstart, colend, name='stdpgv'))" % PGV)
+PGVMAX = PGVMIN.replace(' - ', ' + ')
+
+
+def _equation(pgv):
+    return ' + '.join([
+        '-6.3',
+        '(1.65 * np.log(%s))' % pgv,
+        '(0.06 * np.arctan(%s) * 180 / np.pi)' % SLOPE,
+        "(0.1 * %s * self.eventdict['magnitude'])" % CTI,
+        '(0.01 * np.log(%s) * np.arctan(%s) * 180 / np.pi)' % (pgv, SLOPE)])
+
+
+def test_termkernel():
+    self = FakeModel()
+    equations = [_equation(PGV), _equation(PGVMIN), _equation(PGVMAX)]
+    kernel = TermKernel(equations, scope={'self': self, 'np': np})
+
+    # Each layer is read only once
+    assert kernel.getLeaves() == [('shakemap', 'pgv', 'pgv'),
+                                  ('layerdict', 'slope', 'slope'),
+                                  ('layerdict', 'cti', 'cti'),
+                                  ('uncert', 'stdpgv', 'stdpgv')]
+
+    for rowstart, rowend, colstart, colend in [(None, None, None, None),
+                                               (1, 3, 0, 2), (3, None, 2, 5)]:
+        reads = []
+
+        def fetch(source, key, name):
+            reads.append(key)
+            return getattr(self, source)[key].getSlice(
+                rowstart, rowend, colstart, colend, name=name)
+
+        results = kernel.evaluate(fetch)
+        assert sorted(reads) == ['cti', 'pgv', 'slope', 'stdpgv']
+        for eqn, result in zip(equations, results):
+            np.testing.assert_allclose(result, eval(eqn), rtol=1e-12)
+
+    # Kernels survive pickling (for use in worker processes)
+    kernel2 = pickle.loads(pickle.dumps(kernel))
+    results = kernel2.evaluate(
+        lambda source, key, name: getattr(self, source)[key].getSlice())
+    rowstart = rowend = colstart = colend = None
+    np.testing.assert_allclose(results[0], eval(equations[0]), rtol=1e-12)
+
+
+def test_termkernel_none():
+    self = FakeModel()
+    kernel = TermKernel(['2.5 + (3 * %s)' % SLOPE, None, None],
+                        scope={'self': self, 'np': np})
+    results = kernel.evaluate(
+        lambda source, key, name: getattr(self, source)[key].getSlice())
+    assert results[1] is None and results[2] is None
+    np.testing.assert_allclose(results[0],
+                               2.5 + 3 * self.layerdict['slope'].data)
+
+
+def test_splitTerms():
+    pga = ("self.shakemap['pga'].getSlice(rowstart, rowend, colstart, "
+           "colend, name='pga')")
+    slope = ("self.layerdict['slope'].getSlice(rowstart, rowend, colstart, "
+             "colend, name='slope')")
+    static, factors = splitTerms(['-3.5', '(2 * np.log(%s))' % pga,
+                                  '(0.5 * %s * np.log(%s))' % (slope, pga),
+                                  '(0.1 * %s)' % slope])
+    assert static == ['(-3.5)', '(0.1 * %s)' % slope]
+    assert list(factors.keys()) == ['np.log(%s)' % pga]
+    assert factors['np.log(%s)' % pga] == ['2', '(0.5 * %s)' % slope]
+
+    # Terms mixing shaking and layers in one factor cannot be split
+    try:
+        splitTerms(['(2 * np.log(%s * %s))' % (pga, slope)])
+        raise AssertionError('splitTerms should have failed')
+    except Exception as e:
+        assert 'cannot be split' in str(e)
+
+
+if __name__ == "__main__":
+    test_termkernel()
+    test_termkernel_none()
+    test_splitTerms()
+    print('termcompiler.py tests passed')
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import os.path
+import json
+import shutil
+import tempfile
+import numpy as np
+import matplotlib as mpl
+from mapio.geodict import GeoDict
+from gfail.tiles import (colorize, getNativeZoom, getTileRange, renderTile,
+                         writeTiles, getCoarseFactors, coarsen, TILESIZE)
+
+DFCOLORS = [
+    [0.94, 0.94, 0.70, 0.3],
+    [0.90, 0.78, 0.18, 0.4],
+    [0.92, 0.45, 0.03, 0.5],
+    [0.75, 0.22, 0.36, 0.6],
+    [0.36, 0.16, 0.70, 0.6],
+    [0.12, 0.12, 0.39, 0.6]
+]
+
+DFBINS = [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+
+
+def test_colorize():
+    rs = np.random.RandomState(0)
+    data = rs.uniform(0., 0.7, (50, 60))
+    data[rs.rand(50, 60) < 0.2] = np.nan
+    data[0, :7] = DFBINS
+    for levels, colorlist in [(DFBINS, DFCOLORS), ([0., 0.1, 0.5], DFCOLORS)]:
+        # Same colors as create_png saves
+        cmap = mpl.colors.ListedColormap(colorlist)
+        norm = mpl.colors.BoundaryNorm(levels, cmap.N)
+        data2 = np.ma.array(np.clip(data, levels[0], levels[-1]),
+                            mask=np.isnan(data))
+        target = (cmap(norm(data2)) * 255).astype(np.uint8)
+        np.testing.assert_array_equal(colorize(data, levels, colorlist),
+                                      target)
+
+
+def test_tiles():
+    gdict = GeoDict.createDictFromBox(-122.3, -121.5, 36.6, 37.1, 1/120.,
+                                      1/120.)
+    data = np.full((gdict.ny, gdict.nx), 0.3)
+    data[:, :gdict.nx // 2] = np.nan
+    rgba = colorize(data, DFBINS, DFCOLORS)
+    assert getNativeZoom(gdict) == 8
+
+    # Pixels take the color of the cell their center is in
+    zoom = 10
+    x0, x1, y0, y1 = getTileRange(gdict, zoom)
+    assert (x0, x1, y0, y1) == (164, 167, 398, 401)
+    tile = renderTile(rgba, gdict, zoom, x1 - 1, y0 + 1)
+    n = 2. ** zoom
+    for i, j in [(0, 255), (100, 200), (255, 0)]:
+        lon = (x1 - 1 + (j + 0.5) / TILESIZE) / n * 360. - 180.
+        lat = np.degrees(np.arctan(np.sinh(
+            np.pi * (1. - 2. * (y0 + 1 + (i + 0.5) / TILESIZE) / n))))
+        row = int((gdict.ymax + gdict.dy / 2. - lat) / gdict.dy)
+        col = int((lon - gdict.xmin + gdict.dx / 2.) / gdict.dx)
+        if 0 <= row < gdict.ny and 0 <= col < gdict.nx:
+            np.testing.assert_array_equal(tile[i, j], rgba[row, col])
+        else:
+            assert tile[i, j, 3] == 0
+    # Tiles over nan cells only are empty
+    assert renderTile(rgba, gdict, zoom, x0, y0 + 1) is None
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        outdir = os.path.join(tempdir, 'tiles')
+        manifest = writeTiles(rgba, gdict, outdir, minzoom=zoom,
+                              maxzoom=zoom)
+        with open(manifest, 'r') as f:
+            info = json.load(f)
+        saved = sorted(os.listdir(os.path.join(outdir, str(zoom))))
+        assert saved == ['165', '166']
+        assert info['ntiles'] == 6
+        tilefile = os.path.join(outdir, str(zoom), str(x1 - 1),
+                                '%d.png' % (y0 + 1))
+        image = mpl.pyplot.imread(tilefile)
+        np.testing.assert_array_equal((image * 255).round(), tile)
+
+        # Same tiles rendered concurrently, old tiles are removed
+        writeTiles(rgba, gdict, outdir, nworkers=4)
+        assert not os.path.exists(os.path.join(outdir, str(zoom)))
+        for zoom in range(4, 9):
+            assert os.path.isdir(os.path.join(outdir, str(zoom)))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_coarsen():
+    gdict = GeoDict.createDictFromBox(-122.3, -121.5, 36.6, 37.1, 1/120.,
+                                      1/120.)
+    data = np.full((gdict.ny, gdict.nx), 0.006)
+    data[:10, :] = np.nan
+    data[30, 41] = 0.3
+    rgba = colorize(data, DFBINS, DFCOLORS)
+    assert getCoarseFactors(gdict, 8) == (1, 1)
+    assert getCoarseFactors(gdict, 6) == (3, 3)
+    assert getCoarseFactors(gdict, 5) == (5, 6)
+
+    # Blocks take the color of their highest cell, nan cells are lowest
+    crgba, cdict = coarsen(rgba, gdict, 4, 5, data=data)
+    assert (cdict.ny, cdict.nx) == (16, 20)
+    assert cdict.dx == gdict.dx * 5 and cdict.dy == gdict.dy * 4
+    assert cdict.xmin - cdict.dx / 2. == gdict.xmin - gdict.dx / 2.
+    assert cdict.ymax + cdict.dy / 2. == gdict.ymax + gdict.dy / 2.
+    np.testing.assert_array_equal(crgba[7, 8], rgba[30, 41])
+    np.testing.assert_array_equal(crgba[2, 0], rgba[10, 0])
+    assert not crgba[:2, :, 3].any()
+    # Without values, colored cells are kept over transparent ones
+    crgba, cdict = coarsen(rgba, gdict, 3, 3)
+    assert crgba[3, 0, 3] > 0
+
+    # The single high cell still shows at overview zooms
+    color = rgba[30, 41]
+    tempdir = tempfile.mkdtemp()
+    try:
+        outdir = os.path.join(tempdir, 'tiles')
+        writeTiles(rgba, gdict, outdir, minzoom=4, maxzoom=8, data=data)
+        for zoom in range(4, 9):
+            found = False
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(outdir, str(zoom))):
+                for filename in filenames:
+                    image = mpl.pyplot.imread(os.path.join(dirpath,
+                                                           filename))
+                    image = (image * 255).round().astype(np.uint8)
+                    found = found or (image == color).all(axis=2).any()
+            assert found
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    test_colorize()
+    test_tiles()
+    test_coarsen()
+    print('tiles.py tests passed')